@@ -1,11 +1,59 @@
-import pika, time
+import pika, time, random
+import cProfile, os, signal
 import logging
+import functools
+from concurrent.futures import ProcessPoolExecutor
 from pika.frame import *
 
 LOG_FORMAT = ('%(levelname) -10s %(asctime)s %(name) -30s %(funcName) '
                 '-35s %(lineno) -5d: %(message)s')
 LOGGER = logging.getLogger(__name__)
 
+class delivery_record:
+    """
+    Compact record of a delivered message, used when messages are buffered. Keeps only the
+    delivery tag, routing key and the properties handlers use, instead of the full message
+    details and properties objects. It has the attributes of both that the engine uses, so
+    it can be passed in place of either.
+
+    :param basic_deliver: message details
+    :param properties: message properties
+    :param body: message body, kept as the bytes object pika delivered, without copying
+    """
+
+    __slots__ = ('delivery_tag', 'routing_key', 'redelivered', 'content_type', 'headers', 'timestamp', 'body')
+
+    def __init__(self, basic_deliver, properties, body):
+        self.delivery_tag = basic_deliver.delivery_tag
+        self.routing_key = basic_deliver.routing_key
+        self.redelivered = basic_deliver.redelivered
+        self.content_type = properties.content_type
+        self.headers = properties.headers
+        self.timestamp = properties.timestamp
+        self.body = body
+
+def process_body(body):
+    """
+    Does the CPU-bound work for a message body in a worker process, when the consumer is started
+    with process_workers. It only gets the body, and has to be a module-level function so it can be
+    sent to the worker processes. Returns the body, replace with the real work.
+
+    :param body: message body
+    :return: result passed back to consume_engine.process_result
+    """
+
+    return body
+
+def ignore_interrupts():
+    """
+    Initializer for the worker processes. The consumer handles SIGINT and drains the work in flight,
+    so the workers ignore it instead of being interrupted along with it, and do not inherit the
+    consumer's SIGTERM handler.
+    """
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
 class consume_engine:
     """
     Class to consume asynchronous messages from RabbitMQ server using pika.
@@ -16,18 +64,87 @@ class consume_engine:
     :param port: port to connect to RabbitMQ server on host
     :param vhost: virtual host on RabbitMQ server
     :param queue: queue to consume messages from
+    :param batch_size: maximum number of messages passed to on_batch at once, messages are passed
+                       to on_message one at a time when not set
+    :param batch_wait: maximum number of milliseconds to wait for a batch to fill before passing it to on_batch
+    :param max_buffered_bytes: maximum number of body bytes buffered in a batch, once exceeded the consumer
+                               is cancelled until the batch has been passed on, and then started again
+    :param profile_seconds: number of seconds to profile for when profiling is started with SIGUSR1
+    :param profile_dir: directory the profile stats are written to
+    :param connection_options: extra pika.ConnectionParameters arguments, such as a tuning profile from
+                               connection_profiles/connection_profiles.py
+    :param drain_timeout: number of seconds to wait for in-flight work to finish when shutting down
+    :param nodes: list of (host, port) cluster nodes to connect to, defaults to [(host, port)]
+    :param node_policy: order nodes are tried in, 'round_robin', 'random' or 'least_connections'
+    :param management: management_client from management/management.py, used to find the node that leads the
+                       queue, which is then tried first
+    :param leader_timeout: number of seconds to wait for the management API when looking up the leader before
+                           every connection, the nodes are tried in node_policy order if it does not reply in time
+    :param failover_timeout: number of seconds used as heartbeat and connect timeout when more than one node
+                             is given, pika closes a connection to a lost node once no traffic has arrived for
+                             failover_timeout + 5 seconds, so failover takes between that and twice that
+    :param reconnect_jitter: maximum number of seconds to wait at random before reconnecting, so consumers
+                             that lost the same node do not all reconnect at once
+    :param reconnect_backoff_max: maximum number of seconds to wait before trying the nodes again once all of them failed
+    :param process_workers: number of worker processes message bodies are passed to, so CPU-bound work runs on
+                            all cores and does not block the ioloop, messages are processed on the ioloop when not set
+    :param process_function: module-level function the worker processes call with each body, defaults to process_body
+    :param process_prefetch: maximum number of messages in flight to the worker processes, defaults to twice process_workers
+    :param serializers: serializer registry from serializers/serializers.py, bodies are decoded by their
+                        content type before they are processed when set
+    :param tracer: latency_tracer from latency/latency.py, records broker dwell time and processing time per routing key,
+                   not used for messages passed to process_workers, which are handled in another process
     """
 
-    def __init__(self, username, password, host, port, vhost, queue):
+    # Connections open from this process to each node, for the least_connections policy
+    _node_connections = {}
+    _next_node = 0
+
+    def __init__(self, username, password, host, port, vhost, queue, batch_size=None, batch_wait=100,
+                 profile_seconds=30, profile_dir='.', max_buffered_bytes=None, connection_options=None,
+                 drain_timeout=30, nodes=None, node_policy='round_robin', management=None, leader_timeout=2,
+                 failover_timeout=10, reconnect_jitter=1.0, reconnect_backoff_max=30, process_workers=None,
+                 process_function=process_body, process_prefetch=None, serializers=None, tracer=None):
         self._username = username
         self._password = password
         self._host = host
         self._port = port
+        self._nodes = [tuple(node) for node in nodes] if nodes else [(host, port)]
+        self._node_policy = node_policy
+        self._management = management
+        self._leader_timeout = leader_timeout
+        self._failover_timeout = failover_timeout
+        self._reconnect_jitter = reconnect_jitter
+        self._reconnect_backoff_max = reconnect_backoff_max
+        self._node = None
+        self._opened = False
+        self._stopping = False
         self._vhost = vhost
+        self._connection_options = connection_options or {}
         self._channel = None
         self._connection = None
         self._queue = queue
         self._consumer_tag = None
+        self._batch_size = batch_size
+        self._batch_wait = batch_wait
+        self._batch = []
+        self._batch_timer = None
+        self._max_buffered_bytes = max_buffered_bytes
+        self._buffered_bytes = 0
+        self._paused = False
+        self._drain_timeout = drain_timeout
+        self._drain_deadline = None
+        self._in_flight = 0
+        self._process_workers = process_workers
+        self._process_function = process_function
+        self._process_prefetch = process_prefetch or (process_workers or 0) * 2
+        self._pool = None
+        self._serializers = serializers
+        self._tracer = tracer
+        self._profile_seconds = profile_seconds
+        self._profile_dir = profile_dir
+        self._profiler = None
+        self._callback_times = {}
 
     def on_open(self, connection):
         """
@@ -37,7 +154,9 @@ class consume_engine:
         :param connection: connection passed through from server callback
         """
 
-        print("Reached connection open \n")
+        print("Reached connection open to %s:%i \n" % self._node)
+        self._opened = True
+        consume_engine._node_connections[self._node] = consume_engine._node_connections.get(self._node, 0) + 1
         self._channel = self._connection.channel(on_open_callback=self.on_channel_open)
 
     def on_channel_open(self, channel):
@@ -59,8 +178,37 @@ class consume_engine:
 
         :param channel: channel passed through from server on callback
         """
+        started = time.perf_counter_ns() if self._profiler else None
         self._channel.add_on_cancel_callback(self.on_consumer_cancelled)
-        self._consumer_tag = self._channel.basic_consume(self._queue, self.on_message)
+        if self._batch_size:
+            self._channel.basic_qos(prefetch_count=self._batch_size, callback=self.on_qos)
+        elif self._process_workers:
+            self._channel.basic_qos(prefetch_count=self._process_prefetch, callback=self.on_process_qos)
+        else:
+            self._consumer_tag = self._channel.basic_consume(self._queue, self.on_message)
+        if started is not None:
+            self.record_callback_time('on_declare', started)
+
+    def on_qos(self, method_frame):
+        """
+        Method called when the prefetch count for batch mode has been set. Sets up the consumer
+        to add messages to the current batch.
+
+        :param method_frame: method frame passed through from server on callback
+        """
+
+        self._consumer_tag = self._channel.basic_consume(self._queue, self.on_batch_message)
+
+    def on_process_qos(self, method_frame):
+        """
+        Method called when the prefetch count for the worker processes has been set, so no more
+        than process_prefetch messages are in flight at once. Sets up the consumer to pass messages
+        to the worker processes.
+
+        :param method_frame: method frame passed through from server on callback
+        """
+
+        self._consumer_tag = self._channel.basic_consume(self._queue, self.on_process_message)
 
     def on_consumer_cancelled(self, method_frame):
         """
@@ -69,9 +217,31 @@ class consume_engine:
         :param method_frame: method frame passed through from server on callback
         """
         print(method_frame)
-        if self._channel:
+        if len(self._nodes) > 1 and not self._stopping:
+            # The queue leader may have moved, reconnect so the new leader is tried first
+            self._connection.close()
+        elif self._channel:
             self._channel.close()
 
+    def on_control_message(self, properties):
+        """
+        Handles a control message, a message with an x-control header. x-control 'profile' starts
+        profiling for x-profile-seconds, or profile_seconds when that header is not set.
+
+        :param properties: message properties passed through from server on callback
+        :return: True if the message was a control message
+        """
+
+        headers = properties.headers or {}
+        control = headers.get('x-control')
+        if control is None:
+            return False
+        if control == 'profile':
+            self.start_profiling(headers.get('x-profile-seconds'))
+        else:
+            print("Unknown control message: %s \n" % control)
+        return True
+
     def on_message(self, channel, basic_deliver, properties, body):
         """
         Method called when a message is received by consumer. Sends an acknowledgement that
@@ -83,15 +253,266 @@ class consume_engine:
         :param body: message body passed through from server on callback
         """
 
+        started = time.perf_counter_ns() if self._profiler else None
         self._channel.basic_ack(basic_deliver.delivery_tag)
+        if not self.on_control_message(properties):
+            self.handle_message(channel, basic_deliver, properties, self.decode_body(properties, body))
+        if started is not None:
+            self.record_callback_time('on_message', started)
+
+    def on_process_message(self, channel, basic_deliver, properties, body):
+        """
+        Method called when a message is received with process_workers set. Submits the body to the
+        worker processes, and schedules on_process_done on the ioloop for when the result is back.
+
+        :param channel: channel passed through from server on callback
+        :param basic_deliver: message details passed through from server on callback
+        :param properties: message properties passed through from server on callback
+        :param body: message body passed through from server on callback
+        """
+
+        started = time.perf_counter_ns() if self._profiler else None
+        if self.on_control_message(properties):
+            self._channel.basic_ack(basic_deliver.delivery_tag)
+        else:
+            self._in_flight += 1
+            future = self._pool.submit(self._process_function, body)
+            done = functools.partial(self.on_process_done, self._connection, basic_deliver, properties)
+            future.add_done_callback(lambda future: self._connection.ioloop.add_callback_threadsafe(
+                functools.partial(done, future)))
+        if started is not None:
+            self.record_callback_time('on_process_message', started)
+
+    def on_process_done(self, connection, basic_deliver, properties, future):
+        """
+        Method called on the ioloop when a worker process has finished a message. Passes the result to
+        process_result and acknowledges the message. A message that failed is requeued once, and
+        dropped if it fails again. Results for a connection that has since been lost are ignored,
+        as the server redelivers those messages.
+
+        :param connection: connection the message was delivered on
+        :param basic_deliver: message details passed through from server on callback
+        :param properties: message properties passed through from server on callback
+        :param future: future of the worker process handling the message
+        """
+
+        if connection is not self._connection or self._channel is None or not self._channel.is_open:
+            return
+        self._in_flight -= 1
+        error = future.exception()
+        if error is not None:
+            print("Processing failed: %r \n" % error)
+            self._channel.basic_nack(delivery_tag=basic_deliver.delivery_tag, requeue=not basic_deliver.redelivered)
+            return
+        try:
+            self.process_result(basic_deliver, properties, future.result())
+        finally:
+            self._channel.basic_ack(basic_deliver.delivery_tag)
+
+    def process_result(self, basic_deliver, properties, result):
+        """
+        Called on the ioloop with the result of process_function for a message, before it is acknowledged.
+
+        :param basic_deliver: message details passed through from server on callback
+        :param properties: message properties passed through from server on callback
+        :param result: value returned by process_function
+        """
+
+        print("Delivery tag %i processed: %s" %(basic_deliver.delivery_tag, result))
+
+    def decode_body(self, properties, body):
+        """
+        Decodes a body by its content type with the serializers registry. The body is passed on as it
+        is when no registry is set, or no codec is registered for its content type.
+
+        :param properties: message properties passed through from server on callback
+        :param body: message body passed through from server on callback
+        """
+
+        if self._serializers is None:
+            return body
+        return self._serializers.decode(properties.content_type, body)
+
+    def process_message(self, channel, basic_deliver, properties, body):
+        """
+        Does the work for a message. Raising an exception marks the message as failed in batch mode.
+
+        :param channel: channel passed through from server on callback
+        :param basic_deliver: message details passed through from server on callback
+        :param properties: message properties passed through from server on callback
+        :param body: message body passed through from server on callback
+        """
+
         print(basic_deliver)
         print("Delivery tag is: " + str(basic_deliver.delivery_tag))
         print(properties)
         print("Recevied Content: " + str(body))
 
+    def handle_message(self, channel, basic_deliver, properties, body):
+        """
+        Passes a message to process_message, through the tracer when one is set.
+
+        :param channel: channel passed through from server on callback
+        :param basic_deliver: message details passed through from server on callback
+        :param properties: message properties passed through from server on callback
+        :param body: message body, decoded
+        """
+
+        if self._tracer is None:
+            self.process_message(channel, basic_deliver, properties, body)
+        else:
+            self._tracer.handle(self.process_message, channel, basic_deliver, properties, body)
+
+    def on_batch(self, messages):
+        """
+        Called with a batch of messages. Processes each message in turn, override to handle
+        the whole batch in one call, for example a single write to a database.
+
+        :param messages: list of delivery_record
+        :return: list of the messages that failed, if any
+        """
+
+        failed = []
+        for message in messages:
+            try:
+                self.handle_message(self._channel, message, message, self.decode_body(message, message.body))
+            except Exception:
+                failed.append(message)
+        return failed
+
+    def on_batch_message(self, channel, basic_deliver, properties, body):
+        """
+        Method called when a message is received in batch mode. Adds the message to the current
+        batch, and passes the batch on once it is full. The first message of a batch starts a
+        timer that passes the batch on after batch_wait milliseconds, if it has not filled by then.
+        Consumption is paused once the batch holds more than max_buffered_bytes.
+
+        :param channel: channel passed through from server on callback
+        :param basic_deliver: message details passed through from server on callback
+        :param properties: message properties passed through from server on callback
+        :param body: message body passed through from server on callback
+        """
+
+        started = time.perf_counter_ns() if self._profiler else None
+        if self.on_control_message(properties):
+            self._channel.basic_ack(basic_deliver.delivery_tag)
+        else:
+            self._batch.append(delivery_record(basic_deliver, properties, body))
+            self._buffered_bytes += len(body)
+            if self._max_buffered_bytes and self._buffered_bytes > self._max_buffered_bytes and not self._paused:
+                self.pause_consuming()
+            if len(self._batch) >= self._batch_size:
+                self.flush_batch()
+            elif self._batch_timer is None:
+                self._batch_timer = self._connection.ioloop.call_later(self._batch_wait / 1000.0, self.flush_batch)
+        if started is not None:
+            self.record_callback_time('on_batch_message', started)
+
+    def flush_batch(self):
+        """
+        Passes the current batch to on_batch. Failed messages are rejected and requeued individually,
+        and then the rest of the batch is acknowledged with a single multiple acknowledgement up to
+        the last message that succeeded, which skips the messages already rejected.
+        """
+
+        if self._batch_timer is not None:
+            self._connection.ioloop.remove_timeout(self._batch_timer)
+            self._batch_timer = None
+
+        messages = self._batch
+        self._batch = []
+        self._buffered_bytes = 0
+        if not messages:
+            return
+
+        nacked = set()
+        for message in self.on_batch(messages) or []:
+            self._channel.basic_nack(delivery_tag=message.delivery_tag, requeue=True)
+            nacked.add(message.delivery_tag)
+        acked = [message.delivery_tag for message in messages if message.delivery_tag not in nacked]
+        if acked:
+            self._channel.basic_ack(delivery_tag=max(acked), multiple=True)
+        if self._paused and not self._stopping:
+            self.resume_consuming()
+
+    def pause_consuming(self):
+        """
+        Cancels the consumer, so the server stops delivering messages until the buffered messages
+        have been acknowledged. A new prefetch count would only apply to consumers started after
+        it, so it cannot throttle this one. Messages that arrive before the server has cancelled
+        the consumer are rejected by pika and requeued.
+        """
+
+        self._paused = True
+        self._channel.basic_cancel(consumer_tag=self._consumer_tag)
+        print("Paused consuming, %i bytes buffered \n" % self._buffered_bytes)
+
+    def resume_consuming(self):
+        """
+        Starts a new consumer after consumption was paused.
+        """
+
+        self._paused = False
+        self._consumer_tag = self._channel.basic_consume(self._queue, self.on_batch_message)
+        print("Resumed consuming \n")
+
+    def on_profile_signal(self, signum, frame):
+        """
+        Signal handler that starts profiling. The profiler is started from the ioloop, not from
+        inside the signal handler.
+
+        :param signum: signal number
+        :param frame: stack frame the signal interrupted
+        """
+
+        self._connection.ioloop.add_callback_threadsafe(self.start_profiling)
+
+    def start_profiling(self, seconds=None):
+        """
+        Starts cProfile and the callback timers, and schedules them to stop after the number of
+        seconds. Does nothing if profiling has already started.
+
+        :param seconds: number of seconds to profile for, defaults to profile_seconds
+        """
+
+        if self._profiler is not None:
+            return
+        seconds = seconds or self._profile_seconds
+        print("Profiling for %s seconds \n" % seconds)
+        self._callback_times = {}
+        self._profiler = cProfile.Profile()
+        self._profiler.enable()
+        self._connection.ioloop.call_later(seconds, self.stop_profiling)
+
+    def stop_profiling(self):
+        """
+        Stops cProfile, writes the stats to a file in profile_dir, and prints the callback timers.
+        """
+
+        if self._profiler is None:
+            return
+        self._profiler.disable()
+        path = os.path.join(self._profile_dir, '%s-%i-%i.prof' %(self.__class__.__name__, os.getpid(), int(time.time())))
+        self._profiler.dump_stats(path)
+        self._profiler = None
+        print("Profile written to %s \n" % path)
+        for name, (calls, total_ns) in sorted(self._callback_times.items()):
+            print("%s calls: %i total: %.3fms mean: %.1fus" %(name, calls, total_ns / 1e6, total_ns / 1e3 / calls))
+
+    def record_callback_time(self, name, started):
+        """
+        Adds the time since started to the timer for the callback.
+
+        :param name: name of the callback
+        :param started: time.perf_counter_ns() when the callback started
+        """
+
+        calls, total_ns = self._callback_times.get(name, (0, 0))
+        self._callback_times[name] = (calls + 1, total_ns + time.perf_counter_ns() - started)
+
     def on_close(self, connection, reply_code):
         """
-        Method called when the connection to the RabbitMQ server is closed.
+        Method called when the connection to the RabbitMQ server is closed. Stops the ioloop.
 
         :param connection: connection passed through from server callback
         :param reply_code: code passed through from server on callback containing shutdown code
@@ -99,50 +520,199 @@ class consume_engine:
 
         print(reply_code)
         print("connection is being closed \n")
+        if self._opened:
+            consume_engine._node_connections[self._node] -= 1
+        self.reset_state()
+        self._connection.ioloop.stop()
+
+    def on_open_error(self, connection, error):
+        """
+        Method called when the connection to a node could not be opened. Stops the ioloop so the
+        next node is tried.
+
+        :param connection: connection passed through from server callback
+        :param error: exception describing why the connection could not be opened
+        """
+
+        print("Connection to %s:%i could not be opened: %r \n" %(self._node[0], self._node[1], error))
+        self._connection.ioloop.stop()
+
+    def reset_state(self):
+        """
+        Forgets the channel and any buffered messages after the connection is lost. Messages that
+        were not acknowledged are redelivered by the server, so they are not kept for the next connection.
+        """
+
+        self._channel = None
+        self._consumer_tag = None
+        self._batch = []
+        self._batch_timer = None
+        self._buffered_bytes = 0
+        self._paused = False
+        self._in_flight = 0
+
+    def order_nodes(self):
+        """
+        Returns the nodes in the order they should be tried, by node_policy, with the node that
+        leads the queue first. The leader lookup waits at most leader_timeout seconds, so a slow
+        or unreachable management API does not hold up reconnecting.
+        """
+
+        nodes = list(self._nodes)
+        if self._node_policy == 'random':
+            random.shuffle(nodes)
+        elif self._node_policy == 'least_connections':
+            random.shuffle(nodes)
+            nodes.sort(key=lambda node: consume_engine._node_connections.get(node, 0))
+        else:
+            start = consume_engine._next_node % len(nodes)
+            consume_engine._next_node += 1
+            nodes = nodes[start:] + nodes[:start]
+
+        leader = self._management.queue_leader(self._queue, timeout=self._leader_timeout) if self._management else None
+        if leader is not None:
+            nodes.sort(key=lambda node: node[0] != leader and node[0].split('.')[0] != leader.split('.')[0])
+        return nodes
+
+    def connect(self, node):
+        """
+        Creates the asynchronous connection to a node, using the credentials used to instantiate this
+        consumer engine.
+
+        :param node: (host, port) of the node
+        """
+
+        self._node = node
+        self._opened = False
+        credentials = pika.PlainCredentials(self._username, self._password)
+        options = {'socket_timeout': 300}
+        if len(self._nodes) > 1:
+            options.update(heartbeat=self._failover_timeout, socket_timeout=self._failover_timeout)
+        options.update(self._connection_options)
+        options['connection_attempts'] = 1
+        parameters = pika.ConnectionParameters(node[0], node[1], self._vhost, credentials, **options)
+        self._connection = pika.SelectConnection(parameters, on_open_callback=self.on_open,
+                                                 on_open_error_callback=self.on_open_error)
+        self._connection.add_on_close_callback(self.on_close)
+
+    def on_shutdown_signal(self, signum, frame):
+        """
+        Signal handler for SIGTERM and SIGINT. The first signal starts draining from the ioloop,
+        a second signal closes the connection straight away.
+
+        :param signum: signal number
+        :param frame: stack frame the signal interrupted
+        """
+
+        if self._connection is None or self._connection.is_closed:
+            # Between connections, stop instead of reconnecting
+            self._stopping = True
+        elif self._drain_deadline is None:
+            self._connection.ioloop.add_callback_threadsafe(self.stop_consuming)
+        else:
+            self._connection.ioloop.add_callback_threadsafe(self.close_connection)
 
     def stop_consuming(self):
         """
         Method to cancel consumer connection to server. Pass in callback methods for handling shutdown,
-        once server gives ok.
+        once server gives ok. The connection is closed after drain_timeout seconds even if in-flight
+        work has not finished by then.
         """
-        print("Keyboard Interupt recevied !!!")
-        if self._channel:
+        print("Shutdown recevied, draining !!!")
+        self._stopping = True
+        if self._drain_deadline is not None:
+            return
+        self._drain_deadline = time.monotonic() + self._drain_timeout
+        self._connection.ioloop.call_later(self._drain_timeout, self.close_connection)
+        if self._channel and self._channel.is_open and self._paused:
+            # The consumer was already cancelled when consumption was paused
+            self.on_cancelok(None)
+        elif self._channel and self._channel.is_open:
             self._channel.basic_cancel(consumer_tag=self._consumer_tag, callback=self.on_cancelok)
+        else:
+            self.close_connection()
 
     def on_cancelok(self, unused_frame):
         """
-        Method called when basic consumer connection is cancelled to RabbitMQ server.
-        Closes channel and calls method to close connection.
+        Method called when basic consumer connection is cancelled to RabbitMQ server. No new
+        messages are delivered from here on. Passes on and acknowledges the current batch,
+        and calls method to finish draining.
 
         :param unused_frame: unused method frame passed through from server on callback
         """
-        self._channel.close()
+        self.flush_batch()
+        self.finish_drain()
+
+    def finish_drain(self):
+        """
+        Waits for in-flight work to finish and its acknowledgements to be sent, then closes the
+        channel and the connection, so no message that was already delivered is redelivered to
+        another consumer.
+        """
+
+        if self._in_flight and time.monotonic() < self._drain_deadline:
+            self._connection.ioloop.call_later(0.1, self.finish_drain)
+            return
+        if self._in_flight:
+            print("Drain timed out with %i messages in flight \n" % self._in_flight)
+        if self._channel and self._channel.is_open:
+            self._channel.close()
         self.close_connection()
 
     def close_connection(self):
         """
         Method to close the connection to RabbitMQ server.
         """
-        self._connection.close()
+        self._stopping = True
+        if not (self._connection.is_closing or self._connection.is_closed):
+            self._connection.close()
 
     def run(self):
         """
-        Set up the asynchronous connection to RabbitMQ server using the credentials used to instantiate this
-        consumer engine. Pass in the on_open and on_close methods as callbacks to handle connection open 
-        and close.
+        Connects to the nodes in the order given by order_nodes, and consumes from the first one that
+        opens. When the connection is lost, reconnects after a random wait of up to reconnect_jitter
+        seconds. When no node could be connected to, waits a random time of up to reconnect_jitter
+        doubled for each failed round, capped at reconnect_backoff_max seconds, before trying again.
+        Stops once the consumer has been shut down.
         """
         logging.basicConfig(level=logging.ERROR, format=LOG_FORMAT)
-        credentials = pika.PlainCredentials(self._username, self._password)
-        parameters = pika.ConnectionParameters(self._host, self._port, self._vhost, credentials, socket_timeout=300)
-        self._connection = pika.SelectConnection(parameters, on_open_callback=self.on_open)
-        self._connection.add_on_close_callback(self.on_close)
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, self.on_profile_signal)
+        signal.signal(signal.SIGTERM, self.on_shutdown_signal)
+        signal.signal(signal.SIGINT, self.on_shutdown_signal)
+
+        if self._process_workers:
+            self._pool = ProcessPoolExecutor(max_workers=self._process_workers, initializer=ignore_interrupts)
 
         try:
-            # Loop so we can communicate with RabbitMQ
-            self._connection.ioloop.start()
-        except KeyboardInterrupt:
-            # Gracefully close the connection
-            self.stop_consuming()
+            failed_rounds = 0
+            while not self._stopping:
+                for node in self.order_nodes():
+                    self.connect(node)
+                    try:
+                        # Loop so we can communicate with RabbitMQ
+                        self._connection.ioloop.start()
+                    except KeyboardInterrupt:
+                        # Gracefully close the connection
+                        self.stop_consuming()
+                        self._connection.ioloop.start()
+                    if self._stopping or self._opened:
+                        break
+
+                if self._stopping:
+                    break
+                if self._opened:
+                    failed_rounds = 0
+                    delay = random.uniform(0, self._reconnect_jitter)
+                    print("Connection lost, reconnecting in %.2f seconds \n" % delay)
+                else:
+                    failed_rounds += 1
+                    delay = random.uniform(0, min(self._reconnect_backoff_max, self._reconnect_jitter * 2 ** failed_rounds))
+                    print("No node could be connected to, retrying in %.2f seconds \n" % delay)
+                time.sleep(delay)
+        finally:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False)
 
 
 if __name__ == '__main__':
@@ -1,10 +1,88 @@
-import pika
+import pika, time, random
+import cProfile, os, signal
 import logging
+from pika import frame, spec
 
 LOG_FORMAT = ('%(levelname) -10s %(asctime)s %(name) -30s %(funcName) '
                 '-35s %(lineno) -5d: %(message)s\n')
 LOGGER = logging.getLogger(__name__)
 
+# coalescing_queue writes through pika's private Connection._output_marshaled_frames and reads the
+# negotiated frame size from params.frame_max, as in the pika 1.x series it was written against.
+# With any other version publishes go through channel.basic_publish one frame at a time.
+COALESCING_SUPPORTED = (pika.__version__.split('.')[0] == '1' and
+                        hasattr(pika.connection.Connection, '_output_marshaled_frames'))
+
+class coalescing_queue:
+    """
+    Gathers publishes on a channel and marshals their method, header and body frames into one
+    contiguous buffer, which is handed to the connection in one piece, so it goes out in a single
+    socket send instead of one send per frame. The buffer is flushed once per ioloop iteration,
+    or as soon as it holds flush_bytes. Messages are only counted as published once flushed, and
+    pending counts the buffered messages lost if the channel closes before they are flushed.
+
+    :param connection: open SelectConnection
+    :param channel: open channel to publish on
+    :param flush_bytes: number of buffered bytes that flushes the buffer straight away
+    """
+
+    def __init__(self, connection, channel, flush_bytes=65536):
+        self._connection = connection
+        self._channel = channel
+        self._channel_number = channel.channel_number
+        self._flush_bytes = flush_bytes
+        self._buffer = bytearray()
+        self._flush_timer = None
+        self.pending = 0
+        self.messages = 0
+        self.flushes = 0
+
+    def publish(self, exchange, routing_key, body, properties=None):
+        """
+        Marshals a message into the buffer.
+
+        :param exchange: exchange to publish to
+        :param routing_key: routing key of the message
+        :param body: message body
+        :param properties: pika.BasicProperties of the message
+        """
+
+        if not self._channel.is_open:
+            raise pika.exceptions.ChannelWrongStateError('Channel is closed.')
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        properties = properties or pika.BasicProperties()
+        # Negotiated frame size, less the frame header and frame end
+        body_max_length = self._connection.params.frame_max - spec.FRAME_HEADER_SIZE - spec.FRAME_END_SIZE
+        self._buffer += frame.Method(self._channel_number,
+                                     spec.Basic.Publish(exchange=exchange, routing_key=routing_key)).marshal()
+        self._buffer += frame.Header(self._channel_number, len(body), properties).marshal()
+        for start in range(0, len(body), body_max_length):
+            self._buffer += frame.Body(self._channel_number, body[start:start + body_max_length]).marshal()
+        self.pending += 1
+
+        if len(self._buffer) >= self._flush_bytes:
+            self.flush()
+        elif self._flush_timer is None:
+            self._flush_timer = self._connection.ioloop.call_later(0, self.flush)
+
+    def flush(self):
+        """
+        Hands the buffered frames to the connection as one write. Nothing is written once the
+        channel or the connection has closed, the buffered messages stay pending.
+        """
+
+        if self._flush_timer is not None:
+            self._connection.ioloop.remove_timeout(self._flush_timer)
+            self._flush_timer = None
+        if not self._buffer or not self._connection.is_open or not self._channel.is_open:
+            return
+        self._connection._output_marshaled_frames([bytes(self._buffer)])
+        self._buffer = bytearray()
+        self.messages += self.pending
+        self.pending = 0
+        self.flushes += 1
+
 class publish_engine:
     """
     Class to publish asynchronous messages to RabbitMQ server using pika.
@@ -16,18 +94,71 @@ class publish_engine:
     :param vhost: virtual host on RabbitMQ server
     :param routing_key: routing_key to direct messages to consumer
     :param number_of_messages: number of messages to publish
+    :param profile_seconds: number of seconds to profile for when profiling is started with SIGUSR1
+    :param profile_dir: directory the profile stats are written to
+    :param publish_chunk_size: number of messages published before returning to the ioloop, so that
+                               notifications from the server are processed while publishing
+    :param connection_options: extra pika.ConnectionParameters arguments, such as a tuning profile from
+                               connection_profiles/connection_profiles.py
+    :param coalesce_bytes: when set, publishes are gathered and written to the socket once per ioloop
+                           iteration, or once this many bytes are buffered, instead of once per frame.
+                           Only used with pika 1.x, see COALESCING_SUPPORTED
+    :param serializer: codec from serializers/serializers.py to encode messages with, its content type is set on
+                       every message, messages are published as text when not set. Messages are dictionaries,
+                       so the codec must have encodes_records set
+    :param nodes: list of (host, port) cluster nodes to connect to, defaults to [(host, port)]
+    :param node_policy: order nodes are tried in, 'round_robin', 'random' or 'least_connections'
+    :param failover_timeout: number of seconds used as heartbeat and connect timeout when more than one node
+                             is given, pika closes a connection to a lost node once no traffic has arrived for
+                             failover_timeout + 5 seconds, so failover takes between that and twice that
+    :param reconnect_jitter: maximum number of seconds to wait at random before reconnecting
+    :param reconnect_backoff_max: maximum number of seconds to wait before trying the nodes again once all of them failed
+    :param tracer: latency_tracer from latency/latency.py, when set every message carries the x-published-ns
+                   and x-trace-id headers, so consumers can measure publish to handle latency
+    :param blocked: blocked_monitor from flow_control/flow_control.py, pauses publishing while the server blocks the
+                    connection under memory or disk pressure, or closes the connection with the 'fail' policy.
+                    A connection blocked for longer than its timeout is closed by pika, and publishing goes on
+                    once reconnected
     """
 
-    def __init__(self, username, password, host, port, vhost, routing_key, number_of_messages):
+    # Connections open from this process to each node, for the least_connections policy
+    _node_connections = {}
+    _next_node = 0
+
+    def __init__(self, username, password, host, port, vhost, routing_key, number_of_messages,
+                 profile_seconds=30, profile_dir='.', publish_chunk_size=100, connection_options=None, coalesce_bytes=None, serializer=None, nodes=None,
+                 node_policy='round_robin', failover_timeout=10, reconnect_jitter=1.0, reconnect_backoff_max=30,
+                 tracer=None, blocked=None):
         self._username = username
         self._password = password
         self._host = host
         self._port = port
+        self._nodes = [tuple(node) for node in nodes] if nodes else [(host, port)]
+        self._node_policy = node_policy
+        self._failover_timeout = failover_timeout
+        self._reconnect_jitter = reconnect_jitter
+        self._reconnect_backoff_max = reconnect_backoff_max
+        self._node = None
+        self._opened = False
+        self._stopping = False
         self._vhost = vhost
+        self._connection_options = connection_options or {}
+        self._tracer = tracer
         self._routing_key = routing_key
         self._number_of_messages = number_of_messages
         self._channel = None
         self._connection = None
+        self._profile_seconds = profile_seconds
+        self._profile_dir = profile_dir
+        self._profiler = None
+        self._callback_times = {}
+        self._blocked = blocked
+        self._publish_chunk_size = publish_chunk_size
+        self._coalesce_bytes = coalesce_bytes
+        if serializer is not None and not getattr(serializer, 'encodes_records', False):
+            raise ValueError("Serializer %s cannot encode dictionaries" % serializer.content_type)
+        self._serializer = serializer
+        self._queue = None
 
     def on_open(self, connection):
         """
@@ -37,7 +168,9 @@ class publish_engine:
         :param connection: connection passed through from server callback
         """
 
-        print("Reached connection open \n")
+        print("Reached connection open to %s:%i \n" % self._node)
+        self._opened = True
+        publish_engine._node_connections[self._node] = publish_engine._node_connections.get(self._node, 0) + 1
         self._channel = self._connection.channel(on_open_callback=self.on_channel_open)
 
     def on_channel_open(self, channel):
@@ -56,56 +189,255 @@ class publish_engine:
 
     def on_declare(self, method_frame):
         """
-        Method to publish the messages to RabbitMQ server. The number of messages to publish
-        is contained in the private attribute number_of_messages. Publish using default
-        exchange type.
+        Method called when the queue has been declared. Starts publishing the messages.
 
         :param method_frame: method frame passed through from server callback
         """
 
-        while self._number_of_messages > 0:
+        if self._coalesce_bytes and COALESCING_SUPPORTED:
+            self._queue = coalescing_queue(self._connection, self._channel, self._coalesce_bytes)
+        elif self._coalesce_bytes:
+            print("Write coalescing needs pika 1.x, publishing frame by frame \n")
+        self.publish_messages()
+
+    def publish_messages(self):
+        """
+        Method to publish the messages to RabbitMQ server. The number of messages to publish
+        is contained in the private attribute number_of_messages. Publish using default
+        exchange type. Publishes publish_chunk_size messages at a time, and schedules the next
+        chunk on the ioloop, so publishing pauses as soon as the server blocks the connection.
+        """
+
+        started = time.perf_counter_ns() if self._profiler else None
+        publish = self._queue.publish if self._queue else self._channel.basic_publish
+        published = 0
+        while self._number_of_messages > 0 and published < self._publish_chunk_size and not self.is_blocked():
             print(self._number_of_messages)
+            body = 'H' + str(self._number_of_messages)
+            content_type = 'text/plain'
+            if self._serializer:
+                body = self._serializer.encode({'number': self._number_of_messages})
+                content_type = self._serializer.content_type
 
             # default exchange -> auto binding
             # delivery_mode=2 -> message is persistent
-            self._channel.basic_publish(exchange='',
-                                routing_key=self._routing_key,
-                                body='H' + str(self._number_of_messages),
-                                properties=pika.BasicProperties(content_type='text/plain',
-                                                        delivery_mode=2))
+            publish(exchange='',
+                    routing_key=self._routing_key,
+                    body=body,
+                    properties=pika.BasicProperties(content_type=content_type,
+                                                    delivery_mode=2,
+                                                    timestamp=int(time.time()),
+                                                    headers=self._tracer.trace_headers() if self._tracer else None))
 
             self._number_of_messages -= 1
+            published += 1
+        if self._number_of_messages > 0 and not self.is_blocked():
+            self._connection.ioloop.call_later(0, self.publish_messages)
+        elif self._number_of_messages <= 0 and self._queue:
+            self._queue.flush()
+            print("Published %i messages in %i writes \n" %(self._queue.messages, self._queue.flushes))
+        if started is not None:
+            self.record_callback_time('publish_messages', started)
+
+    def is_blocked(self):
+        """
+        Returns True while the server blocks the connection.
+        """
+
+        return self._blocked is not None and self._blocked.is_blocked()
+
+    def on_connection_blocked(self, connection, method_frame):
+        """
+        Called after the blocked monitor when the server blocks the connection because it is low on
+        memory or disk. Closes the connection with the 'fail' policy, publishing pauses otherwise.
+
+        :param connection: connection passed through from server callback
+        :param method_frame: method frame passed through from server callback, with the reason for the block
+        """
+
+        if self._blocked.policy == 'fail':
+            self._stopping = True
+            self._connection.close()
+
+    def on_connection_unblocked(self, connection, method_frame):
+        """
+        Called after the blocked monitor when the server unblocks the connection. Resumes publishing.
+
+        :param connection: connection passed through from server callback
+        :param method_frame: method frame passed through from server callback
+        """
+
+        if self._number_of_messages > 0:
+            self.publish_messages()
+
+    def on_profile_signal(self, signum, frame):
+        """
+        Signal handler that starts profiling. The profiler is started from the ioloop, not from
+        inside the signal handler.
+
+        :param signum: signal number
+        :param frame: stack frame the signal interrupted
+        """
+
+        self._connection.ioloop.add_callback_threadsafe(self.start_profiling)
+
+    def start_profiling(self, seconds=None):
+        """
+        Starts cProfile and the callback timers, and schedules them to stop after the number of
+        seconds. Does nothing if profiling has already started.
+
+        :param seconds: number of seconds to profile for, defaults to profile_seconds
+        """
+
+        if self._profiler is not None:
+            return
+        seconds = seconds or self._profile_seconds
+        print("Profiling for %s seconds \n" % seconds)
+        self._callback_times = {}
+        self._profiler = cProfile.Profile()
+        self._profiler.enable()
+        self._connection.ioloop.call_later(seconds, self.stop_profiling)
+
+    def stop_profiling(self):
+        """
+        Stops cProfile, writes the stats to a file in profile_dir, and prints the callback timers.
+        """
+
+        if self._profiler is None:
+            return
+        self._profiler.disable()
+        path = os.path.join(self._profile_dir, '%s-%i-%i.prof' %(self.__class__.__name__, os.getpid(), int(time.time())))
+        self._profiler.dump_stats(path)
+        self._profiler = None
+        print("Profile written to %s \n" % path)
+        for name, (calls, total_ns) in sorted(self._callback_times.items()):
+            print("%s calls: %i total: %.3fms mean: %.1fus" %(name, calls, total_ns / 1e6, total_ns / 1e3 / calls))
+
+    def record_callback_time(self, name, started):
+        """
+        Adds the time since started to the timer for the callback.
+
+        :param name: name of the callback
+        :param started: time.perf_counter_ns() when the callback started
+        """
+
+        calls, total_ns = self._callback_times.get(name, (0, 0))
+        self._callback_times[name] = (calls + 1, total_ns + time.perf_counter_ns() - started)
 
     def on_close(self, connection, reply_code):
         """
-        Method called when the connection to the RabbitMQ server is to be closed, and close connection
-        to RabbitMQ server.
+        Method called when the connection to the RabbitMQ server is closed. Stops the ioloop, so
+        run can reconnect and publish the remaining messages.
 
         :param connection: connection passed through from server callback
         :param reply_code: code passed through from server on callback containing shutdown code
         """
 
         print(reply_code)
-        self._connection.close()
+        if self._opened:
+            publish_engine._node_connections[self._node] -= 1
+        if self._queue and self._queue.pending:
+            # Buffered publishes never reached the socket, publish them again once reconnected
+            print("%i buffered messages were not published \n" % self._queue.pending)
+            self._number_of_messages += self._queue.pending
+        self._channel = None
+        self._queue = None
+        if self._blocked:
+            self._blocked.reset()
+        self._connection.ioloop.stop()
         print("Connection is closed \n")
-       
+
+    def on_open_error(self, connection, error):
+        """
+        Method called when the connection to a node could not be opened. Stops the ioloop so the
+        next node is tried.
+
+        :param connection: connection passed through from server callback
+        :param error: exception describing why the connection could not be opened
+        """
+
+        print("Connection to %s:%i could not be opened: %r \n" %(self._node[0], self._node[1], error))
+        self._connection.ioloop.stop()
+
+    def order_nodes(self):
+        """
+        Returns the nodes in the order they should be tried, by node_policy.
+        """
+
+        nodes = list(self._nodes)
+        if self._node_policy == 'random':
+            random.shuffle(nodes)
+        elif self._node_policy == 'least_connections':
+            random.shuffle(nodes)
+            nodes.sort(key=lambda node: publish_engine._node_connections.get(node, 0))
+        else:
+            start = publish_engine._next_node % len(nodes)
+            publish_engine._next_node += 1
+            nodes = nodes[start:] + nodes[:start]
+        return nodes
+
+    def connect(self, node):
+        """
+        Creates the asynchronous connection to a node, using the credentials used to instantiate this
+        publisher engine.
+
+        :param node: (host, port) of the node
+        """
+
+        self._node = node
+        self._opened = False
+        credentials = pika.PlainCredentials(self._username, self._password)
+        options = {'socket_timeout': 300}
+        if len(self._nodes) > 1:
+            options.update(heartbeat=self._failover_timeout, socket_timeout=self._failover_timeout)
+        options.update(self._connection_options)
+        options['connection_attempts'] = 1
+        if self._blocked:
+            options.update(self._blocked.connection_options())
+        parameters = pika.ConnectionParameters(node[0], node[1], self._vhost, credentials, **options)
+        self._connection = pika.SelectConnection(parameters, on_open_callback=self.on_open,
+                                                 on_open_error_callback=self.on_open_error)
+        self._connection.add_on_close_callback(self.on_close)
+        if self._blocked:
+            # The monitor records the block first, then the engine reacts to it
+            self._blocked.watch(self._connection)
+            self._connection.add_on_connection_blocked_callback(self.on_connection_blocked)
+            self._connection.add_on_connection_unblocked_callback(self.on_connection_unblocked)
+
     def run(self):
         """
-        Set up the asynchronous connection to RabbitMQ server using the credentials used to instantiate this
-        publisher engine. Pass in the on_open and on_close methods as callbacks to handle connection open 
-        and close.
+        Connects to the nodes in the order given by order_nodes, and publishes on the first one that
+        opens. When the connection is lost before every message has been published, reconnects after
+        a random wait of up to reconnect_jitter seconds. When no node could be connected to, waits a
+        random time of up to reconnect_jitter doubled for each failed round, capped at
+        reconnect_backoff_max seconds, before trying again.
         """
         
         logging.basicConfig(level=logging.ERROR, format=LOG_FORMAT)
-        credentials = pika.PlainCredentials(self._username, self._password)
-        parameters = pika.ConnectionParameters(self._host, self._port, self._vhost, credentials, socket_timeout=300)
-        self._connection = pika.SelectConnection(parameters, on_open_callback=self.on_open)
-        self._connection.add_on_close_callback(self.on_close)
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, self.on_profile_signal)
 
+        failed_rounds = 0
         try:
-            # Loop so we can communicate with RabbitMQ
-            self._connection.ioloop.start()
-            print("Connection is opened")
+            while not self._stopping and self._number_of_messages > 0:
+                for node in self.order_nodes():
+                    self.connect(node)
+                    # Loop so we can communicate with RabbitMQ
+                    self._connection.ioloop.start()
+                    if self._stopping or self._opened:
+                        break
+
+                if self._stopping or self._number_of_messages <= 0:
+                    break
+                if self._opened:
+                    failed_rounds = 0
+                    delay = random.uniform(0, self._reconnect_jitter)
+                    print("Connection lost, reconnecting in %.2f seconds \n" % delay)
+                else:
+                    failed_rounds += 1
+                    delay = random.uniform(0, min(self._reconnect_backoff_max, self._reconnect_jitter * 2 ** failed_rounds))
+                    print("No node could be connected to, retrying in %.2f seconds \n" % delay)
+                time.sleep(delay)
         except KeyboardInterrupt:
             # Close connection if user kills process
             print("Closing connection.")
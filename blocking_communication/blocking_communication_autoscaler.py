@@ -0,0 +1,258 @@
+import pika, time
+import math, os
+import multiprocessing, signal
+from blocking_communication_consumer import consume_engine
+
+def run_worker(processed, engine_options):
+    """
+    Runs a consume_engine in a worker process, counting the messages it processes in a shared counter
+    so the autoscaler can measure the drain rate. The worker runs in its own session, so CTRL+C in the
+    terminal only reaches the autoscaler, which then stops each worker with a single SIGTERM.
+
+    :param processed: multiprocessing.Value counting processed messages across all workers
+    :param engine_options: keyword arguments for consume_engine
+    """
+
+    if hasattr(os, 'setsid'):
+        os.setsid()
+    engine = consume_engine(**engine_options)
+    process_message = engine.process_message
+
+    def counted_process_message(channel, method, properties, body):
+        process_message(channel, method, properties, body)
+        with processed.get_lock():
+            processed.value += 1
+
+    engine.process_message = counted_process_message
+    engine.run()
+
+class autoscale_engine:
+    """
+    Class to scale a local pool of consume_engine worker processes to the depth of a queue. Polls the
+    queue with a passive declare for its message count and consumer count, and works out the arrival
+    and drain rates from the change in depth and the number of messages the workers processed. Scales
+    to the number of workers needed to keep up with arrivals and clear the backlog within
+    target_seconds, between min_workers and max_workers. Scaling up needs scale_up_polls polls in a
+    row asking for more workers, and scaling down, one worker at a time, scale_down_polls polls in a
+    row asking for fewer, so the pool does not flap. Workers are stopped with SIGTERM, so they drain
+    before exiting.
+
+    :param username: username to login to RabbitMQ server
+    :param password: password for user to login to RabbitMQ server
+    :param host: location of RabbitMQ server
+    :param port: port to connect to RabbitMQ server on host
+    :param vhost: virtual host on RabbitMQ server
+    :param queue_name: queue the workers consume from
+    :param min_workers: minimum number of workers
+    :param max_workers: maximum number of workers, defaults to the number of CPUs
+    :param poll_interval: number of seconds between polls of the queue
+    :param target_seconds: number of seconds a backlog should be cleared in
+    :param scale_up_polls: number of polls in a row that must ask for more workers before scaling up
+    :param scale_down_polls: number of polls in a row that must ask for fewer workers before scaling down
+    :param worker_options: extra consume_engine arguments for the workers, such as batch_size
+    :param connection_options: extra pika.ConnectionParameters arguments, such as a tuning profile from
+                               connection_profiles/connection_profiles.py
+    """
+
+    def __init__(self, username, password, host, port, vhost, queue_name, min_workers=1, max_workers=None,
+                 poll_interval=5, target_seconds=30, scale_up_polls=2, scale_down_polls=6, worker_options=None,
+                 connection_options=None):
+        self._username = username
+        self._password = password
+        self._host = host
+        self._port = port
+        self._vhost = vhost
+        self._connection_options = connection_options or {}
+        self._queue_name = queue_name
+        self._min_workers = min_workers
+        self._max_workers = max_workers or os.cpu_count()
+        self._poll_interval = poll_interval
+        self._target_seconds = target_seconds
+        self._scale_up_polls = scale_up_polls
+        self._scale_down_polls = scale_down_polls
+        self._worker_options = dict(worker_options or {}, username=username, password=password, host=host,
+                                    port=port, vhost=vhost, queue_name=queue_name, connection_options=connection_options)
+        self._processed = multiprocessing.Value('q', 0)
+        self._workers = []
+        self._stopping_workers = []
+        self._up_polls = 0
+        self._down_polls = 0
+        self._stopping = False
+        self._connection = None
+        self._channel = None
+
+    def make_connection(self):
+        """
+        Makes a connection to a RabbitMQ server using the credentials and server info
+        used to instantiate this class.
+        """
+
+        credentials = pika.PlainCredentials(self._username, self._password)
+        options = {'socket_timeout': 300}
+        options.update(self._connection_options)
+        parameters = pika.ConnectionParameters(self._host, self._port, self._vhost, credentials, **options)
+        self._connection = pika.BlockingConnection(parameters)
+        self._channel = self._connection.channel()
+        print("Connected Successfully...")
+
+    def poll_queue(self):
+        """
+        Returns the number of messages ready in the queue, and the number of consumers, without
+        declaring the queue if it does not exist.
+        """
+
+        method = self._channel.queue_declare(queue=self._queue_name, passive=True).method
+        return method.message_count, method.consumer_count
+
+    def desired_workers(self, depth, arrival_rate, drain_rate):
+        """
+        Returns the number of workers needed to keep up with arrivals and clear the backlog within
+        target_seconds, between min_workers and max_workers. Adds one worker at a time while the rate
+        of a single worker is not known yet, and asks for min_workers while the queue is empty and
+        nothing arrives, so an idle pool shrinks.
+
+        :param depth: number of messages ready in the queue
+        :param arrival_rate: messages arriving per second
+        :param drain_rate: messages processed per second by all workers
+        """
+
+        workers = len(self._workers)
+        if workers and drain_rate > 0:
+            needed_rate = arrival_rate + depth / self._target_seconds
+            desired = math.ceil(needed_rate / (drain_rate / workers))
+        elif depth:
+            desired = workers + 1
+        elif not arrival_rate:
+            desired = self._min_workers
+        else:
+            desired = workers
+        return max(self._min_workers, min(self._max_workers, desired))
+
+    def scale(self, desired):
+        """
+        Moves the pool towards the desired number of workers, once enough polls in a row have asked for it.
+
+        :param desired: number of workers wanted by the last poll
+        """
+
+        workers = len(self._workers)
+        self._up_polls = self._up_polls + 1 if desired > workers else 0
+        self._down_polls = self._down_polls + 1 if desired < workers else 0
+
+        if self._up_polls >= self._scale_up_polls:
+            print("Scaling up from %i to %i workers" %(workers, desired))
+            while len(self._workers) < desired:
+                self.start_worker()
+            self._up_polls = 0
+        elif self._down_polls >= self._scale_down_polls:
+            print("Scaling down from %i to %i workers" %(workers, workers - 1))
+            self.stop_worker()
+            self._down_polls = 0
+
+    def start_worker(self):
+        """
+        Starts a worker process.
+        """
+
+        worker = multiprocessing.Process(target=run_worker, args=(self._processed, self._worker_options), daemon=True)
+        worker.start()
+        self._workers.append(worker)
+
+    def stop_worker(self):
+        """
+        Sends SIGTERM to the newest worker, which drains and exits in its own time.
+        """
+
+        worker = self._workers.pop()
+        os.kill(worker.pid, signal.SIGTERM)
+        self._stopping_workers.append(worker)
+
+    def reap_workers(self):
+        """
+        Forgets workers that have exited, and replaces workers that exited without being stopped.
+        """
+
+        self._stopping_workers = [worker for worker in self._stopping_workers if worker.is_alive()]
+        for worker in [worker for worker in self._workers if not worker.is_alive()]:
+            print("Worker %i exited with %s, replacing it" %(worker.pid, worker.exitcode))
+            self._workers.remove(worker)
+            self.start_worker()
+
+    def monitor(self):
+        """
+        Polls the queue every poll_interval seconds, prints the depth, consumer count and rates, and
+        scales the workers.
+        """
+
+        last_depth, consumers = self.poll_queue()
+        last_processed = self._processed.value
+        last_poll = time.monotonic()
+        while not self._stopping:
+            self._connection.sleep(self._poll_interval)
+            if self._stopping:
+                break
+            self.reap_workers()
+            depth, consumers = self.poll_queue()
+            processed = self._processed.value
+            now = time.monotonic()
+            elapsed = now - last_poll
+
+            drain_rate = (processed - last_processed) / elapsed
+            arrival_rate = max(0.0, (depth - last_depth) / elapsed + drain_rate)
+            desired = self.desired_workers(depth, arrival_rate, drain_rate)
+            print("depth: %i consumers: %i workers: %i arrival: %.1f/s drain: %.1f/s desired: %i" %(
+                depth, consumers, len(self._workers), arrival_rate, drain_rate, desired))
+            self.scale(desired)
+            last_depth, last_processed, last_poll = depth, processed, now
+
+    def on_shutdown_signal(self, signum, frame):
+        """
+        Signal handler for SIGTERM. The workers run in their own sessions and do not get the signal,
+        so the autoscaler stops polling, and then stops every worker before exiting.
+
+        :param signum: signal number
+        :param frame: stack frame the signal interrupted
+        """
+
+        print("Shutdown received, stopping workers")
+        self._stopping = True
+
+    def stop(self):
+        """
+        Sends SIGTERM to every worker not already stopping, and waits for them all to drain and exit.
+        """
+
+        for worker in self._workers:
+            if worker.is_alive():
+                os.kill(worker.pid, signal.SIGTERM)
+        for worker in self._workers + self._stopping_workers:
+            worker.join()
+        print("All workers stopped")
+
+    def run(self):
+        """
+        Method to run autoscaler. Makes connection to RabbitMQ server, declares the queue, starts min_workers workers, and
+        scales them until interrupted or sent SIGTERM, then stops every worker.
+        """
+
+        signal.signal(signal.SIGTERM, self.on_shutdown_signal)
+        self.make_connection()
+        # Declared the same way the workers declare it, so it exists before the first poll
+        self._channel.queue_declare(queue=self._queue_name, durable=True)
+        for _ in range(self._min_workers):
+            self.start_worker()
+        print(' [*] Scaling workers for %s. To exit press CTRL+C' % self._queue_name)
+        try:
+            self.monitor()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+            if self._connection.is_open:
+                self._connection.close()
+
+
+if __name__ == '__main__':
+    engine = autoscale_engine(username='guest', password='guest', host='localhost', port=5672, vhost='/',
+                              queue_name='sample_test', min_workers=1, max_workers=8)
+    engine.run()
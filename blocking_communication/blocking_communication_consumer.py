@@ -1,5 +1,219 @@
 import pika
+import copy
+import signal
 import time
+import zlib
+
+class delivery_record:
+    """
+    Compact record of a delivered message, used when messages are buffered. Keeps only the
+    delivery tag, routing key and the properties handlers use, instead of the full message
+    details and properties objects. It has the attributes of both that the engine uses, so it
+    can be passed in place of either. The properties object is only kept when asked for, so a
+    failed message can be republished with all of its properties when retry delays are set.
+
+    :param method: message details
+    :param properties: message properties
+    :param body: message body, kept as the bytes object pika delivered, without copying
+    :param keep_properties: keep the properties object pika delivered, without copying, otherwise properties is None
+    """
+
+    __slots__ = ('delivery_tag', 'routing_key', 'redelivered', 'content_type', 'headers', 'timestamp', 'body',
+                 'properties')
+
+    def __init__(self, method, properties, body, keep_properties=False):
+        self.delivery_tag = method.delivery_tag
+        self.routing_key = method.routing_key
+        self.redelivered = method.redelivered
+        self.content_type = properties.content_type
+        self.headers = properties.headers
+        self.timestamp = properties.timestamp
+        self.body = body
+        self.properties = properties if keep_properties else None
+
+class chunked_transfer:
+    """
+    Large message body being reassembled from its chunks. The buffer is allocated at the full size
+    of the body when the first chunk arrives, and each chunk is written into it at its offset
+    through a memoryview, so chunks are never concatenated. The headers come from the publisher,
+    so the size, chunk count, offsets and indexes are checked before anything is allocated or
+    written, and ValueError is raised for headers that are missing or do not fit.
+
+    :param properties: properties of the first chunk received
+    :param max_size: maximum number of bytes a transfer may have
+    """
+
+    __slots__ = ('properties', 'buffer', 'view', 'received', 'chunk_count', 'checksum', 'started')
+
+    def __init__(self, properties, max_size):
+        headers = properties.headers
+        size = self.int_header(headers, 'x-transfer-size')
+        if not 0 <= size <= max_size:
+            raise ValueError("Transfer size %i is not between 0 and %i bytes" %(size, max_size))
+        chunk_count = self.int_header(headers, 'x-chunk-count')
+        if not 1 <= chunk_count <= max(size, 1):
+            raise ValueError("Chunk count %i does not fit a transfer of %i bytes" %(chunk_count, size))
+        self.properties = properties
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.received = set()
+        self.chunk_count = chunk_count
+        self.checksum = self.int_header(headers, 'x-checksum')
+        self.started = time.monotonic()
+
+    @staticmethod
+    def int_header(headers, name):
+        """
+        Returns an integer header, raising ValueError if it is missing or not an integer.
+
+        :param headers: message headers
+        :param name: name of the header
+        """
+
+        value = headers.get(name)
+        if not isinstance(value, int) or isinstance(value, bool):
+            raise ValueError("Header %s is missing or not an integer" % name)
+        return value
+
+    def add_chunk(self, headers, chunk):
+        """
+        Writes a chunk into the buffer at its offset.
+
+        :param headers: headers of the chunk
+        :param chunk: chunk body
+        :return: True once every chunk has been received
+        """
+
+        index = self.int_header(headers, 'x-chunk-index')
+        if not 0 <= index < self.chunk_count:
+            raise ValueError("Chunk index %i is not below the chunk count %i" %(index, self.chunk_count))
+        offset = self.int_header(headers, 'x-chunk-offset')
+        if not 0 <= offset <= len(self.buffer) - len(chunk):
+            raise ValueError("Chunk of %i bytes at offset %i does not fit a transfer of %i bytes" %(
+                len(chunk), offset, len(self.buffer)))
+        self.view[offset:offset + len(chunk)] = chunk
+        self.received.add(index)
+        return len(self.received) == self.chunk_count
+
+    def is_valid(self):
+        """
+        Returns True if the checksum of the reassembled body matches the checksum of the transfer.
+        """
+
+        return zlib.crc32(self.view) == self.checksum
+
+class transfer_reader:
+    """
+    File like reader over a reassembled body, passed to handlers in place of the body when
+    transfer_reader is set. Reads return memoryview slices of the body, without copying.
+
+    :param view: memoryview of the reassembled body
+    """
+
+    __slots__ = ('view', 'position')
+
+    def __init__(self, view):
+        self.view = view
+        self.position = 0
+
+    def __len__(self):
+        return len(self.view)
+
+    def read(self, size=-1):
+        """
+        Returns the next size bytes of the body, or the rest of the body when size is negative.
+
+        :param size: maximum number of bytes to read
+        """
+
+        end = len(self.view) if size is None or size < 0 else min(self.position + size, len(self.view))
+        data = self.view[self.position:end]
+        self.position = end
+        return data
+
+class stream_message:
+    """
+    Message yielded by consume_engine.stream, with the handles to acknowledge or reject it.
+
+    :param channel: channel the message was delivered on
+    :param method: message details
+    :param properties: message properties
+    :param body: message body, replaced by the result of the function in map_messages
+    """
+
+    __slots__ = ('channel', 'method', 'properties', 'body')
+
+    def __init__(self, channel, method, properties, body):
+        self.channel = channel
+        self.method = method
+        self.properties = properties
+        self.body = body
+
+    def ack(self, multiple=False):
+        """
+        Acknowledges the message.
+
+        :param multiple: also acknowledge every earlier message on the channel
+        """
+
+        self.channel.basic_ack(delivery_tag=self.method.delivery_tag, multiple=multiple)
+
+    def nack(self, requeue=True):
+        """
+        Rejects the message.
+
+        :param requeue: put the message back on the queue
+        """
+
+        self.channel.basic_nack(delivery_tag=self.method.delivery_tag, requeue=requeue)
+
+def map_messages(function, messages):
+    """
+    Lazily replaces the body of each message with function(body).
+
+    :param function: function to apply to each body
+    :param messages: iterable of stream_message, None marks an idle period and is passed through
+    """
+
+    for message in messages:
+        if message is not None:
+            message.body = function(message.body)
+        yield message
+
+def filter_messages(predicate, messages, requeue=False):
+    """
+    Lazily passes on the messages for which predicate(message) is true. Other messages are
+    rejected straight away, so they do not hold up the prefetch window.
+
+    :param predicate: function returning True for messages to keep
+    :param messages: iterable of stream_message, None marks an idle period and is passed through
+    :param requeue: put rejected messages back on the queue
+    """
+
+    for message in messages:
+        if message is None or predicate(message):
+            yield message
+        else:
+            message.nack(requeue=requeue)
+
+def batch_messages(messages, size):
+    """
+    Lazily groups messages into lists of up to size messages. A partial batch is passed on
+    when the stream is idle, or ends.
+
+    :param messages: iterable of stream_message, None marks an idle period
+    :param size: maximum number of messages per batch
+    """
+
+    batch = []
+    for message in messages:
+        if message is not None:
+            batch.append(message)
+        if batch and (message is None or len(batch) >= size):
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
 class consume_engine:
     """
@@ -11,15 +225,54 @@ class consume_engine:
     :param port: port to connect to RabbitMQ server on host
     :param vhost: virtual host on RabbitMQ server
     :param queue_name: queue name to consume messages from
+    :param retry_delays: list of delays in seconds, a message that fails is retried after each delay in
+                         turn, and then moved to the parking queue
+    :param batch_size: maximum number of messages passed to on_batch at once, messages are passed
+                       to on_message one at a time when not set
+    :param batch_wait: maximum number of milliseconds to wait for a batch to fill before passing it to on_batch
+    :param max_buffered_bytes: maximum number of body bytes buffered in a batch, once exceeded the consumer
+                               is cancelled until the batch has been passed on, and then started again
+    :param transfer_timeout: number of seconds to wait for the rest of a chunked transfer before dropping it
+    :param max_transfer_size: maximum number of bytes of a chunked transfer, larger transfers are dropped
+    :param transfer_reader: pass reassembled transfers to process_message as a transfer_reader instead of a body
+    :param connection_options: extra pika.ConnectionParameters arguments, such as a tuning profile from
+                               connection_profiles/connection_profiles.py
+    :param serializers: serializer registry from serializers/serializers.py, bodies are decoded by their
+                        content type before they are processed when set
+    :param tracer: latency_tracer from latency/latency.py, records broker dwell time and processing time per routing key
+    :param drain_timeout: number of seconds to wait for the messages being processed to finish on SIGTERM or SIGINT,
+                          before exiting without acknowledging them
     """
 
-    def __init__(self, username, password, host, port, vhost, queue_name):
+    def __init__(self, username, password, host, port, vhost, queue_name, retry_delays=None,
+                 batch_size=None, batch_wait=100, max_buffered_bytes=None, connection_options=None,
+                 transfer_timeout=60, transfer_reader=False, serializers=None, tracer=None,
+                 max_transfer_size=64 * 1024 * 1024, drain_timeout=30):
         self._username = username
         self._password = password
         self._host = host
         self._port = port
         self._vhost = vhost
+        self._connection_options = connection_options or {}
         self._queue_name = queue_name
+        self._retry_delays = retry_delays or []
+        self._parking_queue_name = queue_name + '.parking'
+        self._batch_size = batch_size
+        self._batch_wait = batch_wait
+        self._batch = []
+        self._batch_started = None
+        self._max_buffered_bytes = max_buffered_bytes
+        self._buffered_bytes = 0
+        self._paused = False
+        self._consumer_tag = None
+        self._transfer_timeout = transfer_timeout
+        self._transfer_reader = transfer_reader
+        self._max_transfer_size = max_transfer_size
+        self._transfers = {}
+        self._serializers = serializers
+        self._tracer = tracer
+        self._drain_timeout = drain_timeout
+        self._draining = False
         self._connection = None
         self._channel = None
 
@@ -29,7 +282,9 @@ class consume_engine:
         used to instantiate this class.
         """
         credentials = pika.PlainCredentials(self._username, self._password)
-        parameters = pika.ConnectionParameters(self._host, self._port, self._vhost, credentials, socket_timeout=300)
+        options = {'socket_timeout': 300}
+        options.update(self._connection_options)
+        parameters = pika.ConnectionParameters(self._host, self._port, self._vhost, credentials, **options)
         self._connection = pika.BlockingConnection(parameters)
         print("Connected Successfully...")
 
@@ -48,12 +303,86 @@ class consume_engine:
 
         self._channel.queue_declare(queue=self._queue_name, durable=True)
         print("Queue declared....")
+        if self._retry_delays:
+            self.declare_retry_queues()
         print(' [*] Waiting for messages. To exit press CTRL+C')
 
-    def on_message(self, channel, method, properties, body):
+    def retry_queue_name(self, delay):
+        """
+        Returns the name of the queue that holds messages waiting to be retried after the delay.
+
+        :param delay: delay in seconds
+        """
+
+        return '%s.retry.%ss' %(self._queue_name, delay)
+
+    def declare_retry_queues(self):
         """
-        Called when a message is received. Sends an acknowledgement that the 
-        message has been received.
+        Declares a delay queue for each retry delay, and the parking queue. Messages in a delay queue
+        expire after its delay, and are then dead lettered through the default exchange back to the
+        queue being consumed, so a failed message waits on the server instead of being redelivered
+        straight away.
+        """
+
+        for delay in self._retry_delays:
+            self._channel.queue_declare(queue=self.retry_queue_name(delay), durable=True,
+                                        arguments={'x-message-ttl': int(delay * 1000),
+                                                   'x-dead-letter-exchange': '',
+                                                   'x-dead-letter-routing-key': self._queue_name})
+        self._channel.queue_declare(queue=self._parking_queue_name, durable=True)
+        print("Retry queues declared....")
+
+    def retry_message(self, method, properties, body, error):
+        """
+        Publishes a failed message to the delay queue for its next retry, or to the parking queue
+        once every retry has been used. The message keeps its properties, such as priority,
+        correlation_id and message_id, and the number of retries and the last error are recorded
+        in its headers.
+
+        :param method: message details passed through from server on callback
+        :param properties: message properties passed through from server on callback
+        :param body: message body passed through from server on callback
+        :param error: exception raised when processing the message
+        """
+
+        headers = dict(properties.headers or {})
+        retry_count = headers.get('x-retry-count', 0)
+        headers['x-retry-count'] = retry_count + 1
+        headers['x-last-error'] = repr(error)
+        headers['x-original-routing-key'] = method.routing_key
+
+        if retry_count < len(self._retry_delays):
+            delay = self._retry_delays[retry_count]
+            routing_key = self.retry_queue_name(delay)
+            print(" [x] Failed %r, retry %i in %s seconds" %(body, retry_count + 1, delay))
+        else:
+            routing_key = self._parking_queue_name
+            print(" [x] Failed %r after %i retries, parking message" %(body, retry_count))
+
+        retry_properties = copy.copy(properties)
+        retry_properties.delivery_mode = 2
+        retry_properties.headers = headers
+        self._channel.basic_publish(exchange='',
+                                    routing_key=routing_key,
+                                    body=body,
+                                    properties=retry_properties)
+
+    def decode_body(self, properties, body):
+        """
+        Decodes a body by its content type with the serializers registry. The body is passed on as it
+        is when no registry is set, or no codec is registered for its content type.
+
+        :param properties: message properties passed through from server on callback
+        :param body: message body passed through from server on callback
+        """
+
+        if self._serializers is None:
+            return body
+        return self._serializers.decode(properties.content_type, body)
+
+    def process_message(self, channel, method, properties, body):
+        """
+        Does the work for a message. Raising an exception marks the message as failed.
 
         :param channel: channel passed through from server on callback
         :param method: message details passed through from server on callback
@@ -64,27 +393,315 @@ class consume_engine:
         print(" [x] working on %r" % body)
         time.sleep(3)
         print(" [x] Done")
+
+    def handle_message(self, channel, method, properties, body):
+        """
+        Passes a message to process_message, through the tracer when one is set.
+
+        :param channel: channel passed through from server on callback
+        :param method: message details passed through from server on callback
+        :param properties: message properties passed through from server on callback
+        :param body: message body, decoded
+        """
+
+        if self._tracer is None:
+            self.process_message(channel, method, properties, body)
+        else:
+            self._tracer.handle(self.process_message, channel, method, properties, body)
+
+    def on_message(self, channel, method, properties, body):
+        """
+        Called when a message is received. Processes the message, and sends an acknowledgement that the 
+        message has been received. When retry delays are set, a message that fails is published to a 
+        delay queue or the parking queue before it is acknowledged.
+
+        :param channel: channel passed through from server on callback
+        :param method: message details passed through from server on callback
+        :param properties: message properties passed through from server on callback
+        :param body: message body passed through from server on callback
+        """
+
+        if 'x-transfer-id' in (properties.headers or {}):
+            self.on_chunk(channel, method, properties, body)
+            self._channel.basic_ack(delivery_tag = method.delivery_tag)
+            return
+
+        try:
+            self.handle_message(channel, method, properties, self.decode_body(properties, body))
+        except Exception as error:
+            if not self._retry_delays:
+                raise
+            self.retry_message(method, properties, body, error)
         self._channel.basic_ack(delivery_tag = method.delivery_tag)
 
+    def on_chunk(self, channel, method, properties, body):
+        """
+        Called when a chunk of a large message is received. Writes the chunk into the buffer of its
+        transfer, and once every chunk has arrived and the checksum matches, passes the whole body
+        to process_message. Chunks are acknowledged as they arrive, so a transfer that does not
+        complete within transfer_timeout, has headers that are missing or do not fit, or whose
+        processing fails, is dropped rather than retried. Each new transfer schedules a check for
+        expired transfers once transfer_timeout has passed, so they are dropped even when no
+        further chunk arrives.
+
+        :param channel: channel passed through from server on callback
+        :param method: message details passed through from server on callback
+        :param properties: message properties passed through from server on callback
+        :param body: message body passed through from server on callback
+        """
+
+        self.expire_transfers()
+        headers = properties.headers
+        transfer_id = headers['x-transfer-id']
+        try:
+            transfer = self._transfers.get(transfer_id)
+            if transfer is None:
+                transfer = chunked_transfer(properties, self._max_transfer_size)
+                self._transfers[transfer_id] = transfer
+                self._connection.call_later(self._transfer_timeout, self.expire_transfers)
+            if not transfer.add_chunk(headers, body):
+                return
+        except ValueError as error:
+            self._transfers.pop(transfer_id, None)
+            print(" [x] Dropped transfer %s: %s" %(transfer_id, error))
+            return
+
+        del self._transfers[transfer_id]
+        if not transfer.is_valid():
+            print(" [x] Dropped transfer %s, checksum does not match" % transfer_id)
+            return
+
+        try:
+            if self._transfer_reader:
+                payload = transfer_reader(transfer.view)
+            else:
+                payload = self.decode_body(transfer.properties, transfer.buffer)
+            self.handle_message(channel, method, transfer.properties, payload)
+        except Exception as error:
+            print(" [x] Transfer %s failed: %r" %(transfer_id, error))
+
+    def expire_transfers(self):
+        """
+        Drops transfers that have been waiting for their chunks for longer than transfer_timeout.
+        """
+
+        now = time.monotonic()
+        for transfer_id, transfer in list(self._transfers.items()):
+            if now - transfer.started >= self._transfer_timeout:
+                del self._transfers[transfer_id]
+                print(" [x] Dropped transfer %s, received %i of %i chunks" %(transfer_id, len(transfer.received), transfer.chunk_count))
+
+    def on_batch(self, messages):
+        """
+        Called with a batch of messages. Processes each message in turn, override to handle
+        the whole batch in one call, for example a single write to a database.
+
+        :param messages: list of delivery_record
+        :return: list of the messages that failed, if any, as (delivery_record, error) tuples
+        """
+
+        failed = []
+        for message in messages:
+            try:
+                self.handle_message(self._channel, message, message, self.decode_body(message, message.body))
+            except Exception as error:
+                failed.append((message, error))
+        return failed
+
+    def on_batch_message(self, channel, method, properties, body):
+        """
+        Called when a message is received in batch mode. Adds the message to the current batch,
+        and pauses consumption once the batch holds more than max_buffered_bytes. Chunks of a
+        transfer are reassembled as in on_message, and the whole body is processed on its own,
+        outside the batch.
+
+        :param channel: channel passed through from server on callback
+        :param method: message details passed through from server on callback
+        :param properties: message properties passed through from server on callback
+        :param body: message body passed through from server on callback
+        """
+
+        if 'x-transfer-id' in (properties.headers or {}):
+            self.on_chunk(channel, method, properties, body)
+            self._channel.basic_ack(delivery_tag=method.delivery_tag)
+            return
+
+        if not self._batch:
+            self._batch_started = time.monotonic()
+        # Failed messages are only republished with their properties when retry delays are set
+        self._batch.append(delivery_record(method, properties, body, keep_properties=bool(self._retry_delays)))
+        self._buffered_bytes += len(body)
+        if self._max_buffered_bytes and self._buffered_bytes > self._max_buffered_bytes and not self._paused:
+            self.pause_consuming()
+
+    def pause_consuming(self):
+        """
+        Cancels the consumer, so the server stops delivering messages until the buffered messages
+        have been acknowledged. A new prefetch count would only apply to consumers started after
+        it, so it cannot throttle this one. Messages that arrive before the server has cancelled
+        the consumer are rejected by pika and requeued.
+        """
+
+        self._paused = True
+        self._channel.basic_cancel(self._consumer_tag)
+        print("Paused consuming, %i bytes buffered" % self._buffered_bytes)
+
+    def resume_consuming(self):
+        """
+        Starts a new consumer after consumption was paused.
+        """
+
+        self._paused = False
+        self._consumer_tag = self._channel.basic_consume(self._queue_name, self.on_batch_message)
+        print("Resumed consuming")
+
+    def flush_batch(self):
+        """
+        Passes the current batch to on_batch. Failed messages are retried when retry delays are
+        set, or rejected and requeued individually otherwise, and then the rest of the batch,
+        including retried messages, is acknowledged with a single multiple acknowledgement up to the
+        last message not rejected, which skips the messages already rejected.
+        """
+
+        messages = self._batch
+        self._batch = []
+        self._batch_started = None
+        self._buffered_bytes = 0
+        if not messages:
+            return
+
+        nacked = set()
+        for message, error in self.on_batch(messages) or []:
+            if self._retry_delays:
+                self.retry_message(message, message.properties, message.body, error)
+            else:
+                self._channel.basic_nack(delivery_tag=message.delivery_tag, requeue=True)
+                nacked.add(message.delivery_tag)
+        acked = [message.delivery_tag for message in messages if message.delivery_tag not in nacked]
+        if acked:
+            self._channel.basic_ack(delivery_tag=max(acked), multiple=True)
+        if self._paused and not self._draining:
+            self.resume_consuming()
+
+    def consume_batches(self):
+        """
+        Consumes messages in batches. A batch is passed to on_batch once it holds batch_size
+        messages, or batch_wait milliseconds after its first message arrived, whichever is first.
+        """
+
+        self._channel.basic_qos(prefetch_count=self._batch_size)
+        self._consumer_tag = self._channel.basic_consume(self._queue_name, self.on_batch_message)
+        while self._channel.is_open and not self._draining:
+            if not self._batch:
+                self._connection.process_data_events(time_limit=None)
+                continue
+
+            remaining = self._batch_started + self._batch_wait / 1000.0 - time.monotonic()
+            if len(self._batch) >= self._batch_size or remaining <= 0:
+                self.flush_batch()
+            else:
+                self._connection.process_data_events(time_limit=remaining)
+
+    def stream(self, prefetch_count=1, inactivity_timeout=None, stop_when_idle=False):
+        """
+        Generator that yields each message in the queue as a stream_message, which must be
+        acknowledged or rejected through its handles. At most prefetch_count messages are
+        unacknowledged at once, so a slow pipeline holds messages back on the server. Stages
+        are composed with map_messages, filter_messages and batch_messages. Messages still
+        waiting in the generator are requeued when it is closed. Chunked transfers are not
+        reassembled, each chunk is yielded as a message of its own.
+
+        :param prefetch_count: maximum number of unacknowledged messages
+        :param inactivity_timeout: number of seconds without a message before the stream is idle
+        :param stop_when_idle: end the stream when it is idle, otherwise None is yielded
+        """
+
+        self._channel.basic_qos(prefetch_count=prefetch_count)
+        try:
+            for method, properties, body in self._channel.consume(self._queue_name,
+                                                                  inactivity_timeout=inactivity_timeout):
+                if method is None:
+                    if stop_when_idle:
+                        return
+                    yield None
+                else:
+                    yield stream_message(self._channel, method, properties, body)
+        finally:
+            if self._channel.is_open:
+                self._channel.cancel()
+
     def consume_messages(self):
         """
         Consumes messages that are in the queue on the RabbitMQ server
         """
 
+        if self._batch_size:
+            self.consume_batches()
+            return
+
         self._channel.basic_qos(prefetch_count=1)
         self._channel.basic_consume(self._queue_name, self.on_message)
         self._channel.start_consuming()
 
+    def on_shutdown_signal(self, signum, frame):
+        """
+        Signal handler for SIGTERM and SIGINT. The first signal starts draining, the message being
+        handled is finished before consuming stops, and the process exits if draining takes longer
+        than drain_timeout. A second signal exits straight away.
+
+        :param signum: signal number
+        :param frame: stack frame the signal interrupted
+        """
+
+        if self._draining:
+            raise SystemExit("Exiting without draining")
+        print("Draining, send the signal again to exit straight away")
+        self._draining = True
+        if hasattr(signal, 'SIGALRM'):
+            signal.signal(signal.SIGALRM, self.on_drain_timeout)
+            signal.setitimer(signal.ITIMER_REAL, self._drain_timeout)
+        self._connection.add_callback_threadsafe(self._channel.stop_consuming)
+
+    def on_drain_timeout(self, signum, frame):
+        """
+        Signal handler for the drain timer. Exits without waiting any longer, unacknowledged
+        messages are redelivered by the server.
+
+        :param signum: signal number
+        :param frame: stack frame the signal interrupted
+        """
+
+        raise SystemExit("Draining took longer than %s seconds, exiting" % self._drain_timeout)
+
+    def drain(self):
+        """
+        Finishes shutting down after consuming has stopped. Passes on and acknowledges the current
+        batch, so no message that was already delivered is redelivered to another consumer, and
+        closes the connection.
+        """
+
+        if self._channel.is_open:
+            self._channel.stop_consuming()
+            self.flush_batch()
+        self._connection.close()
+        if hasattr(signal, 'SIGALRM'):
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        print("Drained and closed connection....")
+
     def run(self):
         """
         Method to run consumer. Makes connection to RabbitMQ server, creates channel,
-        sets up queue, consumes messages.
+        sets up queue, consumes messages. Drains on SIGTERM or SIGINT.
         """
 
         self.make_connection()
         self.channel()
         self.declare_queue()
+        signal.signal(signal.SIGTERM, self.on_shutdown_signal)
+        signal.signal(signal.SIGINT, self.on_shutdown_signal)
         self.consume_messages()
+        if self._draining:
+            self.drain()
 
 if __name__ == '__main__':
     engine = consume_engine(username='guest', password='guest', host='localhost', port=5672, vhost='/', queue_name='sample_test')
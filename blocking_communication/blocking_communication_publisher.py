@@ -1,5 +1,6 @@
-import pika, time
+import pika, time, uuid
 import sys
+import zlib
 
 class publish_engine:
     """
@@ -13,17 +14,36 @@ class publish_engine:
     :param queue_name: queue name to publish messages to
     :param number_of_messages: number of messages to publish
     :param message_interval: number of seconds to wait between publishing each message
+    :param connection_options: extra pika.ConnectionParameters arguments, such as a tuning profile from
+                               connection_profiles/connection_profiles.py
+    :param chunk_size: bodies larger than this number of bytes are published as a transfer of chunks of this size
+    :param serializer: codec from serializers/serializers.py to encode messages with, its content type is set on
+                       every message, messages are published as text when not set. Messages are dictionaries,
+                       so the codec must have encodes_records set
+    :param tracer: latency_tracer from latency/latency.py, when set every message carries the x-published-ns
+                   and x-trace-id headers, so consumers can measure publish to handle latency
+    :param blocked: blocked_monitor from flow_control/flow_control.py, pauses or stops publishing while the server
+                    blocks the connection under memory or disk pressure
     """
 
-    def __init__(self, username, password, host, port, vhost, queue_name, number_of_messages, message_interval):
+    def __init__(self, username, password, host, port, vhost, queue_name, number_of_messages, message_interval,
+                 connection_options=None,
+                 chunk_size=None, serializer=None, tracer=None, blocked=None):
         self._username = username
         self._password = password
         self._host = host
         self._port = port
         self._vhost = vhost
+        self._connection_options = connection_options or {}
+        self._tracer = tracer
         self._messages = number_of_messages
         self._message_interval = message_interval
         self._queue_name = queue_name
+        self._chunk_size = chunk_size
+        if serializer is not None and not getattr(serializer, 'encodes_records', False):
+            raise ValueError("Serializer %s cannot encode dictionaries" % serializer.content_type)
+        self._serializer = serializer
+        self._blocked = blocked
         self._connection = None
         self._channel = None
 
@@ -34,8 +54,14 @@ class publish_engine:
         """
 
         credentials = pika.PlainCredentials(self._username, self._password)
-        parameters = pika.ConnectionParameters(self._host, self._port, self._vhost, credentials, socket_timeout=300)
+        options = {'socket_timeout': 300}
+        options.update(self._connection_options)
+        if self._blocked:
+            options.update(self._blocked.connection_options())
+        parameters = pika.ConnectionParameters(self._host, self._port, self._vhost, credentials, **options)
         self._connection = pika.BlockingConnection(parameters)
+        if self._blocked:
+            self._blocked.watch(self._connection)
         print("Connected Successfully...")
 
     def channel(self):
@@ -54,6 +80,46 @@ class publish_engine:
         self._channel.queue_declare(queue=self._queue_name, durable=True)
         print("Queue declared....")
 
+    def publish_body(self, body, properties):
+        """
+        Publishes a message body to the queue. A body larger than chunk_size is published as a
+        transfer of chunks, each with the transfer id, its index and offset, the number of chunks,
+        the total size and a CRC32 checksum of the whole body in its headers. Chunks are slices
+        of a memoryview of the body, so the body is not copied.
+
+        :param body: message body
+        :param properties: message properties
+        """
+
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        if not self._chunk_size or len(body) <= self._chunk_size:
+            self._channel.basic_publish(exchange='', routing_key=self._queue_name, body=body, properties=properties)
+            return
+
+        view = memoryview(body)
+        transfer_id = uuid.uuid4().hex
+        checksum = zlib.crc32(view)
+        chunk_count = (len(body) + self._chunk_size - 1) // self._chunk_size
+        for index in range(chunk_count):
+            offset = index * self._chunk_size
+            headers = dict(properties.headers or {})
+            headers.update({'x-transfer-id': transfer_id,
+                            'x-chunk-index': index,
+                            'x-chunk-offset': offset,
+                            'x-chunk-count': chunk_count,
+                            'x-transfer-size': len(body),
+                            'x-checksum': checksum})
+            self._channel.basic_publish(exchange='',
+                                        routing_key=self._queue_name,
+                                        body=view[offset:offset + self._chunk_size],
+                                        properties=pika.BasicProperties(
+                                            content_type=properties.content_type,
+                                            delivery_mode=properties.delivery_mode,
+                                            timestamp=properties.timestamp,
+                                            headers=headers,
+                                        ))
+
     def publish_message(self):
         """
         Publishes messages to queue on RabbitMQ server.
@@ -61,14 +127,21 @@ class publish_engine:
 
         message_count = 0
         while message_count < self._messages:
+            if self._blocked:
+                self._blocked.wait_while_blocked(self._connection)
             message_count += 1
             message_body = "task number %i" %(message_count)
-            self._channel.basic_publish(exchange='',
-                                  routing_key=self._queue_name,
-                                  body=message_body,
-                                  properties=pika.BasicProperties(
-                                      delivery_mode=2  # make message persistant
-                                  ))
+            content_type = None
+            if self._serializer:
+                message_body = self._serializer.encode({'task_number': message_count})
+                content_type = self._serializer.content_type
+            self.publish_body(message_body,
+                              pika.BasicProperties(
+                                  content_type=content_type,
+                                  delivery_mode=2,  # make message persistant
+                                  timestamp=int(time.time()),
+                                  headers=self._tracer.trace_headers() if self._tracer else None,
+                              ))
             print("Published message %i" %(message_count))
             time.sleep(self._message_interval)
 
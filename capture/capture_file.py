@@ -0,0 +1,140 @@
+"""
+Capture file format shared by the recorder and the replayer. The file starts with a header:
+
+    8 bytes   magic, RMQCAP01
+    8 bytes   offset of the end of the last complete record, little endian
+
+followed by one record per delivery:
+
+    8 bytes   arrival time in nanoseconds since the epoch
+    2 bytes   length of the exchange name
+    2 bytes   length of the routing key
+    4 bytes   length of the encoded properties
+    4 bytes   length of the body
+              exchange name, routing key, properties in their AMQP wire encoding, body
+
+The end offset is only moved past a record once the whole record has been written, so a capture
+cut short by a crash still reads back up to its last complete record.
+"""
+
+import mmap
+import struct
+import pika
+
+MAGIC = b'RMQCAP01'
+HEADER = struct.Struct('<8sQ')
+RECORD = struct.Struct('<qHHII')
+
+class capture_writer:
+    """
+    Appends deliveries to a memory-mapped capture file. The file is preallocated, and doubled in size
+    whenever a record does not fit, then truncated to its contents when closed.
+
+    :param path: path of the capture file, an existing capture is replaced
+    :param capacity: number of bytes to preallocate
+    """
+
+    def __init__(self, path, capacity=64 * 1024 * 1024):
+        self._file = open(path, 'w+b')
+        self._capacity = max(capacity, HEADER.size)
+        self._file.truncate(self._capacity)
+        self._map = mmap.mmap(self._file.fileno(), self._capacity)
+        self._end = HEADER.size
+        self.records = 0
+        HEADER.pack_into(self._map, 0, MAGIC, self._end)
+
+    def grow(self, needed):
+        """
+        Doubles the size of the file until needed more bytes fit after the last record, and maps it again.
+
+        :param needed: number of bytes the next record takes
+        """
+
+        while self._end + needed > self._capacity:
+            self._capacity *= 2
+        self._map.close()
+        self._file.truncate(self._capacity)
+        self._map = mmap.mmap(self._file.fileno(), self._capacity)
+
+    def append(self, arrival_ns, exchange, routing_key, properties, body):
+        """
+        Appends a delivery to the capture.
+
+        :param arrival_ns: arrival time in nanoseconds since the epoch
+        :param exchange: exchange the message was published to
+        :param routing_key: routing key of the message
+        :param properties: pika.BasicProperties of the message
+        :param body: message body
+        """
+
+        exchange = exchange.encode('utf-8')
+        routing_key = routing_key.encode('utf-8')
+        encoded_properties = b''.join(properties.encode())
+        size = RECORD.size + len(exchange) + len(routing_key) + len(encoded_properties) + len(body)
+        if self._end + size > self._capacity:
+            self.grow(size)
+
+        offset = self._end
+        RECORD.pack_into(self._map, offset, arrival_ns, len(exchange), len(routing_key), len(encoded_properties), len(body))
+        offset += RECORD.size
+        for part in (exchange, routing_key, encoded_properties, body):
+            self._map[offset:offset + len(part)] = part
+            offset += len(part)
+        self._end = offset
+        HEADER.pack_into(self._map, 0, MAGIC, self._end)
+        self.records += 1
+
+    def close(self):
+        """
+        Writes the capture to disk, and truncates the file to its contents.
+        """
+
+        self._map.flush()
+        self._map.close()
+        self._file.truncate(self._end)
+        self._file.close()
+
+class capture_reader:
+    """
+    Reads the records of a capture file through a read-only memory map. Bodies are returned as
+    memoryview slices of the map, and are only valid until the reader is closed.
+
+    :param path: path of the capture file
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._end = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise ValueError("%s is not a capture file" % path)
+        self._view = memoryview(self._map)
+
+    def __iter__(self):
+        """
+        Yields (arrival_ns, exchange, routing_key, properties, body) for each record, in the order they were captured.
+        """
+
+        offset = HEADER.size
+        while offset < self._end:
+            arrival_ns, exchange_length, routing_key_length, properties_length, body_length = RECORD.unpack_from(self._map, offset)
+            offset += RECORD.size
+            exchange = str(self._view[offset:offset + exchange_length], 'utf-8')
+            offset += exchange_length
+            routing_key = str(self._view[offset:offset + routing_key_length], 'utf-8')
+            offset += routing_key_length
+            properties = pika.BasicProperties()
+            properties.decode(self._map[offset:offset + properties_length])
+            offset += properties_length
+            body = self._view[offset:offset + body_length]
+            offset += body_length
+            yield arrival_ns, exchange, routing_key, properties, body
+
+    def close(self):
+        """
+        Unmaps and closes the capture file. Bodies read from it must no longer be in use.
+        """
+
+        self._view.release()
+        self._map.close()
+        self._file.close()
@@ -0,0 +1,122 @@
+import pika, time
+import signal
+from capture_file import capture_writer
+
+class record_engine:
+    """
+    Class to record a message stream from RabbitMQ server to a capture file using pika. Attaches like
+    a consumer: either taps an exchange through its own exclusive queue, so the recorded traffic is
+    still delivered to the other consumers, or consumes a named queue. Every delivery is appended to
+    a memory-mapped capture file, with its exchange, routing key, properties, body and arrival time.
+
+    :param username: username to login to RabbitMQ server
+    :param password: password for user to login to RabbitMQ server
+    :param host: location of RabbitMQ server
+    :param port: port to connect to RabbitMQ server on host
+    :param vhost: virtual host on RabbitMQ server
+    :param path: path of the capture file to write
+    :param exchange: exchange to tap
+    :param binding_keys: binding keys of the tap queue, defaults to every message for topic exchanges
+    :param queue_name: queue to consume instead of tapping an exchange, messages are acknowledged once recorded
+    :param max_messages: stop once this many messages have been recorded
+    :param capacity: number of bytes to preallocate for the capture file
+    :param connection_options: extra pika.ConnectionParameters arguments, such as a tuning profile from
+                               connection_profiles/connection_profiles.py
+    """
+
+    def __init__(self, username, password, host, port, vhost, path, exchange=None, binding_keys=None,
+                 queue_name=None, max_messages=None, capacity=64 * 1024 * 1024, connection_options=None):
+        self._username = username
+        self._password = password
+        self._host = host
+        self._port = port
+        self._vhost = vhost
+        self._connection_options = connection_options or {}
+        self._path = path
+        self._exchange = exchange
+        self._binding_keys = binding_keys or ['#']
+        self._queue_name = queue_name
+        self._max_messages = max_messages
+        self._capacity = capacity
+        self._writer = None
+        self._connection = None
+        self._channel = None
+
+    def make_connection(self):
+        """
+        Makes a connection to a RabbitMQ server using the credentials and server info
+        used to instantiate this class.
+        """
+
+        credentials = pika.PlainCredentials(self._username, self._password)
+        options = {'socket_timeout': 300}
+        options.update(self._connection_options)
+        parameters = pika.ConnectionParameters(self._host, self._port, self._vhost, credentials, **options)
+        self._connection = pika.BlockingConnection(parameters)
+        self._channel = self._connection.channel()
+        print("Connected Successfully...")
+
+    def declare_queue(self):
+        """
+        Declares an exclusive queue bound to the exchange with each binding key, when tapping an exchange.
+        """
+
+        if self._queue_name:
+            return
+        result = self._channel.queue_declare(queue='', exclusive=True)
+        self._queue_name = result.method.queue
+        for binding_key in self._binding_keys:
+            self._channel.queue_bind(exchange=self._exchange, queue=self._queue_name, routing_key=binding_key)
+        print("Tapping exchange %s with %s" %(self._exchange, ', '.join(self._binding_keys)))
+
+    def on_message(self, channel, method, properties, body):
+        """
+        Called when a message is received. Appends it to the capture file, and acknowledges it.
+
+        :param channel: channel passed through from server on callback
+        :param method: message details passed through from server on callback
+        :param properties: message properties passed through from server on callback
+        :param body: message body passed through from server on callback
+        """
+
+        self._writer.append(time.time_ns(), method.exchange, method.routing_key, properties, body)
+        self._channel.basic_ack(delivery_tag=method.delivery_tag)
+        if self._max_messages and self._writer.records >= self._max_messages:
+            self._channel.stop_consuming()
+
+    def on_shutdown_signal(self, signum, frame):
+        """
+        Signal handler for SIGTERM and SIGINT. Stops recording after the message being recorded.
+
+        :param signum: signal number
+        :param frame: stack frame the signal interrupted
+        """
+
+        self._connection.add_callback_threadsafe(self._channel.stop_consuming)
+
+    def run(self):
+        """
+        Method to run recorder. Makes connection to RabbitMQ server, sets up the queue, and records
+        messages until max_messages have been recorded, or SIGTERM or SIGINT is received.
+        """
+
+        self.make_connection()
+        self.declare_queue()
+        self._writer = capture_writer(self._path, self._capacity)
+        signal.signal(signal.SIGTERM, self.on_shutdown_signal)
+        signal.signal(signal.SIGINT, self.on_shutdown_signal)
+        print(' [*] Recording to %s. To stop press CTRL+C' % self._path)
+        self._channel.basic_qos(prefetch_count=100)
+        self._channel.basic_consume(self._queue_name, self.on_message)
+        try:
+            self._channel.start_consuming()
+        finally:
+            self._writer.close()
+            print("Recorded %i messages to %s" %(self._writer.records, self._path))
+        self._connection.close()
+
+
+if __name__ == '__main__':
+    engine = record_engine(username='guest', password='guest', host='localhost', port=5672, vhost='/',
+                           path='scores.capture', exchange='topic_scores', binding_keys=['scores.#'])
+    engine.run()
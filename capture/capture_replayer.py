@@ -0,0 +1,115 @@
+import pika, time
+from capture_file import capture_reader
+
+class replay_engine:
+    """
+    Class to replay a capture file to RabbitMQ server using pika. Messages are published one at a
+    time in the order they were captured, so the order of messages per routing key is kept, and each
+    message is published when its arrival time, relative to the first message, comes round again.
+
+    :param username: username to login to RabbitMQ server
+    :param password: password for user to login to RabbitMQ server
+    :param host: location of RabbitMQ server
+    :param port: port to connect to RabbitMQ server on host
+    :param vhost: virtual host on RabbitMQ server
+    :param path: path of the capture file to replay
+    :param speed: replay speed, 1 replays with the captured timing, 2 twice as fast, and None as fast as possible
+    :param exchange: exchange to publish to, defaults to the exchange each message was captured from
+    :param connection_options: extra pika.ConnectionParameters arguments, such as a tuning profile from
+                               connection_profiles/connection_profiles.py
+    """
+
+    def __init__(self, username, password, host, port, vhost, path, speed=1, exchange=None, connection_options=None):
+        self._username = username
+        self._password = password
+        self._host = host
+        self._port = port
+        self._vhost = vhost
+        self._connection_options = connection_options or {}
+        self._path = path
+        self._speed = speed
+        self._exchange = exchange
+        self._connection = None
+        self._channel = None
+
+    def make_connection(self):
+        """
+        Makes a connection to a RabbitMQ server using the credentials and server info
+        used to instantiate this class.
+        """
+
+        credentials = pika.PlainCredentials(self._username, self._password)
+        options = {'socket_timeout': 300}
+        options.update(self._connection_options)
+        parameters = pika.ConnectionParameters(self._host, self._port, self._vhost, credentials, **options)
+        self._connection = pika.BlockingConnection(parameters)
+        self._channel = self._connection.channel()
+        print("Connected Successfully...")
+
+    def wait_until(self, deadline):
+        """
+        Waits until the deadline, processing heartbeats and other events from the server while waiting.
+
+        :param deadline: time.monotonic() to wait until
+        """
+
+        remaining = deadline - time.monotonic()
+        while remaining > 0:
+            self._connection.process_data_events(time_limit=remaining)
+            remaining = deadline - time.monotonic()
+
+    def replay(self):
+        """
+        Publishes every message in the capture file, and prints the number of messages, the time
+        taken, and how far behind the captured timing the replay fell at most.
+
+        :return: number of messages published
+        """
+
+        reader = capture_reader(self._path)
+        records = iter(reader)
+        body = None
+        published = 0
+        max_lag = 0.0
+        first_arrival_ns = None
+        started = time.monotonic()
+        try:
+            for arrival_ns, exchange, routing_key, properties, body in records:
+                if first_arrival_ns is None:
+                    first_arrival_ns = arrival_ns
+                if self._speed:
+                    deadline = started + (arrival_ns - first_arrival_ns) / 1e9 / self._speed
+                    self.wait_until(deadline)
+                    max_lag = max(max_lag, time.monotonic() - deadline)
+                self._channel.basic_publish(exchange=self._exchange if self._exchange is not None else exchange,
+                                            routing_key=routing_key,
+                                            body=body,
+                                            properties=properties)
+                published += 1
+        finally:
+            # Bodies are views of the mapped file, let go of them before it is unmapped
+            records.close()
+            body = None
+            reader.close()
+
+        elapsed = time.monotonic() - started
+        print("Replayed %i messages in %.3f seconds, %.0f messages per second, at most %.1fms behind" %(
+            published, elapsed, published / elapsed if elapsed else 0, max_lag * 1000))
+        return published
+
+    def run(self):
+        """
+        Method to run replayer. Makes connection to RabbitMQ server, replays the capture file, and closes the connection.
+        """
+
+        self.make_connection()
+        try:
+            self.replay()
+        finally:
+            self._connection.close()
+
+
+if __name__ == '__main__':
+    engine = replay_engine(username='guest', password='guest', host='localhost', port=5672, vhost='/',
+                           path='scores.capture', speed=1)
+    engine.run()
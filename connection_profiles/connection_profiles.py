@@ -0,0 +1,34 @@
+"""
+Named connection tuning profiles. Each profile is a dictionary of pika.ConnectionParameters
+arguments, passed to any engine as connection_options, for example:
+
+    consume_engine(..., connection_options=TUNING_PROFILES['low_latency'])
+
+pika always sets TCP_NODELAY on its sockets, and does not expose the socket send and receive
+buffer sizes, so those are left to the operating system.
+"""
+
+TUNING_PROFILES = {
+    # pika and RabbitMQ defaults, with the socket timeout the engines have always used
+    'default': {
+        'socket_timeout': 300,
+    },
+    # Small, chatty messages: small frames so a large message does not hold up the connection,
+    # and a dead peer or a blocked connection is detected quickly
+    'low_latency': {
+        'frame_max': 16384,
+        'heartbeat': 10,
+        'socket_timeout': 5,
+        'blocked_connection_timeout': 10,
+        'tcp_options': {'TCP_KEEPIDLE': 10, 'TCP_KEEPINTVL': 5, 'TCP_KEEPCNT': 3, 'TCP_USER_TIMEOUT': 15000},
+    },
+    # Large payloads and high volume: the largest frames pika accepts (its FRAME_MAX_SIZE, AMQP 0.9.1 itself allows
+    # up to 2^32-1 bytes), and patience with a busy broker
+    'bulk_throughput': {
+        'frame_max': 131072,
+        'heartbeat': 120,
+        'socket_timeout': 300,
+        'blocked_connection_timeout': 300,
+        'tcp_options': {'TCP_KEEPIDLE': 60, 'TCP_KEEPINTVL': 10, 'TCP_KEEPCNT': 6},
+    },
+}
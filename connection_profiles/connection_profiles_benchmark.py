@@ -0,0 +1,84 @@
+import pika
+import time
+from connection_profiles import TUNING_PROFILES
+
+class benchmark_engine:
+    """
+    Class to compare connection tuning profiles. For each profile and payload size, publishes
+    messages to a temporary queue on the RabbitMQ server, consumes them back, and prints the
+    publish and round trip throughput.
+
+    :param username: username to login to RabbitMQ server
+    :param password: password for user to login to RabbitMQ server
+    :param host: location of RabbitMQ server
+    :param port: port to connect to RabbitMQ server on host
+    :param vhost: virtual host on RabbitMQ server
+    :param payload_sizes: dictionary of payload size in bytes to number of messages to send at that size
+    :param profiles: names of the profiles in TUNING_PROFILES to compare, defaults to all of them
+    """
+
+    def __init__(self, username, password, host, port, vhost, payload_sizes, profiles=None):
+        self._username = username
+        self._password = password
+        self._host = host
+        self._port = port
+        self._vhost = vhost
+        self._payload_sizes = payload_sizes
+        self._profiles = profiles or sorted(TUNING_PROFILES)
+
+    def make_connection(self, profile):
+        """
+        Makes a connection to a RabbitMQ server using the connection options of the profile.
+
+        :param profile: name of the profile in TUNING_PROFILES
+        """
+
+        credentials = pika.PlainCredentials(self._username, self._password)
+        parameters = pika.ConnectionParameters(self._host, self._port, self._vhost, credentials, **TUNING_PROFILES[profile])
+        return pika.BlockingConnection(parameters)
+
+    def measure(self, profile, payload_size, number_of_messages):
+        """
+        Publishes number_of_messages messages of payload_size bytes, and consumes them back.
+
+        :param profile: name of the profile in TUNING_PROFILES
+        :param payload_size: size of each message body in bytes
+        :param number_of_messages: number of messages to send
+        :return: publish and round trip throughput in messages per second
+        """
+
+        connection = self.make_connection(profile)
+        channel = connection.channel()
+        queue_name = channel.queue_declare('', exclusive=True).method.queue
+        body = b'x' * payload_size
+
+        started = time.perf_counter()
+        for _ in range(number_of_messages):
+            channel.basic_publish(exchange='', routing_key=queue_name, body=body)
+        published = time.perf_counter()
+
+        received = 0
+        for method, properties, message in channel.consume(queue_name, auto_ack=True):
+            received += 1
+            if received == number_of_messages:
+                break
+        finished = time.perf_counter()
+        channel.cancel()
+        connection.close()
+
+        return number_of_messages / (published - started), number_of_messages / (finished - started)
+
+    def run(self):
+        """
+        Method to run the benchmark. Measures every profile at every payload size and prints the results.
+        """
+
+        print("%-16s %12s %10s %16s %16s" %('profile', 'payload', 'messages', 'publish msg/s', 'round trip msg/s'))
+        for payload_size, number_of_messages in sorted(self._payload_sizes.items()):
+            for profile in self._profiles:
+                publish_rate, round_trip_rate = self.measure(profile, payload_size, number_of_messages)
+                print("%-16s %12i %10i %16.0f %16.0f" %(profile, payload_size, number_of_messages, publish_rate, round_trip_rate))
+
+if __name__ == '__main__':
+    engine = benchmark_engine(username='guest', password='guest', host='localhost', port=5672, vhost='/', payload_sizes={64: 20000, 1048576: 200})
+    engine.run()
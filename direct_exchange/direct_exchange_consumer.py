@@ -1,4 +1,5 @@
 import pika
+import signal
 import time
 
 class consume_engine:
@@ -11,22 +12,55 @@ class consume_engine:
     :param port: port to connect to RabbitMQ server on host
     :param vhost: virtual host on RabbitMQ server
     :param exchange_name: exchange name to consume messages from 
-    :param routing_key: routing key 
+    :param routing_key: routing key, or a dictionary of routing key to handler, a function of (channel, method,
+                        properties, body), to consume several routing keys from one queue
     :param message_interval: number of seconds to wait between publishing each message
+    :param conflate: only handle the newest message per key when the consumer falls behind
+    :param conflation_key: function of (method, properties, body) returning the key to conflate
+                           messages on, defaults to the routing key of the message
+    :param conflation_window: maximum number of unacknowledged messages to drain per conflation pass
+    :param max_priority: declare the queue with x-max-priority, so higher priority messages are delivered first
+    :param connection_options: extra pika.ConnectionParameters arguments, such as a tuning profile from
+                               connection_profiles/connection_profiles.py
+    :param group: consumer_group from management/management.py, when set the consumer uses the durable queue of the
+                  group, that keeps its messages while the consumer is down and is shared by the consumers
+                  of the group, and acknowledges each message once it has been handled
+    :param tracer: latency_tracer from latency/latency.py, records broker dwell time and handler time per routing key
+    :param drain_timeout: number of seconds to wait for the messages being handled to finish on SIGTERM or SIGINT,
+                          before exiting without acknowledging them
     """
 
-    def __init__(self, username, password, host, port, vhost, exchange, routing_key):
+    def __init__(self, username, password, host, port, vhost, exchange, routing_key,
+                 conflate=False, conflation_key=None, conflation_window=100, max_priority=None,
+                 connection_options=None, group=None, tracer=None, drain_timeout=30):
         self._username = username
         self._password = password
         self._host = host
         self._port = port
         self._vhost = vhost
-        self._routing_key = routing_key
+        self._connection_options = connection_options or {}
         self._exchange_name = exchange
-        self._routing_key = routing_key
+        if isinstance(routing_key, dict):
+            self._handlers = dict(routing_key)
+            self._routing_keys = list(routing_key)
+        else:
+            self._handlers = {}
+            self._routing_keys = [routing_key]
+        if not self._routing_keys:
+            raise ValueError("At least one routing key is needed")
         self._queue_name = None
         self._connection = None
         self._channel = None
+        self._conflate = conflate
+        self._conflation_key = conflation_key
+        self._conflation_window = conflation_window
+        self._latest_messages = {}
+        self._last_delivery_tag = None
+        self._max_priority = max_priority
+        self._group = group
+        self._tracer = tracer
+        self._drain_timeout = drain_timeout
+        self._draining = False
         
     def make_connection(self):
         """
@@ -35,7 +69,9 @@ class consume_engine:
         """
 
         credentials = pika.PlainCredentials(self._username, self._password)
-        parameters = pika.ConnectionParameters(self._host, self._port, self._vhost, credentials, socket_timeout=300)
+        options = {'socket_timeout': 300}
+        options.update(self._connection_options)
+        parameters = pika.ConnectionParameters(self._host, self._port, self._vhost, credentials, **options)
         self._connection = pika.BlockingConnection(parameters)
         print("Connected successfully...")
 
@@ -56,25 +92,108 @@ class consume_engine:
                                         exchange_type='direct')
         print("Exchange declared....")
 
+    def queue_arguments(self):
+        """
+        Returns the arguments to declare the queue with, x-max-priority when max_priority is set, and
+        x-expires for a group queue when the group sets queue_expires.
+        """
+
+        arguments = {}
+        if self._max_priority:
+            arguments['x-max-priority'] = self._max_priority
+        if self._group:
+            arguments.update(self._group.queue_arguments())
+        return arguments or None
+
+    def reconcile_bindings(self, queue_name, binding_keys):
+        """
+        Makes the bindings between the exchange and a group queue match the binding keys. When the
+        group has a management client, only the missing bindings are added, and then the bindings
+        that are no longer asked for are removed, unless another consumer of the group is using the
+        queue. Without one every key is bound, which is idempotent.
+
+        :param queue_name: group queue
+        :param binding_keys: binding keys the queue should have
+        """
+
+        to_bind, to_unbind = self._group.plan_bindings(self._exchange_name, queue_name, binding_keys)
+        if to_bind:
+            self.bind_keys(queue_name, to_bind)
+        for routing_key, arguments in to_unbind:
+            self._channel.queue_unbind(queue=queue_name, exchange=self._exchange_name,
+                                       routing_key=routing_key, arguments=arguments)
+            print("Removed binding %s from queue: %s" %(routing_key, queue_name))
+
     def declare_queue(self):
         """
-        Get the name of the queue, which is automatically created by the RabbitMQ server
+        Get the name of the queue, which is automatically created by the RabbitMQ server, or
+        declare the durable group queue when a group is set
         """
 
-        result = self._channel.queue_declare('', exclusive=True)
+        if self._group:
+            self._queue_name = self._group.queue_name(self._exchange_name)
+            result = self._channel.queue_declare(self._queue_name, durable=True, arguments=self.queue_arguments())
+            print("Resuming group queue: %s with %i messages waiting" %(self._queue_name, result.method.message_count))
+            print(' [*] Waiting for messages. To exit press CTRL+C')
+            return
+
+        result = self._channel.queue_declare('', exclusive=True, arguments=self.queue_arguments())
         self._queue_name = result.method.queue
         print("Queue declared....")
         print(' [*] Waiting for messages. To exit press CTRL+C')
 
+    def bind_keys(self, queue_name, routing_keys):
+        """
+        Binds a queue to the exchange with each routing key. The binds are pipelined: all but the last
+        are sent without waiting for a reply, and the last one waits for its reply. The server handles
+        the methods on a channel in order, so that reply means every bind before it succeeded too, and
+        a bind that fails closes the channel, which raises on the last bind.
+
+        BlockingChannel.queue_bind always waits for its reply, so the pipelined binds are sent on the
+        asynchronous channel underneath it, BlockingChannel._impl, which is private to pika, so the
+        Pipfile pins pika to the 1.1 series. Without it every key is bound with a blocking queue_bind.
+
+        :param queue_name: queue to bind
+        :param routing_keys: routing keys to bind with, at least one
+        """
+
+        *pipelined, last = routing_keys
+        impl = getattr(self._channel, '_impl', None)
+        for routing_key in pipelined:
+            if impl is None:
+                self._channel.queue_bind(exchange=self._exchange_name, routing_key=routing_key, queue=queue_name)
+            else:
+                # Without a reply callback the asynchronous channel sends a nowait bind
+                impl.queue_bind(queue_name, self._exchange_name, routing_key)
+        self._channel.queue_bind(exchange=self._exchange_name, routing_key=last, queue=queue_name)
+
     def make_binding(self):
         """
-        Bind the queue to the exchange with routing key
+        Bind the queue to the exchange with each routing key
         """
 
-        self._channel.queue_bind(exchange=self._exchange_name,
-                                 routing_key=self._routing_key,
-                                 queue=self._queue_name)
-        print("Made binding between exchange: %s and queue: %s" %(self._exchange_name, self._queue_name))
+        if self._group:
+            self.reconcile_bindings(self._queue_name, self._routing_keys)
+        else:
+            self.bind_keys(self._queue_name, self._routing_keys)
+        print("Made binding between exchange: %s and queue: %s with %s" %(self._exchange_name, self._queue_name, ', '.join(self._routing_keys)))
+
+    def dispatch(self, channel, method, properties, body):
+        """
+        Passes a message to the handler for its routing key, or to on_message when there is none,
+        through the tracer when one is set.
+
+        :param channel: channel passed through from server on callback
+        :param method: message details passed through from server on callback
+        :param properties: message properties passed through from server on callback
+        :param body: message body passed through from server on callback
+        """
+
+        handler = self._handlers.get(method.routing_key, self.on_message)
+        if self._tracer is None:
+            handler(channel, method, properties, body)
+        else:
+            self._tracer.handle(handler, channel, method, properties, body)
 
     def on_message(self, channel, method, properties, body):
         """
@@ -89,19 +208,141 @@ class consume_engine:
         print(" [x] Feed Received - %s \n" % str(body))
         time.sleep(2)
 
+    def on_conflated_message(self, channel, method, properties, body):
+        """
+        Called when a message is received in conflation mode. Keeps only the newest message
+        for each conflation key, the older message for that key is superseded and will be
+        acknowledged when the pending messages are flushed.
+
+        :param channel: channel passed through from server on callback
+        :param method: message details passed through from server on callback
+        :param properties: message properties passed through from server on callback
+        :param body: message body passed through from server on callback
+        """
+
+        if self._conflation_key:
+            key = self._conflation_key(method, properties, body)
+        else:
+            key = method.routing_key
+        self._latest_messages[key] = (method, properties, body)
+        self._last_delivery_tag = method.delivery_tag
+
+    def flush_conflated(self):
+        """
+        Hands the newest message for each key to its handler, then acknowledges every drained
+        message, including the superseded ones, with a single multiple acknowledgement.
+        """
+
+        if self._last_delivery_tag is None:
+            return
+
+        latest_messages = self._latest_messages
+        last_delivery_tag = self._last_delivery_tag
+        self._latest_messages = {}
+        self._last_delivery_tag = None
+
+        for method, properties, body in latest_messages.values():
+            self.dispatch(self._channel, method, properties, body)
+        self._channel.basic_ack(delivery_tag=last_delivery_tag, multiple=True)
+
+    def consume_conflated(self):
+        """
+        Consumes messages in conflation mode. Waits for at least one message, drains everything
+        else already delivered up to the conflation window, and then flushes the newest message
+        per key, so catching up after a stall takes one pass instead of one pass per message.
+        """
+
+        self._channel.basic_qos(prefetch_count=self._conflation_window)
+        self._channel.basic_consume(self._queue_name, self.on_conflated_message)
+        while self._channel.is_open and not self._draining:
+            self._connection.process_data_events(time_limit=None)
+            self._connection.process_data_events(time_limit=0)
+            self.flush_conflated()
+
+    def on_acked_message(self, channel, method, properties, body):
+        """
+        Called when a message is received on a queue consumed with manual acknowledgements.
+        Handles the message, and then acknowledges it so the next message can be delivered.
+
+        :param channel: channel passed through from server on callback
+        :param method: message details passed through from server on callback
+        :param properties: message properties passed through from server on callback
+        :param body: message body passed through from server on callback
+        """
+
+        self.dispatch(channel, method, properties, body)
+        channel.basic_ack(delivery_tag=method.delivery_tag)
+
     def consume_messages(self):
         """
         Consumes all messages that are sent to the specific Direct Exchange on the RabbitMQ server
         """
 
-        self._channel.basic_consume(self._queue_name, self.on_message,
+        if self._conflate:
+            self.consume_conflated()
+            return
+
+        if self._max_priority or self._group:
+            # Priorities only reorder messages waiting in the queue, so keep one in flight, and
+            # acknowledge group queue messages once handled so none are lost on a restart
+            self._channel.basic_qos(prefetch_count=1)
+            self._channel.basic_consume(self._queue_name, self.on_acked_message)
+            self._channel.start_consuming()
+            return
+
+        self._channel.basic_consume(self._queue_name, self.dispatch,
                                     auto_ack=True)
         self._channel.start_consuming()
 
+    def on_shutdown_signal(self, signum, frame):
+        """
+        Signal handler for SIGTERM and SIGINT. The first signal starts draining, the message being
+        handled is finished before consuming stops, and the process exits if draining takes longer
+        than drain_timeout. A second signal exits straight away.
+
+        :param signum: signal number
+        :param frame: stack frame the signal interrupted
+        """
+
+        if self._draining:
+            raise SystemExit("Exiting without draining")
+        print("Draining, send the signal again to exit straight away")
+        self._draining = True
+        if hasattr(signal, 'SIGALRM'):
+            signal.signal(signal.SIGALRM, self.on_drain_timeout)
+            signal.setitimer(signal.ITIMER_REAL, self._drain_timeout)
+        self._connection.add_callback_threadsafe(self._channel.stop_consuming)
+
+    def on_drain_timeout(self, signum, frame):
+        """
+        Signal handler for the drain timer. Exits without waiting any longer, unacknowledged
+        messages are redelivered by the server.
+
+        :param signum: signal number
+        :param frame: stack frame the signal interrupted
+        """
+
+        raise SystemExit("Draining took longer than %s seconds, exiting" % self._drain_timeout)
+
+    def drain(self):
+        """
+        Finishes shutting down after consuming has stopped. Hands on and acknowledges the messages
+        held for conflation, and closes the connection.
+        """
+
+        if self._channel.is_open:
+            self._channel.stop_consuming()
+            self.flush_conflated()
+        self._connection.close()
+        if hasattr(signal, 'SIGALRM'):
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        print("Drained and closed connection....")
+
     def run(self):
         """
         Method to run consumer. Makes connection to RabbitMQ server, creates channel,
         binds queue and exchange with routing key, consumes messages from queue.
+        Drains on SIGTERM or SIGINT.
         """
 
         self.make_connection()
@@ -109,7 +350,11 @@ class consume_engine:
         self.declare_exchange()
         self.declare_queue()
         self.make_binding()
+        signal.signal(signal.SIGTERM, self.on_shutdown_signal)
+        signal.signal(signal.SIGINT, self.on_shutdown_signal)
         self.consume_messages()
+        if self._draining:
+            self.drain()
 
 if __name__ == '__main__':
     # routing keys: scores.curling, scores.hockey, scores.football
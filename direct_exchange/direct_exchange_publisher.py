@@ -18,20 +18,32 @@ class publish_engine:
     :param routing_key_curling: routing key
     :param routing_key_hockey: routing key
     :param routing_key_football: routing key
+    :param priorities: dictionary of routing key to message priority, for queues declared with x-max-priority
+    :param connection_options: extra pika.ConnectionParameters arguments, such as a tuning profile from
+                               connection_profiles/connection_profiles.py
+    :param tracer: latency_tracer from latency/latency.py, when set every message carries the x-published-ns
+                   and x-trace-id headers, so consumers can measure publish to handle latency
+    :param blocked: blocked_monitor from flow_control/flow_control.py, pauses or stops publishing while the server
+                    blocks the connection under memory or disk pressure
     """
 
-    def __init__(self, username, password, host, port, vhost, exchange, number_of_messages, message_interval, routing_key_curling, routing_key_hockey, routing_key_football):
+    def __init__(self, username, password, host, port, vhost, exchange, number_of_messages, message_interval, routing_key_curling, routing_key_hockey, routing_key_football, priorities=None,
+                 connection_options=None, tracer=None, blocked=None):
         self._username = username
         self._password = password
         self._host = host
         self._port = port
         self._vhost = vhost
+        self._connection_options = connection_options or {}
+        self._tracer = tracer
         self._messages = number_of_messages
         self._message_interval = message_interval
         self._exchange_name = exchange
         self._routing_key_curling = routing_key_curling
         self._routing_key_hockey = routing_key_hockey
         self._routing_key_football = routing_key_football
+        self._priorities = priorities or {}
+        self._blocked = blocked
         self._connection = None
         self._channel = None
 
@@ -42,8 +54,14 @@ class publish_engine:
         """
 
         credentials = pika.PlainCredentials(self._username, self._password)
-        parameters = pika.ConnectionParameters(self._host, self._port, self._vhost, credentials, socket_timeout=300)
+        options = {'socket_timeout': 300}
+        options.update(self._connection_options)
+        if self._blocked:
+            options.update(self._blocked.connection_options())
+        parameters = pika.ConnectionParameters(self._host, self._port, self._vhost, credentials, **options)
         self._connection = pika.BlockingConnection(parameters)
+        if self._blocked:
+            self._blocked.watch(self._connection)
         print("Connected successfully...")
 
     def open_channel(self):
@@ -73,6 +91,8 @@ class publish_engine:
         football_score = 0
         hockey_score = 0
         while message_count < self._messages:
+            if self._blocked:
+                self._blocked.wait_while_blocked(self._connection)
             message_count += 1
             score += randint(0, 9)
             football_score += randint(0, 1)
@@ -84,6 +104,9 @@ class publish_engine:
                                   body=message_body,
                                   properties=pika.BasicProperties(
                                       delivery_mode=2,
+                                      priority=self._priorities.get(self._routing_key_curling),
+                                      timestamp=int(time.time()),
+                                      headers=self._tracer.trace_headers() if self._tracer else None,
                                   ))
 
             message_body = "Football Score | New York Vs New England | New York : %i | New England : 0" %(football_score)
@@ -92,6 +115,9 @@ class publish_engine:
                                         body=message_body,
                                         properties=pika.BasicProperties(
                                             delivery_mode=2, 
+                                            priority=self._priorities.get(self._routing_key_football),
+                                            timestamp=int(time.time()),
+                                            headers=self._tracer.trace_headers() if self._tracer else None,
                                         ))
 
             message_body = "Hockey Score | Canada Vs Russia | Canada : %i | Russia : 0" % (hockey_score)
@@ -100,6 +126,9 @@ class publish_engine:
                                         body=message_body,
                                         properties=pika.BasicProperties(
                                             delivery_mode=2,
+                                            priority=self._priorities.get(self._routing_key_hockey),
+                                            timestamp=int(time.time()),
+                                            headers=self._tracer.trace_headers() if self._tracer else None,
                                         ))
 
             print("Published scorecard for curling, football and hockey - %i " %(message_count))
@@ -1,4 +1,5 @@
 import pika
+import signal
 import time
 
 class consume_engine:
@@ -16,16 +17,30 @@ class consume_engine:
     :param port: port to connect to RabbitMQ server on host
     :param vhost: virtual host on RabbitMQ server
     :param exchange_name: exchange name to consume messages from
+    :param connection_options: extra pika.ConnectionParameters arguments, such as a tuning profile from
+                               connection_profiles/connection_profiles.py
+    :param group: consumer_group from management/management.py, when set the consumer uses the durable queue of the
+                  group, that keeps its messages while the consumer is down and is shared by the consumers
+                  of the group, and acknowledges each message once it has been handled
+    :param tracer: latency_tracer from latency/latency.py, records broker dwell time and handler time per routing key
+    :param drain_timeout: number of seconds to wait for the messages being handled to finish on SIGTERM or SIGINT,
+                          before exiting without acknowledging them
     """
 
-    def __init__(self, username, password, host, port, vhost, exchange):
+    def __init__(self, username, password, host, port, vhost, exchange, connection_options=None, group=None,
+                 tracer=None, drain_timeout=30):
         self._username = username
         self._password = password
         self._host = host
         self._port = port
         self._vhost = vhost
+        self._connection_options = connection_options or {}
         self._exchange_name = exchange
         self._queue_name = None
+        self._group = group
+        self._tracer = tracer
+        self._drain_timeout = drain_timeout
+        self._draining = False
         self._connection = None
         self._channel = None
 
@@ -36,7 +51,9 @@ class consume_engine:
         """
 
         credentials = pika.PlainCredentials(self._username, self._password)
-        parameters = pika.ConnectionParameters(self._host, self._port, self._vhost, credentials, socket_timeout=300)
+        options = {'socket_timeout': 300}
+        options.update(self._connection_options)
+        parameters = pika.ConnectionParameters(self._host, self._port, self._vhost, credentials, **options)
         self._connection = pika.BlockingConnection(parameters)
         print("Connected successfully...")
 
@@ -57,11 +74,47 @@ class consume_engine:
                          exchange_type='fanout')
         print("Exchange declared....")
 
+    def queue_arguments(self):
+        """
+        Returns the arguments to declare the queue with, x-expires for a group queue when the group sets queue_expires.
+        """
+
+        if self._group:
+            return self._group.queue_arguments() or None
+        return None
+
+    def reconcile_bindings(self, queue_name, binding_keys):
+        """
+        Makes the bindings between the exchange and a group queue match the binding keys. When the
+        group has a management client, only the missing bindings are added, and then the bindings
+        that are no longer asked for are removed, unless another consumer of the group is using the
+        queue. Without one every key is bound, which is idempotent.
+
+        :param queue_name: group queue
+        :param binding_keys: binding keys the queue should have
+        """
+
+        to_bind, to_unbind = self._group.plan_bindings(self._exchange_name, queue_name, binding_keys)
+        for binding_key in to_bind:
+            self._channel.queue_bind(exchange=self._exchange_name, routing_key=binding_key, queue=queue_name)
+        for routing_key, arguments in to_unbind:
+            self._channel.queue_unbind(queue=queue_name, exchange=self._exchange_name,
+                                       routing_key=routing_key, arguments=arguments)
+            print("Removed binding %s from queue: %s" %(routing_key, queue_name))
+
     def declare_queue(self):
         """
-        Get the name of the queue, which is automatically created by the RabbitMQ server
+        Get the name of the queue, which is automatically created by the RabbitMQ server, or
+        declare the durable group queue when a group is set
         """
 
+        if self._group:
+            self._queue_name = self._group.queue_name(self._exchange_name)
+            result = self._channel.queue_declare(self._queue_name, durable=True, arguments=self.queue_arguments())
+            print("Resuming group queue: %s with %i messages waiting" %(self._queue_name, result.method.message_count))
+            print(' [*] Waiting for messages. To exit press CTRL+C')
+            return
+
         result = self._channel.queue_declare('', exclusive=True)
         self._queue_name = result.method.queue
         print("Queue declared....")
@@ -72,8 +125,12 @@ class consume_engine:
         Bind the automatically created queue to the exchange
         """
 
-        self._channel.queue_bind(exchange=self._exchange_name,
-                           queue=self._queue_name)
+        if self._group:
+            # Fanout exchanges ignore the routing key, bind with an empty one
+            self.reconcile_bindings(self._queue_name, [''])
+        else:
+            self._channel.queue_bind(exchange=self._exchange_name,
+                               queue=self._queue_name)
         print("Made binding between exchange: %s and queue: %s" %(self._exchange_name, self._queue_name))
 
     def on_message(self, channel, method, properties, body):
@@ -89,19 +146,99 @@ class consume_engine:
         print(" [x] Feed Received - %s \n" % str(body))
         time.sleep(2)
 
+    def handle_message(self, channel, method, properties, body):
+        """
+        Passes a message to on_message, through the tracer when one is set.
+
+        :param channel: channel passed through from server on callback
+        :param method: message details passed through from server on callback
+        :param properties: message properties passed through from server on callback
+        :param body: message body passed through from server on callback
+        """
+
+        if self._tracer is None:
+            self.on_message(channel, method, properties, body)
+        else:
+            self._tracer.handle(self.on_message, channel, method, properties, body)
+
+    def on_acked_message(self, channel, method, properties, body):
+        """
+        Called when a message is received on a queue consumed with manual acknowledgements.
+        Handles the message, and then acknowledges it so the next message can be delivered.
+
+        :param channel: channel passed through from server on callback
+        :param method: message details passed through from server on callback
+        :param properties: message properties passed through from server on callback
+        :param body: message body passed through from server on callback
+        """
+
+        self.handle_message(channel, method, properties, body)
+        channel.basic_ack(delivery_tag=method.delivery_tag)
+
     def consume_messages(self):
         """
         Consumes all messages that are sent to the Fanout Exchange on the RabbitMQ server
         """
 
-        self._channel.basic_consume(self._queue_name, self.on_message,
+        if self._group:
+            # Acknowledge group queue messages once handled, so none are lost on a restart
+            self._channel.basic_qos(prefetch_count=1)
+            self._channel.basic_consume(self._queue_name, self.on_acked_message)
+            self._channel.start_consuming()
+            return
+
+        self._channel.basic_consume(self._queue_name, self.handle_message,
                                     auto_ack=True)
         self._channel.start_consuming()
 
+    def on_shutdown_signal(self, signum, frame):
+        """
+        Signal handler for SIGTERM and SIGINT. The first signal starts draining, the message being
+        handled is finished before consuming stops, and the process exits if draining takes longer
+        than drain_timeout. A second signal exits straight away.
+
+        :param signum: signal number
+        :param frame: stack frame the signal interrupted
+        """
+
+        if self._draining:
+            raise SystemExit("Exiting without draining")
+        print("Draining, send the signal again to exit straight away")
+        self._draining = True
+        if hasattr(signal, 'SIGALRM'):
+            signal.signal(signal.SIGALRM, self.on_drain_timeout)
+            signal.setitimer(signal.ITIMER_REAL, self._drain_timeout)
+        self._connection.add_callback_threadsafe(self._channel.stop_consuming)
+
+    def on_drain_timeout(self, signum, frame):
+        """
+        Signal handler for the drain timer. Exits without waiting any longer, unacknowledged
+        messages are redelivered by the server.
+
+        :param signum: signal number
+        :param frame: stack frame the signal interrupted
+        """
+
+        raise SystemExit("Draining took longer than %s seconds, exiting" % self._drain_timeout)
+
+    def drain(self):
+        """
+        Finishes shutting down after consuming has stopped, and the message being handled has
+        finished. Closes the connection.
+        """
+
+        if self._channel.is_open:
+            self._channel.stop_consuming()
+        self._connection.close()
+        if hasattr(signal, 'SIGALRM'):
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        print("Drained and closed connection....")
+
     def run(self):
         """
         Method to run consumer. Makes connection to RabbitMQ server, creates channel,
         sets up Fanout Exchange, binds queue and exchange, consumes messages.
+        Drains on SIGTERM or SIGINT.
         """
 
         self.make_connection()
@@ -109,7 +246,11 @@ class consume_engine:
         self.declare_exchange()
         self.declare_queue()
         self.make_binding()
+        signal.signal(signal.SIGTERM, self.on_shutdown_signal)
+        signal.signal(signal.SIGINT, self.on_shutdown_signal)
         self.consume_messages()
+        if self._draining:
+            self.drain()
 
 if __name__ == '__main__':
     engine = consume_engine(username='guest', password='guest', host='localhost', port=5672, vhost='/', exchange='score.feed.fanout_exchange')
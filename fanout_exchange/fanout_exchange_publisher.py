@@ -18,17 +18,27 @@ class publish_engine:
     :param exchange_name: exchange name to publish messages to 
     :param number_of_messages: number of messages to publish
     :param message_interval: number of seconds to wait between publishing each message
+    :param connection_options: extra pika.ConnectionParameters arguments, such as a tuning profile from
+                               connection_profiles/connection_profiles.py
+    :param tracer: latency_tracer from latency/latency.py, when set every message carries the x-published-ns
+                   and x-trace-id headers, so consumers can measure publish to handle latency
+    :param blocked: blocked_monitor from flow_control/flow_control.py, pauses or stops publishing while the server
+                    blocks the connection under memory or disk pressure
     """
 
-    def __init__(self, username, password, host, port, vhost, exchange, number_of_messages, message_interval):
+    def __init__(self, username, password, host, port, vhost, exchange, number_of_messages, message_interval,
+                 connection_options=None, tracer=None, blocked=None):
         self._username = username
         self._password = password
         self._host = host
         self._port = port
         self._vhost = vhost
+        self._connection_options = connection_options or {}
+        self._tracer = tracer
         self._messages = number_of_messages
         self._message_interval = message_interval
         self._exchange_name = exchange
+        self._blocked = blocked
         self._connection = None
         self._channel = None
 
@@ -39,8 +49,14 @@ class publish_engine:
         """
 
         credentials = pika.PlainCredentials(self._username, self._password)
-        parameters = pika.ConnectionParameters(self._host, self._port, self._vhost, credentials, socket_timeout=300)
+        options = {'socket_timeout': 300}
+        options.update(self._connection_options)
+        if self._blocked:
+            options.update(self._blocked.connection_options())
+        parameters = pika.ConnectionParameters(self._host, self._port, self._vhost, credentials, **options)
         self._connection = pika.BlockingConnection(parameters)
+        if self._blocked:
+            self._blocked.watch(self._connection)
         print("Connected successfully...")
 
     def channel(self):
@@ -68,6 +84,8 @@ class publish_engine:
         message_count = 0
         score = 0
         while message_count < self._messages:
+            if self._blocked:
+                self._blocked.wait_while_blocked(self._connection)
             message_count += 1
             score += randint(0, 9)
             message_body = "Curling Score | Home Team : Canada | Away Team : England | Score : %i " %(score)
@@ -76,6 +94,8 @@ class publish_engine:
                                   body=message_body,
                                   properties=pika.BasicProperties(
                                       delivery_mode=2,  # make message persistant
+                                      timestamp=int(time.time()),
+                                      headers=self._tracer.trace_headers() if self._tracer else None,
                                   ))
             print("Published message %i with score %i" %(message_count, score))
             time.sleep(self._message_interval)
@@ -0,0 +1,67 @@
+import time
+from fanout_exchange_consumer import consume_engine
+from fanout_exchange_ring import ring_writer
+
+class relay_engine(consume_engine):
+    """
+    Class to relay a Fanout Exchange to the processes on one host. Subscribes to the exchange like
+    any fanout consumer, and writes each delivery into a shared memory ring buffer, that the local
+    processes read with fanout_exchange_subscriber.py instead of each opening its own connection and
+    queue. The broker then sends every broadcast to the host once, however many local subscribers
+    there are.
+
+    :param ring_name: name of the shared memory ring buffer the local subscribers attach to
+    :param slots: number of messages the ring holds, a subscriber falling further behind loses messages
+    :param slot_size: number of bytes per message, larger messages are dropped
+    :param report_interval: number of seconds between printing the number of messages relayed
+
+    Other parameters are the same as consume_engine in fanout_exchange_consumer.py.
+    """
+
+    def __init__(self, username, password, host, port, vhost, exchange, ring_name, slots=4096, slot_size=16 * 1024,
+                 report_interval=10, **options):
+        super().__init__(username, password, host, port, vhost, exchange, **options)
+        self._ring_name = ring_name
+        self._slots = slots
+        self._slot_size = slot_size
+        self._report_interval = report_interval
+        self._last_report = time.monotonic()
+        self._ring = None
+
+    def on_message(self, channel, method, properties, body):
+        """
+        Called when a message is received. Writes it into the ring buffer.
+
+        :param channel: channel passed through from server on callback
+        :param method: message details passed through from server on callback
+        :param properties: message properties passed through from server on callback
+        :param body: message body passed through from server on callback
+        """
+
+        self._ring.write(properties, body)
+        now = time.monotonic()
+        if now - self._last_report >= self._report_interval:
+            print("Relayed %i messages, %i too large for a slot" %(self._ring.sequence, self._ring.dropped))
+            self._last_report = now
+
+    def run(self):
+        """
+        Method to run relay. Creates the ring buffer, then consumes from the Fanout Exchange until
+        interrupted, and removes the ring buffer.
+        """
+
+        self._ring = ring_writer(self._ring_name, self._slots, self._slot_size)
+        print("Relaying %s to ring buffer: %s" %(self._exchange_name, self._ring_name))
+        try:
+            super().run()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            print("Relayed %i messages" % self._ring.sequence)
+            self._ring.close()
+
+
+if __name__ == '__main__':
+    engine = relay_engine(username='guest', password='guest', host='localhost', port=5672, vhost='/',
+                          exchange='score.feed.fanout_exchange', ring_name='score_feed_relay')
+    engine.run()
@@ -0,0 +1,192 @@
+"""
+Shared memory ring buffer used by the fanout relay and its local subscribers. One relay process
+writes, and any number of processes on the same host read. The buffer starts with a header:
+
+    8 bytes   magic, RMQRING1
+    4 bytes   number of slots
+    4 bytes   size of a slot
+    8 bytes   sequence number of the last complete message, little endian
+
+followed by fixed size slots, message n going into slot n % slots:
+
+    8 bytes   sequence number of the message in the slot, 0 while it is being written
+    4 bytes   length of the properties
+    4 bytes   length of the body
+              properties in their AMQP wire encoding, body
+
+Needs Python 3.8 or later, for multiprocessing.shared_memory.
+
+Sequence numbers start at 1. The writer never waits for readers, so a reader that falls more than
+a whole ring behind loses messages. It notices because the slot it wants holds a later sequence
+number, or because the sequence number of the slot changed while it was reading it.
+"""
+
+import struct
+import time
+from multiprocessing import resource_tracker, shared_memory
+import pika
+
+MAGIC = b'RMQRING1'
+HEADER = struct.Struct('<8sIIQ')
+SLOT = struct.Struct('<QII')
+SEQUENCE = struct.Struct('<Q')
+LENGTHS = struct.Struct('<II')
+SEQUENCE_OFFSET = 16
+
+class ring_writer:
+    """
+    Creates the shared memory ring buffer and writes messages into it.
+
+    :param name: name of the shared memory block, readers attach to it by this name
+    :param slots: number of messages the ring holds
+    :param slot_size: number of bytes per message, including properties and the slot header
+    """
+
+    def __init__(self, name, slots=4096, slot_size=16 * 1024):
+        self._slots = slots
+        self._slot_size = slot_size
+        self._memory = shared_memory.SharedMemory(name=name, create=True, size=HEADER.size + slots * slot_size)
+        self._memory.buf[:] = bytes(len(self._memory.buf))
+        HEADER.pack_into(self._memory.buf, 0, MAGIC, slots, slot_size, 0)
+        self.sequence = 0
+        self.dropped = 0
+
+    def write(self, properties, body):
+        """
+        Writes a message into the next slot, overwriting the oldest message.
+
+        :param properties: pika.BasicProperties of the message
+        :param body: message body
+        :return: sequence number of the message, or None if it does not fit in a slot
+        """
+
+        encoded_properties = b''.join(properties.encode())
+        if SLOT.size + len(encoded_properties) + len(body) > self._slot_size:
+            self.dropped += 1
+            print("Message of %i bytes does not fit in a ring slot, dropped" % len(body))
+            return None
+
+        sequence = self.sequence + 1
+        buf = self._memory.buf
+        offset = HEADER.size + (sequence % self._slots) * self._slot_size
+        # Mark the slot as being written first, so a reader still on the old message sees it change
+        SEQUENCE.pack_into(buf, offset, 0)
+        start = offset + SLOT.size
+        buf[start:start + len(encoded_properties)] = encoded_properties
+        start += len(encoded_properties)
+        buf[start:start + len(body)] = body
+        LENGTHS.pack_into(buf, offset + SEQUENCE.size, len(encoded_properties), len(body))
+        # The sequence number is written last, a reader that sees it also sees the message it belongs to
+        SEQUENCE.pack_into(buf, offset, sequence)
+        SEQUENCE.pack_into(buf, SEQUENCE_OFFSET, sequence)
+        self.sequence = sequence
+        return sequence
+
+    def close(self):
+        """
+        Detaches from the ring and removes it, readers still attached keep their mapping until they close.
+        """
+
+        self._memory.close()
+        self._memory.unlink()
+
+class ring_reader:
+    """
+    Attaches to a ring buffer created by a ring_writer and reads the messages written after it
+    attached. Bodies are returned as memoryview slices of the shared memory, so nothing is copied,
+    and are only valid until the writer comes round to their slot again.
+
+    :param name: name of the shared memory block
+    :param poll_interval: number of seconds to sleep while there is no new message
+    """
+
+    def __init__(self, name, poll_interval=0.001):
+        self._memory = shared_memory.SharedMemory(name=name)
+        # The relay owns the ring, do not let this process remove it on exit. SharedMemory registers
+        # itself with the resource tracker under the private _name, the name with its leading slash
+        # on POSIX, and has no public way to opt out before Python 3.13's track=False
+        resource_tracker.unregister(self._memory._name, 'shared_memory')
+        magic, self._slots, self._slot_size, self.sequence = HEADER.unpack_from(self._memory.buf, 0)
+        if magic != MAGIC:
+            raise ValueError("%s is not a relay ring buffer" % name)
+        self._poll_interval = poll_interval
+        self.lost = 0
+
+    def latest(self):
+        """
+        Returns the sequence number of the last complete message in the ring.
+        """
+
+        return SEQUENCE.unpack_from(self._memory.buf, SEQUENCE_OFFSET)[0]
+
+    def slot_offset(self, sequence):
+        """
+        Returns the offset of the slot message sequence is written to.
+
+        :param sequence: sequence number of a message
+        """
+
+        return HEADER.size + (sequence % self._slots) * self._slot_size
+
+    def still_valid(self, sequence):
+        """
+        Returns whether the slot of a message still holds it, so a body read from it was not overwritten while in use.
+
+        :param sequence: sequence number of a message that has been read
+        """
+
+        return SEQUENCE.unpack_from(self._memory.buf, self.slot_offset(sequence))[0] == sequence
+
+    def skip_overrun(self, wanted):
+        """
+        Moves past messages the writer has already overwritten, to the oldest message it will not
+        overwrite next, and counts the messages lost.
+
+        :param wanted: sequence number of the message that was overwritten
+        """
+
+        oldest = self.latest() - self._slots + 2
+        if oldest > wanted:
+            self.lost += oldest - wanted
+            print("Fell behind the relay, lost %i messages" %(oldest - wanted))
+            self.sequence = oldest - 1
+
+    def read(self):
+        """
+        Waits for the next message and returns it.
+
+        :return: (sequence number, pika.BasicProperties, body as a memoryview)
+        """
+
+        buf = self._memory.buf
+        while True:
+            wanted = self.sequence + 1
+            offset = self.slot_offset(wanted)
+            sequence = SEQUENCE.unpack_from(buf, offset)[0]
+            if sequence == wanted:
+                # Read after the sequence number, which the writer stores after them
+                properties_length, body_length = LENGTHS.unpack_from(buf, offset + SEQUENCE.size)
+                start = offset + SLOT.size
+                encoded_properties = bytes(buf[start:start + properties_length])
+                start += properties_length
+                body = buf[start:start + body_length]
+                if self.still_valid(wanted):
+                    # Only decoded once known not to be torn by the writer coming round again
+                    properties = pika.BasicProperties()
+                    properties.decode(encoded_properties)
+                    self.sequence = wanted
+                    return wanted, properties, body
+                body.release()
+                self.skip_overrun(wanted)
+            elif self.latest() >= wanted:
+                # The slot holds a later message, or one being written over it
+                self.skip_overrun(wanted)
+            else:
+                time.sleep(self._poll_interval)
+
+    def close(self):
+        """
+        Detaches from the ring. Bodies read from it must no longer be in use.
+        """
+
+        self._memory.close()
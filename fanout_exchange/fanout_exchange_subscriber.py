@@ -0,0 +1,63 @@
+from fanout_exchange_ring import ring_reader
+
+class subscribe_engine:
+    """
+    Class to receive a Fanout Exchange from the relay on the same host, through its shared memory
+    ring buffer, without a connection to RabbitMQ server. Receives the messages relayed after it
+    starts. Bodies are read in place from shared memory, and messages the relay overwrote before
+    this subscriber got to them are counted as lost.
+
+    :param ring_name: name of the shared memory ring buffer written by fanout_exchange_relay.py
+    :param poll_interval: number of seconds to sleep while there is no new message
+    """
+
+    def __init__(self, ring_name, poll_interval=0.001):
+        self._ring_name = ring_name
+        self._poll_interval = poll_interval
+        self._reader = None
+
+    def on_message(self, sequence, properties, body):
+        """
+        Called when a message is received. The body is a memoryview of the ring buffer, copy it with
+        bytes(body) to keep it after returning.
+
+        :param sequence: sequence number of the message in the ring
+        :param properties: message properties
+        :param body: message body
+        """
+
+        print(" [x] Feed Received - %s \n" % str(bytes(body)))
+
+    def consume_messages(self):
+        """
+        Reads messages from the ring buffer until interrupted.
+        """
+
+        while True:
+            sequence, properties, body = self._reader.read()
+            try:
+                self.on_message(sequence, properties, body)
+                if not self._reader.still_valid(sequence):
+                    print("Message %i was overwritten while it was handled" % sequence)
+            finally:
+                body.release()
+
+    def run(self):
+        """
+        Method to run subscriber. Attaches to the ring buffer, and receives messages until interrupted.
+        """
+
+        self._reader = ring_reader(self._ring_name, self._poll_interval)
+        print(' [*] Waiting for messages from relay %s. To exit press CTRL+C' % self._ring_name)
+        try:
+            self.consume_messages()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            print("Received up to message %i, lost %i" %(self._reader.sequence, self._reader.lost))
+            self._reader.close()
+
+
+if __name__ == '__main__':
+    engine = subscribe_engine(ring_name='score_feed_relay')
+    engine.run()
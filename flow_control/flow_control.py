@@ -0,0 +1,127 @@
+"""
+Handling of connection.blocked and connection.unblocked notifications, shared by the publishers.
+The server blocks a publishing connection when it is low on memory or disk. A monitor is passed
+to a publisher, one per publisher, for example:
+
+    publish_engine(..., blocked=blocked_monitor(policy='wait', timeout=300))
+
+With the 'wait' policy the publisher pauses while the connection is blocked, and gives up with
+ConnectionBlockedTimeout once it has been blocked for timeout seconds, so a server that never
+unblocks does not hang it for ever. With the 'fail' policy it gives up straight away.
+"""
+
+import time
+import pika
+
+class blocked_monitor:
+    """
+    Tracks whether a connection is blocked by the server, how many times it has been blocked, and
+    for how long in total.
+
+    :param policy: what to do when the server blocks the connection under memory or disk pressure,
+                   'wait' pauses publishing until it is unblocked, 'fail' gives up straight away
+    :param timeout: number of seconds the connection may stay blocked before it is closed, None waits for ever
+    """
+
+    def __init__(self, policy='wait', timeout=300):
+        if policy not in ('wait', 'fail'):
+            raise ValueError("Unknown blocked policy %r, use 'wait' or 'fail'" % policy)
+        self.policy = policy
+        self.timeout = timeout
+        self.blocked_since = None
+        self._blocked_count = 0
+        self._blocked_seconds = 0.0
+
+    def connection_options(self):
+        """
+        Returns the pika.ConnectionParameters arguments that make pika close a connection that stays
+        blocked for longer than timeout, which also covers asynchronous connections.
+        """
+
+        if self.timeout is None:
+            return {}
+        return {'blocked_connection_timeout': self.timeout}
+
+    def watch(self, connection):
+        """
+        Adds the blocked and unblocked callbacks to a connection.
+
+        :param connection: BlockingConnection or SelectConnection
+        """
+
+        connection.add_on_connection_blocked_callback(self.on_connection_blocked)
+        connection.add_on_connection_unblocked_callback(self.on_connection_unblocked)
+
+    def is_blocked(self):
+        """
+        Returns True while the connection is blocked.
+        """
+
+        return self.blocked_since is not None
+
+    def on_connection_blocked(self, connection, method_frame):
+        """
+        Called when the server blocks the connection because it is low on memory or disk.
+
+        :param connection: connection passed through from server callback
+        :param method_frame: method frame passed through from server callback, with the reason for the block
+        """
+
+        self.blocked_since = time.monotonic()
+        self._blocked_count += 1
+        print("Connection blocked by server: %s" % method_frame.method.reason)
+
+    def on_connection_unblocked(self, connection, method_frame):
+        """
+        Called when the server unblocks the connection.
+
+        :param connection: connection passed through from server callback
+        :param method_frame: method frame passed through from server callback
+        """
+
+        self.reset()
+        print("Connection unblocked by server, blocked %i times for %.1f seconds in total" %(self._blocked_count, self._blocked_seconds))
+
+    def reset(self):
+        """
+        Ends the current blocked period, if any, for example when the connection has closed.
+        """
+
+        if self.blocked_since is not None:
+            self._blocked_seconds += time.monotonic() - self.blocked_since
+            self.blocked_since = None
+
+    def metrics(self):
+        """
+        Returns whether the connection is blocked, the number of times it has been blocked, and
+        the total number of seconds it has been blocked for.
+        """
+
+        blocked_seconds = self._blocked_seconds
+        if self.blocked_since is not None:
+            blocked_seconds += time.monotonic() - self.blocked_since
+        return {'blocked': self.blocked_since is not None,
+                'blocked_count': self._blocked_count,
+                'blocked_seconds': blocked_seconds}
+
+    def wait_while_blocked(self, connection):
+        """
+        Called by a publisher on a BlockingConnection before publishing. Processes pending
+        notifications from the server, and if the connection is blocked either waits until it is
+        unblocked or raises, depending on policy. Waiting gives up once the connection has been
+        blocked for timeout seconds.
+
+        :param connection: BlockingConnection the publisher publishes on
+        """
+
+        connection.process_data_events(time_limit=0)
+        if self.blocked_since is None:
+            return
+        if self.policy == 'fail':
+            raise pika.exceptions.ConnectionBlockedTimeout("Connection is blocked by server, not publishing")
+        while self.blocked_since is not None:
+            waited = time.monotonic() - self.blocked_since
+            if self.timeout is not None and waited >= self.timeout:
+                raise pika.exceptions.ConnectionBlockedTimeout("Connection blocked for %.1f seconds, not publishing" % waited)
+            time_limit = 1 if self.timeout is None else min(1, self.timeout - waited)
+            connection.process_data_events(time_limit=time_limit)
@@ -0,0 +1,171 @@
+"""
+Latency tracing shared by the publishers and consumers. A tracer is passed to a publisher, which
+stamps every message with its publish time and a trace id, and to a consumer, which records the
+time from publish to arrival and the time spent in its handler per routing key, for example:
+
+    publish_engine(..., tracer=latency_tracer())
+    consume_engine(..., tracer=latency_tracer(report_interval=10))
+
+The publisher and consumer clocks are compared, so dwell times are only meaningful when both
+run on hosts with synchronized clocks.
+"""
+
+import time
+import uuid
+
+class latency_histogram:
+    """
+    HDR style histogram of latencies in microseconds. Values below 128 are counted exactly, and
+    larger values are counted in buckets of 64 per power of two, so every recorded value keeps
+    about two significant digits however large it is, and recording is a constant time update.
+    """
+
+    SUB_BUCKET_BITS = 7
+    SUB_BUCKET_COUNT = 1 << SUB_BUCKET_BITS
+    SUB_BUCKET_HALF = SUB_BUCKET_COUNT >> 1
+
+    def __init__(self):
+        self._counts = {}
+        self._total = 0
+
+    def bucket_index(self, value):
+        """
+        Returns the index of the bucket that counts the value.
+
+        :param value: latency in microseconds
+        """
+
+        if value < self.SUB_BUCKET_COUNT:
+            return max(value, 0)
+        shift = value.bit_length() - self.SUB_BUCKET_BITS
+        return shift * self.SUB_BUCKET_HALF + (value >> shift)
+
+    def bucket_value(self, index):
+        """
+        Returns the highest value counted by the bucket at the index.
+
+        :param index: bucket index
+        """
+
+        if index < self.SUB_BUCKET_COUNT:
+            return index
+        shift = index // self.SUB_BUCKET_HALF - 1
+        sub_bucket = index - shift * self.SUB_BUCKET_HALF
+        return ((sub_bucket + 1) << shift) - 1
+
+    def record(self, value):
+        """
+        Records a latency.
+
+        :param value: latency in microseconds
+        """
+
+        index = self.bucket_index(int(value))
+        self._counts[index] = self._counts.get(index, 0) + 1
+        self._total += 1
+
+    def count(self):
+        """
+        Returns the number of latencies recorded.
+        """
+
+        return self._total
+
+    def percentile(self, percentile):
+        """
+        Returns the latency at the percentile, to the precision of its bucket.
+
+        :param percentile: percentile between 0 and 100
+        """
+
+        if not self._total:
+            return 0
+        target = max(1, int(round(self._total * percentile / 100.0)))
+        seen = 0
+        for index in sorted(self._counts):
+            seen += self._counts[index]
+            if seen >= target:
+                return self.bucket_value(index)
+        return self.bucket_value(max(self._counts))
+
+    def reset(self):
+        """
+        Removes all recorded latencies.
+        """
+
+        self._counts = {}
+        self._total = 0
+
+class latency_tracer:
+    """
+    Adds trace headers to published messages, and records and reports the latencies of handled
+    messages. Dwell time, from publish to arrival, covers the network and the broker, and handler
+    time is the time spent handling the message. p50, p99 and p999 are printed per routing key
+    every report_interval seconds.
+
+    :param report_interval: number of seconds between latency reports
+    """
+
+    def __init__(self, report_interval=10):
+        self._report_interval = report_interval
+        self._histograms = {}
+        self._last_report = time.monotonic()
+
+    def trace_headers(self, headers=None):
+        """
+        Returns the message headers with the publish time, in nanoseconds since the epoch, and
+        a unique trace id added, so consumers can measure publish to handle latency.
+
+        :param headers: existing message headers to add the trace headers to
+        """
+
+        headers = dict(headers or {})
+        headers['x-published-ns'] = time.time_ns()
+        headers['x-trace-id'] = uuid.uuid4().hex
+        return headers
+
+    def handle(self, handler, channel, method, properties, body):
+        """
+        Calls a message handler, and records the dwell time of the message and the time the handler
+        took, in histograms for the routing key of the message.
+
+        :param handler: function of (channel, method, properties, body) that handles the message
+        :param channel: channel passed through from server on callback
+        :param method: message details passed through from server on callback
+        :param properties: message properties passed through from server on callback
+        :param body: message body passed through from server on callback
+        :return: what the handler returned
+        """
+
+        arrived_ns = time.time_ns()
+        started = time.perf_counter_ns()
+        try:
+            return handler(channel, method, properties, body)
+        finally:
+            handler_us = (time.perf_counter_ns() - started) // 1000
+            histograms = self._histograms.get(method.routing_key)
+            if histograms is None:
+                histograms = self._histograms[method.routing_key] = {'dwell': latency_histogram(),
+                                                                     'handler': latency_histogram()}
+            published_ns = (properties.headers or {}).get('x-published-ns')
+            if published_ns is not None:
+                histograms['dwell'].record((arrived_ns - published_ns) // 1000)
+            histograms['handler'].record(handler_us)
+
+            if time.monotonic() - self._last_report >= self._report_interval:
+                self.report()
+
+    def report(self):
+        """
+        Prints the p50, p99 and p999 dwell and handler latencies, in microseconds, for each
+        routing key, and starts new histograms for the next interval.
+        """
+
+        for routing_key, histograms in sorted(self._histograms.items()):
+            for name, histogram in sorted(histograms.items()):
+                if histogram.count():
+                    print(" [latency] %s %s count: %i p50: %ius p99: %ius p999: %ius" %(
+                        routing_key, name, histogram.count(), histogram.percentile(50),
+                        histogram.percentile(99), histogram.percentile(99.9)))
+                histogram.reset()
+        self._last_report = time.monotonic()
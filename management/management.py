@@ -0,0 +1,159 @@
+"""
+RabbitMQ management API client and consumer groups, shared by the consumers. Both are passed to a
+consumer, for example:
+
+    management = management_client('http://localhost:15672', 'guest', 'guest', vhost='/')
+    consume_engine(..., group=consumer_group('stats', queue_expires=86400, management=management))
+
+A consumer group gives a consumer a durable queue named after the exchange and the group, the same
+on every restart. With a management client, the bindings the queue already has are listed, so only
+the missing ones are added, and the ones no longer asked for are removed once no other consumer of
+the group is using the queue.
+"""
+
+import base64
+import json
+import urllib.parse
+import urllib.request
+
+class management_client:
+    """
+    Reads queues and bindings from the RabbitMQ management API, with basic authentication.
+
+    :param url: url of the management API, such as http://localhost:15672
+    :param username: username to login to the management API
+    :param password: password for user to login to the management API
+    :param vhost: virtual host the queues and exchanges are in
+    :param timeout: number of seconds to wait for a reply
+    """
+
+    def __init__(self, url, username, password, vhost='/', timeout=10):
+        self._url = url.rstrip('/')
+        self._token = base64.b64encode(('%s:%s' %(username, password)).encode()).decode()
+        self._vhost = vhost
+        self._timeout = timeout
+
+    def request(self, *path, timeout=None):
+        """
+        Returns the decoded JSON reply to a GET of an API path.
+
+        :param path: path segments after /api, quoted before they are joined
+        :param timeout: number of seconds to wait for a reply, defaults to the client's timeout
+        """
+
+        url = '%s/api/%s' %(self._url, '/'.join(urllib.parse.quote(segment, safe='') for segment in path))
+        request = urllib.request.Request(url)
+        request.add_header('Authorization', 'Basic ' + self._token)
+        with urllib.request.urlopen(request, timeout=self._timeout if timeout is None else timeout) as response:
+            return json.loads(response.read().decode())
+
+    def queue_leader(self, queue_name, timeout=None):
+        """
+        Returns the host name of the node that leads a queue.
+
+        :param queue_name: queue to look up
+        :param timeout: number of seconds to wait for a reply, defaults to the client's timeout
+        :return: host name of the node, or None if it could not be found
+        """
+
+        try:
+            info = self.request('queues', self._vhost, queue_name, timeout=timeout)
+        except Exception as error:
+            print("Could not find leader of %s: %r" %(queue_name, error))
+            return None
+        node = info.get('leader') or info.get('node')
+        # Node names look like rabbit@hostname
+        return node.split('@')[-1] if node else None
+
+    def queue_consumers(self, queue_name):
+        """
+        Returns the number of consumers of a queue.
+
+        :param queue_name: queue to look up
+        :return: number of consumers, or None if the queue could not be found
+        """
+
+        try:
+            info = self.request('queues', self._vhost, queue_name)
+        except Exception as error:
+            print("Could not find consumers of %s: %r" %(queue_name, error))
+            return None
+        return info.get('consumers')
+
+    def bindings(self, exchange, queue_name):
+        """
+        Returns the bindings between an exchange and a queue.
+
+        :param exchange: exchange the queue is bound to
+        :param queue_name: queue to list the bindings of
+        :return: list of (routing key, arguments), or None if the bindings could not be listed
+        """
+
+        try:
+            bindings = self.request('bindings', self._vhost, 'e', exchange, 'q', queue_name)
+        except Exception as error:
+            print("Could not list bindings of %s: %r" %(queue_name, error))
+            return None
+        return [(binding['routing_key'], binding.get('arguments') or None) for binding in bindings]
+
+class consumer_group:
+    """
+    A named group of consumers sharing durable queues. Messages published while every consumer of
+    the group is down wait in the queue, and consumers acknowledge each message once handled.
+
+    :param name: group name, queues are named <exchange>.<name>
+    :param queue_expires: number of seconds a queue is kept once it has no consumers, declared as x-expires
+    :param management: management_client, used to remove bindings the consumers no longer ask for
+    """
+
+    def __init__(self, name, queue_expires=None, management=None):
+        self.name = name
+        self._queue_expires = queue_expires
+        self._management = management
+
+    def queue_name(self, exchange, suffix=None):
+        """
+        Returns the name of the durable queue of the group, the same on every restart.
+
+        :param exchange: exchange the queue is bound to
+        :param suffix: added to the name, to tell apart several queues of one group
+        """
+
+        name = '%s.%s' %(exchange, self.name)
+        return '%s.%s' %(name, suffix) if suffix else name
+
+    def queue_arguments(self):
+        """
+        Returns the queue arguments of the group, x-expires when queue_expires is set.
+        """
+
+        if self._queue_expires:
+            return {'x-expires': int(self._queue_expires * 1000)}
+        return {}
+
+    def plan_bindings(self, exchange, queue_name, binding_keys):
+        """
+        Works out the bindings to add and remove so a queue is bound with the binding keys. Every
+        key is bound when there is no management client, or the bindings could not be listed, as
+        binding is idempotent, and nothing is removed.
+
+        The members of a group share the queue and may ask for different keys, so bindings that are
+        not asked for are only removed when the queue has no consumers. While another member is
+        consuming, the queue keeps them, and ends up bound with the union of the members' keys.
+
+        :param exchange: exchange the queue is bound to
+        :param queue_name: group queue
+        :param binding_keys: binding keys the queue should have
+        :return: (binding keys to bind, list of (routing key, arguments) to unbind)
+        """
+
+        existing = self._management.bindings(exchange, queue_name) if self._management else None
+        if existing is None:
+            return list(binding_keys), []
+        bound = {routing_key for routing_key, _ in existing}
+        to_bind = [binding_key for binding_key in binding_keys if binding_key not in bound]
+        to_unbind = [(routing_key, arguments) for routing_key, arguments in existing if routing_key not in binding_keys]
+        if to_unbind and self._management.queue_consumers(queue_name) != 0:
+            print("Keeping %i bindings of %s, other consumers of the group may rely on them" %(len(to_unbind), queue_name))
+            to_unbind = []
+        return to_bind, to_unbind
@@ -0,0 +1,236 @@
+import pika, time, uuid
+import functools
+import logging
+import threading
+from concurrent.futures import Future, TimeoutError
+
+LOG_FORMAT = ('%(levelname) -10s %(asctime)s %(name) -30s %(funcName) '
+                '-35s %(lineno) -5d: %(message)s')
+LOGGER = logging.getLogger(__name__)
+
+REPLY_TO = 'amq.rabbitmq.reply-to'
+
+class client_engine:
+    """
+    Class to make RPC calls through RabbitMQ server using pika. Replies are received through
+    direct reply-to, so no reply queue is declared. The connection runs on its own ioloop
+    thread, and each call returns a Future straight away, so any number of calls can be in
+    flight at once on the one channel. Futures are matched to replies by correlation id, and
+    fail with TimeoutError when no reply arrives in time, or with ConnectionError when the
+    client is not running or its connection closes.
+
+    :param username: username to login to RabbitMQ server
+    :param password: password for user to login to RabbitMQ server
+    :param host: location of RabbitMQ server
+    :param port: port to connect to RabbitMQ server on host
+    :param vhost: virtual host on RabbitMQ server
+    :param queue: queue the server consumes requests from
+    :param timeout: default number of seconds to wait for a reply
+    :param connection_options: extra pika.ConnectionParameters arguments, such as a tuning profile from
+                               connection_profiles/connection_profiles.py
+    """
+
+    def __init__(self, username, password, host, port, vhost, queue, timeout=5, connection_options=None):
+        self._username = username
+        self._password = password
+        self._host = host
+        self._port = port
+        self._vhost = vhost
+        self._connection_options = connection_options or {}
+        self._queue = queue
+        self._timeout = timeout
+        self._pending = {}
+        self._queued = set()
+        self._running = False
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._thread = None
+        self._channel = None
+        self._connection = None
+
+    def on_open(self, connection):
+        """
+        Method called after connection to RabbitMQ server has been opened. Opens a channel.
+
+        :param connection: connection passed through from server callback
+        """
+
+        self._channel = self._connection.channel(on_open_callback=self.on_channel_open)
+
+    def on_channel_open(self, channel):
+        """
+        Method called when the channel is opened. Consumes replies from the direct reply-to
+        pseudo queue, which has to be done before the first request is published.
+
+        :param channel: channel passed through from server on callback
+        """
+
+        self._channel.basic_consume(REPLY_TO, self.on_response, auto_ack=True, callback=self.on_consume_ok)
+
+    def on_consume_ok(self, method_frame):
+        """
+        Method called when the reply consumer has been set up. Calls can be made from here on.
+
+        :param method_frame: method frame passed through from server on callback
+        """
+
+        with self._lock:
+            self._running = True
+        self._ready.set()
+
+    def call(self, body, timeout=None):
+        """
+        Makes an RPC call. Safe to call from any thread. The Future fails straight away when the
+        client has not been started, or has been closed, as the ioloop would never publish the call.
+
+        :param body: request body
+        :param timeout: number of seconds to wait for the reply, defaults to the client timeout
+        :return: Future that resolves to the reply body
+        """
+
+        future = Future()
+        correlation_id = uuid.uuid4().hex
+        with self._lock:
+            if not self._running:
+                future.set_exception(ConnectionError("RPC client is not running"))
+                return future
+            # Failed by on_close if the connection closes before the ioloop gets to it
+            self._queued.add(future)
+        self._connection.ioloop.add_callback_threadsafe(
+            functools.partial(self.publish_request, correlation_id, body, future, timeout or self._timeout))
+        return future
+
+    def publish_request(self, correlation_id, body, future, timeout):
+        """
+        Publishes a request on the ioloop, and starts the timer for its reply. Calls cancelled
+        before they reach the ioloop are not published, and once published a call can no longer
+        be cancelled.
+
+        :param correlation_id: id to match the reply to the request
+        :param body: request body
+        :param future: Future to resolve with the reply
+        :param timeout: number of seconds to wait for the reply
+        """
+
+        with self._lock:
+            self._queued.discard(future)
+        if not future.set_running_or_notify_cancel():
+            return
+        if self._channel is None or not self._channel.is_open:
+            future.set_exception(ConnectionError("Channel is closed"))
+            return
+        timer = self._connection.ioloop.call_later(timeout, functools.partial(self.on_timeout, correlation_id))
+        self._pending[correlation_id] = (future, timer)
+        self._channel.basic_publish(exchange='',
+                                    routing_key=self._queue,
+                                    body=body,
+                                    properties=pika.BasicProperties(
+                                        reply_to=REPLY_TO,
+                                        correlation_id=correlation_id,
+                                    ))
+
+    def on_response(self, channel, basic_deliver, properties, body):
+        """
+        Method called when a reply is received. Resolves the Future of the matching call. Replies
+        to calls that have already timed out are dropped.
+
+        :param channel: channel passed through from server on callback
+        :param basic_deliver: message details passed through from server on callback
+        :param properties: message properties passed through from server on callback
+        :param body: message body passed through from server on callback
+        """
+
+        pending = self._pending.pop(properties.correlation_id, None)
+        if pending is None:
+            return
+        future, timer = pending
+        self._connection.ioloop.remove_timeout(timer)
+        if future.done():
+            return
+        if (properties.headers or {}).get('x-error'):
+            future.set_exception(RuntimeError(body.decode()))
+        else:
+            future.set_result(body)
+
+    def on_timeout(self, correlation_id):
+        """
+        Method called when no reply has arrived in time. Fails the Future of the call.
+
+        :param correlation_id: id of the call
+        """
+
+        pending = self._pending.pop(correlation_id, None)
+        if pending is not None and not pending[0].done():
+            pending[0].set_exception(TimeoutError("No reply to RPC call %s" % correlation_id))
+
+    def on_close(self, connection, reply_code):
+        """
+        Method called when the connection to the RabbitMQ server is closed. Fails every call
+        still waiting for a reply or to be published, and stops the ioloop.
+
+        :param connection: connection passed through from server callback
+        :param reply_code: code passed through from server on callback containing shutdown code
+        """
+
+        with self._lock:
+            self._running = False
+            queued = self._queued
+            self._queued = set()
+        futures = [future for future, timer in self._pending.values()] + list(queued)
+        for future in futures:
+            if not future.done():
+                future.set_exception(ConnectionError("Connection closed: %s" % reply_code))
+        self._pending = {}
+        self._ready.set()
+        self._connection.ioloop.stop()
+
+    def on_open_error(self, connection, error):
+        """
+        Method called when the connection to RabbitMQ server could not be opened. Stops the ioloop.
+
+        :param connection: connection passed through from server callback
+        :param error: exception describing why the connection could not be opened
+        """
+
+        print("Connection could not be opened: %r \n" % error)
+        self._ready.set()
+        self._connection.ioloop.stop()
+
+    def start(self):
+        """
+        Set up the asynchronous connection to RabbitMQ server using the credentials used to instantiate this
+        client engine, run its ioloop on a background thread, and wait until calls can be made.
+        """
+
+        logging.basicConfig(level=logging.ERROR, format=LOG_FORMAT)
+        credentials = pika.PlainCredentials(self._username, self._password)
+        options = {'socket_timeout': 300}
+        options.update(self._connection_options)
+        parameters = pika.ConnectionParameters(self._host, self._port, self._vhost, credentials, **options)
+        self._connection = pika.SelectConnection(parameters, on_open_callback=self.on_open,
+                                                 on_open_error_callback=self.on_open_error)
+        self._connection.add_on_close_callback(self.on_close)
+        self._thread = threading.Thread(target=self._connection.ioloop.start, daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        if not self._connection.is_open:
+            raise ConnectionError("Could not connect to RabbitMQ server")
+
+    def close(self):
+        """
+        Close the connection to RabbitMQ server and wait for the ioloop thread to finish.
+        """
+
+        self._connection.ioloop.add_callback_threadsafe(self._connection.close)
+        self._thread.join()
+
+
+if __name__ == '__main__':
+    engine = client_engine(username='guest', password='guest', host='localhost', port=5672, vhost='/', queue='rpc_queue')
+    engine.start()
+    started = time.perf_counter()
+    futures = [engine.call('request %i' % number) for number in range(1000)]
+    replies = [future.result() for future in futures]
+    elapsed = time.perf_counter() - started
+    print("%i calls in %.3f seconds, %.1fus per call" %(len(replies), elapsed, elapsed / len(replies) * 1e6))
+    engine.close()
@@ -0,0 +1,178 @@
+import pika
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+LOG_FORMAT = ('%(levelname) -10s %(asctime)s %(name) -30s %(funcName) '
+                '-35s %(lineno) -5d: %(message)s')
+LOGGER = logging.getLogger(__name__)
+
+class server_engine:
+    """
+    Class to serve RPC requests from RabbitMQ server using pika. Requests are consumed from a
+    queue and handled on a pool of worker threads, and each reply is published to the reply_to
+    address of its request, with the same correlation id, from the ioloop. Requests are
+    acknowledged once their reply has been published, and at most prefetch_count requests are
+    handled at once.
+
+    :param username: username to login to RabbitMQ server
+    :param password: password for user to login to RabbitMQ server
+    :param host: location of RabbitMQ server
+    :param port: port to connect to RabbitMQ server on host
+    :param vhost: virtual host on RabbitMQ server
+    :param queue: queue to consume requests from
+    :param workers: number of worker threads handling requests
+    :param prefetch_count: maximum number of requests in flight, defaults to twice the number of workers
+    :param connection_options: extra pika.ConnectionParameters arguments, such as a tuning profile from
+                               connection_profiles/connection_profiles.py
+    """
+
+    def __init__(self, username, password, host, port, vhost, queue, workers=4, prefetch_count=None,
+                 connection_options=None):
+        self._username = username
+        self._password = password
+        self._host = host
+        self._port = port
+        self._vhost = vhost
+        self._connection_options = connection_options or {}
+        self._queue = queue
+        self._workers = workers
+        self._prefetch_count = prefetch_count or workers * 2
+        self._pool = None
+        self._channel = None
+        self._connection = None
+
+    def on_open(self, connection):
+        """
+        Method called after connection to RabbitMQ server has been opened. Opens a channel.
+
+        :param connection: connection passed through from server callback
+        """
+
+        print("Reached connection open \n")
+        self._channel = self._connection.channel(on_open_callback=self.on_channel_open)
+
+    def on_channel_open(self, channel):
+        """
+        Method called when the channel is opened. Declares the queue to consume requests from.
+
+        :param channel: channel passed through from server on callback
+        """
+
+        print("Reached channel open \n")
+        self._channel.queue_declare(self._queue, callback=self.on_declare)
+
+    def on_declare(self, method_frame):
+        """
+        Method called when the queue has been declared. Limits the number of requests in flight.
+
+        :param method_frame: method frame passed through from server on callback
+        """
+
+        self._channel.basic_qos(prefetch_count=self._prefetch_count, callback=self.on_qos)
+
+    def on_qos(self, method_frame):
+        """
+        Method called when the prefetch count has been set. Starts consuming requests.
+
+        :param method_frame: method frame passed through from server on callback
+        """
+
+        self._channel.basic_consume(self._queue, self.on_request)
+        print(' [*] Waiting for requests. To exit press CTRL+C')
+
+    def process_request(self, body):
+        """
+        Handles a request on a worker thread and returns the reply body, as bytes or str. Echoes
+        the request, override to do real work. Raising an exception sends an error reply.
+
+        :param body: request body
+        """
+
+        return body
+
+    def on_request(self, channel, basic_deliver, properties, body):
+        """
+        Method called when a request is received. Hands the request to the worker pool, and
+        schedules the reply on the ioloop once the worker has finished.
+
+        :param channel: channel passed through from server on callback
+        :param basic_deliver: message details passed through from server on callback
+        :param properties: message properties passed through from server on callback
+        :param body: message body passed through from server on callback
+        """
+
+        future = self._pool.submit(self.process_request, body)
+        future.add_done_callback(lambda future: self._connection.ioloop.add_callback_threadsafe(
+            functools.partial(self.on_result, basic_deliver, properties, future)))
+
+    def on_result(self, basic_deliver, properties, future):
+        """
+        Method called on the ioloop when a worker has finished a request. Publishes the reply,
+        or an error reply with the x-error header, and acknowledges the request. A reply that is
+        not bytes or str is sent as an error reply. Nothing is sent once the channel has closed,
+        the server redelivers the request.
+
+        :param basic_deliver: message details of the request
+        :param properties: message properties of the request
+        :param future: future of the worker handling the request
+        """
+
+        if self._channel is None or not self._channel.is_open:
+            print("Channel closed, reply to request %i dropped \n" % basic_deliver.delivery_tag)
+            return
+        error = future.exception()
+        result = None if error else future.result()
+        if error is None and not isinstance(result, (bytes, str)):
+            error = TypeError("process_request returned %s, not bytes or str" % type(result).__name__)
+        if properties.reply_to:
+            self._channel.basic_publish(exchange='',
+                                        routing_key=properties.reply_to,
+                                        body=repr(error) if error else result,
+                                        properties=pika.BasicProperties(
+                                            correlation_id=properties.correlation_id,
+                                            headers={'x-error': True} if error else None,
+                                        ))
+        self._channel.basic_ack(basic_deliver.delivery_tag)
+
+    def on_close(self, connection, reply_code):
+        """
+        Method called when the connection to the RabbitMQ server is closed. Stops the ioloop.
+
+        :param connection: connection passed through from server callback
+        :param reply_code: code passed through from server on callback containing shutdown code
+        """
+
+        print(reply_code)
+        print("connection is being closed \n")
+        self._connection.ioloop.stop()
+
+    def run(self):
+        """
+        Set up the asynchronous connection to RabbitMQ server using the credentials used to instantiate this
+        server engine, and start the worker pool.
+        """
+
+        logging.basicConfig(level=logging.ERROR, format=LOG_FORMAT)
+        credentials = pika.PlainCredentials(self._username, self._password)
+        options = {'socket_timeout': 300}
+        options.update(self._connection_options)
+        parameters = pika.ConnectionParameters(self._host, self._port, self._vhost, credentials, **options)
+        self._pool = ThreadPoolExecutor(max_workers=self._workers)
+        self._connection = pika.SelectConnection(parameters, on_open_callback=self.on_open)
+        self._connection.add_on_close_callback(self.on_close)
+
+        try:
+            # Loop so we can communicate with RabbitMQ
+            self._connection.ioloop.start()
+        except KeyboardInterrupt:
+            # Gracefully close the connection
+            self._connection.close()
+            self._connection.ioloop.start()
+        finally:
+            self._pool.shutdown(wait=False)
+
+
+if __name__ == '__main__':
+    engine = server_engine(username='guest', password='guest', host='localhost', port=5672, vhost='/', queue='rpc_queue')
+    engine.run()
@@ -0,0 +1,344 @@
+"""
+Message body serializers, keyed by content_type. A publisher is given a codec, for example:
+
+    publish_engine(..., serializer=SERIALIZERS.get('application/json'))
+
+and sets its content_type on every message, and a consumer is given the registry:
+
+    consume_engine(..., serializers=SERIALIZERS)
+
+and decodes each body from properties.content_type before it is processed. Content types can
+carry parameters, such as the struct layout or the charset. Codecs are built once for each MIME
+type and set of parameters they take, and cached, not rebuilt for every message. Parameters a codec
+does not take are ignored, so they do not make new cache entries, and the cache holds at most
+max_codecs codecs, as content types come from the publishers.
+
+Codecs with encodes_records set encode dictionaries, the records the publishers send. Text, and
+struct layouts without field names, encode other values and cannot be given to a publisher.
+"""
+
+import inspect
+import json
+import struct
+
+class text_codec:
+    """
+    Plain text.
+
+    :param charset: text encoding, UTF-8 when not given
+    """
+
+    encodes_records = False
+
+    def __init__(self, charset='utf-8'):
+        self._charset = charset
+        self.content_type = 'text/plain' if charset == 'utf-8' else 'text/plain; charset=%s' % charset
+
+    def encode(self, value):
+        return value.encode(self._charset)
+
+    def decode(self, body):
+        return bytes(body).decode(self._charset)
+
+class json_codec:
+    """
+    Compact JSON, without whitespace between items.
+
+    :param charset: text encoding, UTF-8 when not given
+    """
+
+    encodes_records = True
+
+    def __init__(self, charset='utf-8'):
+        self._charset = charset
+        self._encoder = json.JSONEncoder(separators=(',', ':'))
+        self._decoder = json.JSONDecoder()
+        self.content_type = 'application/json' if charset == 'utf-8' else 'application/json; charset=%s' % charset
+
+    def encode(self, value):
+        return self._encoder.encode(value).encode(self._charset)
+
+    def decode(self, body):
+        return self._decoder.decode(bytes(body).decode(self._charset))
+
+class struct_codec:
+    """
+    Fixed layout binary records packed with the struct module. The fastest and smallest format for
+    numeric records with a fixed set of fields.
+
+    :param format: struct format string, such as <HHd
+    :param fields: comma separated field names, records are dictionaries with these keys when given,
+                   and tuples otherwise
+    """
+
+    def __init__(self, format, fields=None):
+        self._struct = struct.Struct(format)
+        self._fields = tuple(fields.split(',')) if fields else None
+        self.encodes_records = self._fields is not None
+        self.content_type = 'application/x-struct; format=%s' % format
+        if fields:
+            self.content_type += '; fields=%s' % fields
+
+    def encode(self, value):
+        if self._fields:
+            return self._struct.pack(*[value[field] for field in self._fields])
+        return self._struct.pack(*value)
+
+    def decode(self, body):
+        values = self._struct.unpack(body)
+        if self._fields:
+            return dict(zip(self._fields, values))
+        return values
+
+class msgpack_codec:
+    """
+    Compact, self-describing binary format for None, bool, int, float, str, bytes, list and dict
+    values, laid out as MessagePack so other MessagePack readers can decode it, written with the
+    standard library only.
+    """
+
+    content_type = 'application/x-msgpack'
+    encodes_records = True
+
+    _uint8 = struct.Struct('>B')
+    _uint16 = struct.Struct('>H')
+    _uint32 = struct.Struct('>I')
+    _int64 = struct.Struct('>q')
+    _uint64 = struct.Struct('>Q')
+    _float64 = struct.Struct('>d')
+    # Type codes of fixed size numbers
+    _numbers = {0xcc: _uint8, 0xcd: _uint16, 0xce: _uint32, 0xcf: _uint64,
+                0xd0: struct.Struct('>b'), 0xd1: struct.Struct('>h'), 0xd2: struct.Struct('>i'), 0xd3: _int64,
+                0xca: struct.Struct('>f'), 0xcb: _float64}
+    # Type codes of values preceded by their length
+    _sized = {0xc4: (_uint8, 'bin'), 0xc5: (_uint16, 'bin'), 0xc6: (_uint32, 'bin'),
+              0xd9: (_uint8, 'str'), 0xda: (_uint16, 'str'), 0xdb: (_uint32, 'str'),
+              0xdc: (_uint16, 'array'), 0xdd: (_uint32, 'array'),
+              0xde: (_uint16, 'map'), 0xdf: (_uint32, 'map')}
+
+    def encode(self, value):
+        buffer = bytearray()
+        self.pack(value, buffer)
+        return bytes(buffer)
+
+    def pack(self, value, buffer):
+        """
+        Appends the encoding of a value to the buffer.
+
+        :param value: value to encode
+        :param buffer: bytearray to append to
+        """
+
+        if value is None:
+            buffer.append(0xc0)
+        elif value is True:
+            buffer.append(0xc3)
+        elif value is False:
+            buffer.append(0xc2)
+        elif isinstance(value, int):
+            if 0 <= value < 0x80:
+                buffer.append(value)
+            elif -32 <= value < 0:
+                buffer.append(value & 0xff)
+            elif not -0x8000000000000000 <= value <= 0xffffffffffffffff:
+                raise ValueError("Cannot encode %r, integers must fit in 64 bits" % value)
+            elif value >= 0x8000000000000000:
+                buffer.append(0xcf)
+                buffer += self._uint64.pack(value)
+            else:
+                buffer.append(0xd3)
+                buffer += self._int64.pack(value)
+        elif isinstance(value, float):
+            buffer.append(0xcb)
+            buffer += self._float64.pack(value)
+        elif isinstance(value, str):
+            data = value.encode('utf-8')
+            self.pack_header(len(data), buffer, 0xa0, 32, 0xd9, 0xda, 0xdb)
+            buffer += data
+        elif isinstance(value, (bytes, bytearray, memoryview)):
+            self.pack_header(len(value), buffer, None, 0, 0xc4, 0xc5, 0xc6)
+            buffer += value
+        elif isinstance(value, (list, tuple)):
+            self.pack_header(len(value), buffer, 0x90, 16, None, 0xdc, 0xdd)
+            for item in value:
+                self.pack(item, buffer)
+        elif isinstance(value, dict):
+            self.pack_header(len(value), buffer, 0x80, 16, None, 0xde, 0xdf)
+            for key, item in value.items():
+                self.pack(key, buffer)
+                self.pack(item, buffer)
+        else:
+            raise TypeError("Cannot encode %r" % type(value))
+
+    def pack_header(self, length, buffer, fixed, fixed_limit, code8, code16, code32):
+        """
+        Appends the type and length header of a str, bytes, list or dict value, using the shortest form.
+        """
+
+        if fixed is not None and length < fixed_limit:
+            buffer.append(fixed | length)
+        elif code8 is not None and length < 0x100:
+            buffer.append(code8)
+            buffer.append(length)
+        elif length < 0x10000:
+            buffer.append(code16)
+            buffer += self._uint16.pack(length)
+        else:
+            buffer.append(code32)
+            buffer += self._uint32.pack(length)
+
+    def decode(self, body):
+        value, offset = self.unpack(memoryview(body), 0)
+        return value
+
+    def unpack(self, view, offset):
+        """
+        Decodes the value starting at offset.
+
+        :param view: memoryview of the body
+        :param offset: offset of the value in the body
+        :return: the value, and the offset of the next value
+        """
+
+        code = view[offset]
+        offset += 1
+        if code < 0x80:
+            return code, offset
+        if code >= 0xe0:
+            return code - 0x100, offset
+        if code <= 0x8f:
+            return self.unpack_map(view, offset, code & 0x0f)
+        if code <= 0x9f:
+            return self.unpack_array(view, offset, code & 0x0f)
+        if code <= 0xbf:
+            return self.unpack_str(view, offset, code & 0x1f)
+        if code == 0xc0:
+            return None, offset
+        if code == 0xc2:
+            return False, offset
+        if code == 0xc3:
+            return True, offset
+        if code in self._numbers:
+            packer = self._numbers[code]
+            return packer.unpack_from(view, offset)[0], offset + packer.size
+        if code in self._sized:
+            packer, kind = self._sized[code]
+            length = packer.unpack_from(view, offset)[0]
+            offset += packer.size
+            if kind == 'bin':
+                return bytes(view[offset:offset + length]), offset + length
+            if kind == 'str':
+                return self.unpack_str(view, offset, length)
+            if kind == 'array':
+                return self.unpack_array(view, offset, length)
+            return self.unpack_map(view, offset, length)
+        raise ValueError("Unsupported type code 0x%02x" % code)
+
+    def unpack_str(self, view, offset, length):
+        return str(view[offset:offset + length], 'utf-8'), offset + length
+
+    def unpack_array(self, view, offset, length):
+        items = []
+        for _ in range(length):
+            item, offset = self.unpack(view, offset)
+            items.append(item)
+        return items, offset
+
+    def unpack_map(self, view, offset, length):
+        items = {}
+        for _ in range(length):
+            key, offset = self.unpack(view, offset)
+            items[key], offset = self.unpack(view, offset)
+        return items, offset
+
+class serializer_registry:
+    """
+    Codec factories keyed by MIME type, and a cache of codecs keyed by the MIME type and the
+    parameters the codec takes. The oldest codec is dropped once the cache is full.
+
+    :param max_codecs: maximum number of codecs cached
+    """
+
+    def __init__(self, max_codecs=64):
+        self._factories = {}
+        self._codecs = {}
+        self._max_codecs = max_codecs
+
+    def register(self, mime_type, factory):
+        """
+        Registers a codec factory. The factory is called with the content type parameters it takes
+        as keyword arguments, other parameters are left out.
+
+        :param mime_type: MIME type without parameters, such as application/json
+        :param factory: callable returning a codec with encode, decode and content_type
+        """
+
+        parameters = inspect.signature(factory).parameters.values()
+        if any(parameter.kind == parameter.VAR_KEYWORD for parameter in parameters):
+            accepted = None
+        else:
+            accepted = {parameter.name for parameter in parameters}
+        self._factories[mime_type.lower()] = (factory, accepted)
+        self._codecs = {}
+
+    def get(self, content_type):
+        """
+        Returns the codec for a content type, building it on first use.
+
+        :param content_type: content type, with parameters if the codec takes any
+        :return: codec, or None if no codec is registered for the MIME type
+        :raises ValueError: if the codec cannot be built from the parameters
+        """
+
+        if not content_type:
+            return None
+        mime_type, _, parameters = content_type.partition(';')
+        mime_type = mime_type.strip().lower()
+        factory, accepted = self._factories.get(mime_type, (None, None))
+        if factory is None:
+            return None
+        options = {}
+        for parameter in parameters.split(';'):
+            name, _, value = parameter.partition('=')
+            name = name.strip().lower()
+            if name and (accepted is None or name in accepted):
+                options[name] = value.strip().strip('"')
+
+        key = (mime_type, tuple(sorted(options.items())))
+        codec = self._codecs.get(key)
+        if codec is None:
+            try:
+                codec = factory(**options)
+            except (TypeError, ValueError, struct.error) as error:
+                raise ValueError("Cannot build a codec for %s: %s" %(content_type, error))
+            if len(self._codecs) >= self._max_codecs:
+                del self._codecs[next(iter(self._codecs))]
+            self._codecs[key] = codec
+        return codec
+
+    def encode(self, content_type, value):
+        """
+        Encodes a value with the codec for a content type.
+
+        :param content_type: content type to encode as
+        :param value: value to encode
+        """
+
+        return self.get(content_type).encode(value)
+
+    def decode(self, content_type, body):
+        """
+        Decodes a body by its content type. Bodies without a registered content type are returned as they are.
+
+        :param content_type: content_type property of the message
+        :param body: message body
+        """
+
+        codec = self.get(content_type)
+        return body if codec is None else codec.decode(body)
+
+SERIALIZERS = serializer_registry()
+SERIALIZERS.register('text/plain', text_codec)
+SERIALIZERS.register('application/json', json_codec)
+SERIALIZERS.register('application/x-struct', struct_codec)
+SERIALIZERS.register('application/x-msgpack', msgpack_codec)
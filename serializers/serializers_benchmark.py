@@ -0,0 +1,60 @@
+import time
+from serializers import SERIALIZERS
+
+class benchmark_engine:
+    """
+    Class to compare serializers. For each record and content type, times encoding and decoding
+    the record, and prints the mean time per call and the encoded size, so the format for a
+    stream can be picked by measurement. Needs no RabbitMQ server.
+
+    :param records: dictionary of record name to (record, content types to compare)
+    :param iterations: number of times each record is encoded and decoded
+    """
+
+    def __init__(self, records, iterations=100000):
+        self._records = records
+        self._iterations = iterations
+
+    def time_calls(self, function, argument):
+        """
+        Returns the mean number of nanoseconds a call to function takes.
+
+        :param function: function to time
+        :param argument: argument to call it with
+        """
+
+        started = time.perf_counter_ns()
+        for _ in range(self._iterations):
+            function(argument)
+        return (time.perf_counter_ns() - started) / self._iterations
+
+    def run(self):
+        """
+        Runs every record through every content type listed for it, and prints the results.
+        """
+
+        print("%-10s %-82s %10s %10s %7s" %('record', 'content type', 'encode ns', 'decode ns', 'bytes'))
+        for name, (record, content_types) in self._records.items():
+            for content_type in content_types:
+                codec = SERIALIZERS.get(content_type)
+                body = codec.encode(record)
+                if codec.decode(body) != record:
+                    print("%-10s %-82s does not round trip" %(name, content_type))
+                    continue
+                encode_ns = self.time_calls(codec.encode, record)
+                decode_ns = self.time_calls(codec.decode, body)
+                print("%-10s %-82s %10.0f %10.0f %7i" %(name, content_type, encode_ns, decode_ns, len(body)))
+
+
+if __name__ == '__main__':
+    score = {'home_score': 3, 'away_score': 2, 'period': 3, 'timestamp': 1603090800.25}
+    game = {'sport': 'hockey', 'home': 'Oilers', 'away': 'Flames', 'home_score': 3, 'away_score': 2,
+            'scorers': ['McDavid', 'Draisaitl', 'Gaudreau'], 'final': True}
+    records = {
+        'score': (score, ['application/json', 'application/x-msgpack',
+                          'application/x-struct; format=<HHBd; fields=home_score,away_score,period,timestamp']),
+        'game': (game, ['application/json', 'application/x-msgpack']),
+        'text': ('Oilers 3 | Flames 2 | final', ['text/plain', 'application/json', 'application/x-msgpack']),
+    }
+    engine = benchmark_engine(records)
+    engine.run()
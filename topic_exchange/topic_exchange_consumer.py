@@ -1,6 +1,114 @@
 import pika
+import signal
 import time
 
+class binding_planner:
+    """
+    Plans the bindings for a list of topic subscriptions. Drops every pattern that another pattern
+    already covers, such as scores.hockey next to scores.*, so the queue is bound with the smallest
+    set of patterns that routes the same messages. With generalize_at, patterns that differ only in
+    their last word are replaced by one pattern ending in * once there are that many of them, which
+    routes more messages than were subscribed to, and wanted filters those out locally.
+
+    :param subscriptions: list of topic patterns subscribed to
+    :param generalize_at: number of patterns differing only in their last word that are replaced by a single pattern
+    """
+
+    def __init__(self, subscriptions, generalize_at=None):
+        self.subscriptions = sorted(set(subscriptions))
+        patterns = self.minimize(self.subscriptions)
+        if generalize_at:
+            patterns = self.minimize(self.generalize(patterns, generalize_at))
+        self.patterns = patterns
+        self.exact = patterns == self.minimize(self.subscriptions)
+        self._wanted = {}
+
+    @staticmethod
+    def covers(general, specific):
+        """
+        Returns whether every routing key the specific pattern matches is also matched by the general pattern.
+        A routing key is a pattern without wildcards, so this also tells whether a pattern matches a routing key.
+
+        :param general: topic pattern
+        :param specific: topic pattern or routing key
+        """
+
+        general = general.split('.')
+        specific = specific.split('.')
+        matches = {}
+
+        def match(i, j):
+            if (i, j) not in matches:
+                if i == len(general):
+                    result = j == len(specific)
+                elif general[i] == '#':
+                    # # takes zero words, or one more word (or wildcard) of the specific pattern
+                    result = match(i + 1, j) or (j < len(specific) and match(i, j + 1))
+                elif j == len(specific):
+                    result = False
+                elif general[i] == '*':
+                    # * matches exactly one word, which a # in the specific pattern is not
+                    result = specific[j] != '#' and match(i + 1, j + 1)
+                else:
+                    result = general[i] == specific[j] and match(i + 1, j + 1)
+                matches[(i, j)] = result
+            return matches[(i, j)]
+
+        return match(0, 0)
+
+    def minimize(self, patterns):
+        """
+        Returns the patterns that are not covered by any other pattern. Of patterns that cover each
+        other, such as # and #.#, the shortest is kept.
+
+        :param patterns: list of topic patterns
+        """
+
+        patterns = sorted(set(patterns), key=lambda pattern: (len(pattern), pattern))
+        kept = []
+        for pattern in patterns:
+            if not any(self.covers(other, pattern) for other in kept):
+                kept = [other for other in kept if not self.covers(pattern, other)]
+                kept.append(pattern)
+        return sorted(kept)
+
+    def generalize(self, patterns, generalize_at):
+        """
+        Replaces patterns that differ only in their last word with the common prefix followed by *,
+        once there are generalize_at of them.
+
+        :param patterns: list of topic patterns
+        :param generalize_at: number of sibling patterns to replace
+        """
+
+        siblings = {}
+        for pattern in patterns:
+            prefix, _, last = pattern.rpartition('.')
+            if prefix and last not in ('*', '#'):
+                siblings.setdefault(prefix, []).append(pattern)
+        generalized = set(patterns)
+        for prefix, group in siblings.items():
+            if len(group) >= generalize_at:
+                generalized.difference_update(group)
+                generalized.add(prefix + '.*')
+        return sorted(generalized)
+
+    def wanted(self, routing_key):
+        """
+        Returns whether a routing key matches one of the subscriptions. Always true when no pattern
+        was generalized. Answers are cached per routing key, so this is a dictionary lookup after the
+        first message with each routing key.
+
+        :param routing_key: routing key of a delivered message
+        """
+
+        if self.exact:
+            return True
+        wanted = self._wanted.get(routing_key)
+        if wanted is None:
+            wanted = self._wanted[routing_key] = any(self.covers(pattern, routing_key) for pattern in self.subscriptions)
+        return wanted
+
 class consume_engine:
     """
     Class to consume messages to RabbitMQ server using pika. Consumes messages
@@ -12,31 +120,66 @@ class consume_engine:
     :param port: port to connect to RabbitMQ server on host
     :param vhost: virtual host on RabbitMQ server
     :param exchange_name: exchange name to consume messages from 
-    :param routing_key: routing key 
+    :param routing_key: binding key, or a list of binding keys, which are bound with the smallest set of
+                        patterns covering them
+    :param generalize_at: replace this many binding keys that differ only in their last word with one pattern
+                          ending in *, and filter out the extra messages locally
     :param message_interval: number of seconds to wait between publishing each message
+    :param conflate: only handle the newest message per key when the consumer falls behind
+    :param conflation_key: function of (method, properties, body) returning the key to conflate
+                           messages on, defaults to the routing key of the message
+    :param conflation_window: maximum number of unacknowledged messages to drain per conflation pass
+    :param max_priority: declare the queue with x-max-priority, so higher priority messages are delivered first
+    :param connection_options: extra pika.ConnectionParameters arguments, such as a tuning profile from
+                               connection_profiles/connection_profiles.py
+    :param group: consumer_group from management/management.py, when set the consumer uses the durable queue of the
+                  group, that keeps its messages while the consumer is down and is shared by the consumers
+                  of the group, and acknowledges each message once it has been handled
+    :param tracer: latency_tracer from latency/latency.py, records broker dwell time and handler time per routing key
+    :param drain_timeout: number of seconds to wait for the messages being handled to finish on SIGTERM or SIGINT,
+                          before exiting without acknowledging them
     """
 
-    def __init__(self, username, password, host, port, vhost, exchange, routing_key):
+    def __init__(self, username, password, host, port, vhost, exchange, routing_key,
+                 conflate=False, conflation_key=None, conflation_window=100, max_priority=None,
+                 connection_options=None, group=None, generalize_at=None, tracer=None, drain_timeout=30):
         self._username = username
         self._password = password
         self._host = host
         self._port = port
         self._vhost = vhost
+        self._connection_options = connection_options or {}
         self._routing_key = routing_key
         self._exchange_name = exchange
         self._routing_key = routing_key
+        self._planner = binding_planner([routing_key] if isinstance(routing_key, str) else routing_key, generalize_at)
         self._queue_name = None
         self._connection = None
         self._channel = None
+        self._conflate = conflate
+        self._conflation_key = conflation_key
+        self._conflation_window = conflation_window
+        self._latest_messages = {}
+        self._last_delivery_tag = None
+        self._max_priority = max_priority
+        self._group = group
+        self._tracer = tracer
+        self._drain_timeout = drain_timeout
+        self._draining = False
+        self._frame_state = {}
 
     def make_connection(self):
         """
         Makes a connection to a RabbitMQ server using the credentials and server info 
-        used to instantiate this class.
+        used to instantiate this class. Forgets the keyframes of the previous connection, as deltas
+        missed while disconnected cannot be applied to them.
         """
 
+        self._frame_state = {}
         credentials = pika.PlainCredentials(self._username, self._password)
-        parameters = pika.ConnectionParameters(self._host, self._port, self._vhost, credentials, socket_timeout=300)
+        options = {'socket_timeout': 300}
+        options.update(self._connection_options)
+        parameters = pika.ConnectionParameters(self._host, self._port, self._vhost, credentials, **options)
         self._connection = pika.BlockingConnection(parameters)
         print("Connected successfully...")
 
@@ -57,25 +200,71 @@ class consume_engine:
                          exchange_type='topic')
         print("Exchange declared....")
 
+    def queue_arguments(self):
+        """
+        Returns the arguments to declare the queue with, x-max-priority when max_priority is set, and
+        x-expires for a group queue when the group sets queue_expires.
+        """
+
+        arguments = {}
+        if self._max_priority:
+            arguments['x-max-priority'] = self._max_priority
+        if self._group:
+            arguments.update(self._group.queue_arguments())
+        return arguments or None
+
+    def reconcile_bindings(self, queue_name, binding_keys):
+        """
+        Makes the bindings between the exchange and a group queue match the binding keys. When the
+        group has a management client, only the missing bindings are added, and then the bindings
+        that are no longer asked for are removed, unless another consumer of the group is using the
+        queue. Without one every key is bound, which is idempotent.
+
+        :param queue_name: group queue
+        :param binding_keys: binding keys the queue should have
+        """
+
+        to_bind, to_unbind = self._group.plan_bindings(self._exchange_name, queue_name, binding_keys)
+        for binding_key in to_bind:
+            self._channel.queue_bind(exchange=self._exchange_name, routing_key=binding_key, queue=queue_name)
+        for routing_key, arguments in to_unbind:
+            self._channel.queue_unbind(queue=queue_name, exchange=self._exchange_name,
+                                       routing_key=routing_key, arguments=arguments)
+            print("Removed binding %s from queue: %s" %(routing_key, queue_name))
+        print("Bindings added: %i removed: %i" %(len(to_bind), len(to_unbind)))
+
     def declare_queue(self):
         """
-        Get the name of the queue, which is automatically created by the RabbitMQ server
+        Get the name of the queue, which is automatically created by the RabbitMQ server, or
+        declare the durable group queue when a group is set
         """
 
-        result = self._channel.queue_declare('', exclusive=True)
+        if self._group:
+            self._queue_name = self._group.queue_name(self._exchange_name)
+            result = self._channel.queue_declare(self._queue_name, durable=True, arguments=self.queue_arguments())
+            print("Resuming group queue: %s with %i messages waiting" %(self._queue_name, result.method.message_count))
+            print(' [*] Waiting for messages. To exit press CTRL+C')
+            return
+
+        result = self._channel.queue_declare('', exclusive=True, arguments=self.queue_arguments())
         self._queue_name = result.method.queue
         print("Queue declared....")
         print(' [*] Waiting for messages. To exit press CTRL+C')
 
     def make_binding(self):
         """
-        Bind the queue to the exchange with routing key
+        Bind the queue to the exchange with the planned patterns
         """
 
-        self._channel.queue_bind(exchange=self._exchange_name,
-                                 routing_key=self._routing_key,
-                                 queue=self._queue_name)
-        print("Made binding between exchange: %s and queue: %s" %(self._exchange_name, self._queue_name))
+        if self._group:
+            self.reconcile_bindings(self._queue_name, self._planner.patterns)
+        else:
+            for pattern in self._planner.patterns:
+                self._channel.queue_bind(exchange=self._exchange_name,
+                                         routing_key=pattern,
+                                         queue=self._queue_name)
+        print("Made binding between exchange: %s and queue: %s with %i patterns for %i subscriptions" %(
+            self._exchange_name, self._queue_name, len(self._planner.patterns), len(self._planner.subscriptions)))
 
     def on_message(self, channel, method, properties, body):
         """
@@ -90,19 +279,208 @@ class consume_engine:
         print(" [x] Feed Received - %s \n" % str(body))
         time.sleep(2)
 
+    def handle_message(self, channel, method, properties, body):
+        """
+        Passes a message to on_message, through the tracer when one is set.
+
+        :param channel: channel passed through from server on callback
+        :param method: message details passed through from server on callback
+        :param properties: message properties passed through from server on callback
+        :param body: message body passed through from server on callback
+        """
+
+        if self._tracer is None:
+            self.on_message(channel, method, properties, body)
+        else:
+            self._tracer.handle(self.on_message, channel, method, properties, body)
+
+    def rebuild_message(self, method, properties, body):
+        """
+        Rebuilds the full score from a delta encoded message. Keyframes replace the stored fields
+        for the routing key, and deltas of 'index=field' pairs are applied on top of them. Messages
+        published without delta encoding are returned unchanged.
+
+        :param method: message details passed through from server on callback
+        :param properties: message properties passed through from server on callback
+        :param body: message body passed through from server on callback
+        :return: full message body, or None if a delta arrives before any keyframe
+        """
+
+        frame = (properties.headers or {}).get('x-frame')
+        if frame is None:
+            return body
+
+        if frame == 'keyframe':
+            self._frame_state[method.routing_key] = body.decode().split(' | ')
+            return body
+
+        fields = self._frame_state.get(method.routing_key)
+        if fields is None:
+            print(" [x] Waiting for keyframe on %s \n" % method.routing_key)
+            return None
+        if body:
+            for change in body.decode().split(' | '):
+                index, field = change.split('=', 1)
+                fields[int(index)] = field
+        return ' | '.join(fields).encode()
+
+    def on_delivery(self, channel, method, properties, body):
+        """
+        Called when a message is received. Rebuilds delta encoded scores before passing them to on_message.
+
+        :param channel: channel passed through from server on callback
+        :param method: message details passed through from server on callback
+        :param properties: message properties passed through from server on callback
+        :param body: message body passed through from server on callback
+        """
+
+        if not self._planner.wanted(method.routing_key):
+            return
+        body = self.rebuild_message(method, properties, body)
+        if body is not None:
+            self.handle_message(channel, method, properties, body)
+
+    def on_conflated_message(self, channel, method, properties, body):
+        """
+        Called when a message is received in conflation mode. Keeps only the newest message
+        for each conflation key, the older message for that key is superseded and will be
+        acknowledged when the pending messages are flushed.
+
+        :param channel: channel passed through from server on callback
+        :param method: message details passed through from server on callback
+        :param properties: message properties passed through from server on callback
+        :param body: message body passed through from server on callback
+        """
+
+        self._last_delivery_tag = method.delivery_tag
+        if not self._planner.wanted(method.routing_key):
+            return
+        body = self.rebuild_message(method, properties, body)
+        if body is None:
+            return
+
+        if self._conflation_key:
+            key = self._conflation_key(method, properties, body)
+        else:
+            key = method.routing_key
+        self._latest_messages[key] = (method, properties, body)
+
+    def flush_conflated(self):
+        """
+        Hands the newest message for each key to on_message, then acknowledges every drained
+        message, including the superseded ones, with a single multiple acknowledgement.
+        """
+
+        if self._last_delivery_tag is None:
+            return
+
+        latest_messages = self._latest_messages
+        last_delivery_tag = self._last_delivery_tag
+        self._latest_messages = {}
+        self._last_delivery_tag = None
+
+        for method, properties, body in latest_messages.values():
+            self.handle_message(self._channel, method, properties, body)
+        self._channel.basic_ack(delivery_tag=last_delivery_tag, multiple=True)
+
+    def consume_conflated(self):
+        """
+        Consumes messages in conflation mode. Waits for at least one message, drains everything
+        else already delivered up to the conflation window, and then flushes the newest message
+        per key, so catching up after a stall takes one pass instead of one pass per message.
+        """
+
+        self._channel.basic_qos(prefetch_count=self._conflation_window)
+        self._channel.basic_consume(self._queue_name, self.on_conflated_message)
+        while self._channel.is_open and not self._draining:
+            self._connection.process_data_events(time_limit=None)
+            self._connection.process_data_events(time_limit=0)
+            self.flush_conflated()
+
+    def on_acked_message(self, channel, method, properties, body):
+        """
+        Called when a message is received on a queue consumed with manual acknowledgements.
+        Handles the message, and then acknowledges it so the next message can be delivered.
+
+        :param channel: channel passed through from server on callback
+        :param method: message details passed through from server on callback
+        :param properties: message properties passed through from server on callback
+        :param body: message body passed through from server on callback
+        """
+
+        self.on_delivery(channel, method, properties, body)
+        channel.basic_ack(delivery_tag=method.delivery_tag)
+
     def consume_messages(self):
         """
         Consumes all messages that are sent to the specific Direct Exchange on the RabbitMQ server
         """
 
-        self._channel.basic_consume(self._queue_name, self.on_message,
+        if self._conflate:
+            self.consume_conflated()
+            return
+
+        if self._max_priority or self._group:
+            # Priorities only reorder messages waiting in the queue, so keep one in flight, and
+            # acknowledge group queue messages once handled so none are lost on a restart
+            self._channel.basic_qos(prefetch_count=1)
+            self._channel.basic_consume(self._queue_name, self.on_acked_message)
+            self._channel.start_consuming()
+            return
+
+        self._channel.basic_consume(self._queue_name, self.on_delivery,
                                     auto_ack=True)
         self._channel.start_consuming()
 
+    def on_shutdown_signal(self, signum, frame):
+        """
+        Signal handler for SIGTERM and SIGINT. The first signal starts draining, the message being
+        handled is finished before consuming stops, and the process exits if draining takes longer
+        than drain_timeout. A second signal exits straight away.
+
+        :param signum: signal number
+        :param frame: stack frame the signal interrupted
+        """
+
+        if self._draining:
+            raise SystemExit("Exiting without draining")
+        print("Draining, send the signal again to exit straight away")
+        self._draining = True
+        if hasattr(signal, 'SIGALRM'):
+            signal.signal(signal.SIGALRM, self.on_drain_timeout)
+            signal.setitimer(signal.ITIMER_REAL, self._drain_timeout)
+        self._connection.add_callback_threadsafe(self._channel.stop_consuming)
+
+    def on_drain_timeout(self, signum, frame):
+        """
+        Signal handler for the drain timer. Exits without waiting any longer, unacknowledged
+        messages are redelivered by the server.
+
+        :param signum: signal number
+        :param frame: stack frame the signal interrupted
+        """
+
+        raise SystemExit("Draining took longer than %s seconds, exiting" % self._drain_timeout)
+
+    def drain(self):
+        """
+        Finishes shutting down after consuming has stopped. Hands on and acknowledges the messages
+        held for conflation, and closes the connection.
+        """
+
+        if self._channel.is_open:
+            self._channel.stop_consuming()
+            self.flush_conflated()
+        self._connection.close()
+        if hasattr(signal, 'SIGALRM'):
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        print("Drained and closed connection....")
+
     def run(self):
         """
         Method to run consumer. Makes connection to RabbitMQ server, creates channel,
         binds queue and exchange with routing key, consumes messages from queue.
+        Drains on SIGTERM or SIGINT.
         """
 
         self.make_connection()
@@ -110,7 +488,11 @@ class consume_engine:
         self.declare_exchange()
         self.declare_queue()
         self.make_binding()
+        signal.signal(signal.SIGTERM, self.on_shutdown_signal)
+        signal.signal(signal.SIGINT, self.on_shutdown_signal)
         self.consume_messages()
+        if self._draining:
+            self.drain()
 
 if __name__ == '__main__':
     # routing keys: scores.curling, scores.hockey, scores.football
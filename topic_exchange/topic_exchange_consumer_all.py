@@ -1,5 +1,84 @@
 import pika
+import signal
 import time
+from topic_exchange_consumer import binding_planner
+
+# numpy is optional, and only needed for columnar=True
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+class score_batch_decoder:
+    """
+    Decodes batches of score messages into NumPy column arrays, with one row per team score.
+    Routing keys and team names are replaced by integer codes, which stay the same across
+    batches, so per team aggregations are vectorized over the columns.
+    """
+
+    def __init__(self):
+        if np is None:
+            raise ImportError("columnar=True needs numpy to decode score batches into columns, install it with: pipenv install numpy")
+        self.routing_keys = {}
+        self.teams = {}
+
+    def decode(self, messages):
+        """
+        Returns the scores in a batch of messages as a dictionary of column arrays: routing_key
+        and team codes, score, and timestamp in nanoseconds since the epoch. The timestamp is
+        the x-published-ns header, or the timestamp property when the header is not set.
+
+        :param messages: list of (method, properties, body) tuples
+        """
+
+        routing_keys = []
+        teams = []
+        scores = []
+        timestamps = []
+        for method, properties, body in messages:
+            routing_key = self.routing_keys.setdefault(method.routing_key, len(self.routing_keys))
+            timestamp = (properties.headers or {}).get('x-published-ns') or (properties.timestamp or 0) * 1000000000
+            home_team = None
+            for field in body.split(b' | ')[1:]:
+                name, separator, value = field.rpartition(b' : ')
+                if not separator:
+                    continue
+                value = value.strip()
+                if name == b'Home Team':
+                    home_team = value
+                elif value.isdigit():
+                    team = home_team if name == b'Score' and home_team else name
+                    routing_keys.append(routing_key)
+                    teams.append(self.teams.setdefault(team.decode(), len(self.teams)))
+                    scores.append(int(value))
+                    timestamps.append(timestamp)
+
+        return {'routing_key': np.array(routing_keys, dtype=np.int32),
+                'team': np.array(teams, dtype=np.int32),
+                'score': np.array(scores, dtype=np.int64),
+                'timestamp': np.array(timestamps, dtype=np.int64)}
+
+    def score_rates(self, columns):
+        """
+        Returns the rate of change of the score in points per second for each team in the columns,
+        from its first and last score in the batch, as arrays of team codes and rates.
+
+        :param columns: columns returned by decode
+        """
+
+        order = np.lexsort((columns['timestamp'], columns['team']))
+        teams = columns['team'][order]
+        scores = columns['score'][order]
+        timestamps = columns['timestamp'][order]
+        if not len(teams):
+            return teams, np.zeros(0)
+
+        team_codes, first = np.unique(teams, return_index=True)
+        last = np.append(first[1:] - 1, len(teams) - 1)
+        elapsed = (timestamps[last] - timestamps[first]) / 1e9
+        change = (scores[last] - scores[first]).astype(np.float64)
+        rates = np.divide(change, elapsed, out=np.zeros_like(change), where=elapsed > 0)
+        return team_codes, rates
 
 class consume_engine:
     """
@@ -12,31 +91,83 @@ class consume_engine:
     :param port: port to connect to RabbitMQ server on host
     :param vhost: virtual host on RabbitMQ server
     :param exchange_name: exchange name to consume messages from 
-    :param routing_key: routing key 
+    :param routing_key: binding key, or a list of binding keys, which are bound with the smallest set of
+                        patterns covering them
+    :param generalize_at: replace this many binding keys, of the queue or of a lane, that differ only in their
+                          last word with one pattern ending in *, and filter out the extra messages locally
     :param message_interval: number of seconds to wait between publishing each message
+    :param conflate: only handle the newest message per key when the consumer falls behind
+    :param conflation_key: function of (method, properties, body) returning the key to conflate
+                           messages on, defaults to the routing key of the message
+    :param conflation_window: maximum number of unacknowledged messages to drain per conflation pass
+    :param max_priority: declare the queue with x-max-priority, so higher priority messages are delivered first
+    :param lanes: dictionary of lane name to (binding keys, prefetch count), each lane is consumed from
+                  its own queue with its own prefetch, so a burst on one lane does not delay another
+    :param tracer: latency_tracer from latency/latency.py, records broker dwell time and handler time per routing key
+    :param batch_size: maximum number of messages passed to on_batch at once, messages are passed
+                       to on_message one at a time when not set
+    :param batch_wait: maximum number of milliseconds to wait for a batch to fill before passing it to on_batch
+    :param columnar: decode batches into NumPy columns and print per team rates, requires numpy
+    :param connection_options: extra pika.ConnectionParameters arguments, such as a tuning profile from
+                               connection_profiles/connection_profiles.py
+    :param group: consumer_group from management/management.py, when set the consumer uses the durable queue of the
+                  group, that keeps its messages while the consumer is down and is shared by the consumers
+                  of the group, and acknowledges each message once it has been handled
+    :param drain_timeout: number of seconds to wait for the messages being handled to finish on SIGTERM or SIGINT,
+                          before exiting without acknowledging them
     """
 
-    def __init__(self, username, password, host, port, vhost, exchange, routing_key):
+    def __init__(self, username, password, host, port, vhost, exchange, routing_key,
+                 conflate=False, conflation_key=None, conflation_window=100, max_priority=None, lanes=None,
+                 tracer=None, batch_size=None, batch_wait=100, columnar=False,
+                 connection_options=None, group=None, generalize_at=None, drain_timeout=30):
         self._username = username
         self._password = password
         self._host = host
         self._port = port
         self._vhost = vhost
+        self._connection_options = connection_options or {}
         self._routing_key = routing_key
         self._exchange_name = exchange
         self._routing_key = routing_key
         self._queue_name = None
         self._connection = None
         self._channel = None
+        self._conflate = conflate
+        self._conflation_key = conflation_key
+        self._conflation_window = conflation_window
+        self._latest_messages = {}
+        self._last_delivery_tag = None
+        self._max_priority = max_priority
+        self._group = group
+        self._lanes = lanes
+        self._lane_queues = {}
+        self._planner = binding_planner([routing_key] if isinstance(routing_key, str) else routing_key, generalize_at)
+        self._lane_planners = dict((lane, binding_planner(binding_keys, generalize_at))
+                                   for lane, (binding_keys, prefetch_count) in (lanes or {}).items())
+        self._consumer_planners = {}
+        self._frame_state = {}
+        self._tracer = tracer
+        self._drain_timeout = drain_timeout
+        self._draining = False
+        self._batch_size = batch_size
+        self._batch_wait = batch_wait
+        self._batch = []
+        self._batch_started = None
+        self._decoder = score_batch_decoder() if columnar else None
 
     def make_connection(self):
         """
         Makes a connection to a RabbitMQ server using the credentials and server info 
-        used to instantiate this class.
+        used to instantiate this class. Forgets the keyframes of the previous connection, as deltas
+        missed while disconnected cannot be applied to them.
         """
 
+        self._frame_state = {}
         credentials = pika.PlainCredentials(self._username, self._password)
-        parameters = pika.ConnectionParameters(self._host, self._port, self._vhost, credentials, socket_timeout=300)
+        options = {'socket_timeout': 300}
+        options.update(self._connection_options)
+        parameters = pika.ConnectionParameters(self._host, self._port, self._vhost, credentials, **options)
         self._connection = pika.BlockingConnection(parameters)
         print("Connected successfully...")
 
@@ -57,24 +188,111 @@ class consume_engine:
                          exchange_type='topic')
         print("Exchange declared....")
 
+    def queue_arguments(self):
+        """
+        Returns the arguments to declare the queue with, x-max-priority when max_priority is set, and
+        x-expires for a group queue when the group sets queue_expires.
+        """
+
+        arguments = {}
+        if self._max_priority:
+            arguments['x-max-priority'] = self._max_priority
+        if self._group:
+            arguments.update(self._group.queue_arguments())
+        return arguments or None
+
+    def reconcile_bindings(self, queue_name, binding_keys):
+        """
+        Makes the bindings between the exchange and a group queue match the binding keys. When the
+        group has a management client, only the missing bindings are added, and then the bindings
+        that are no longer asked for are removed, unless another consumer of the group is using the
+        queue. Without one every key is bound, which is idempotent.
+
+        :param queue_name: group queue
+        :param binding_keys: binding keys the queue should have
+        """
+
+        to_bind, to_unbind = self._group.plan_bindings(self._exchange_name, queue_name, binding_keys)
+        for binding_key in to_bind:
+            self._channel.queue_bind(exchange=self._exchange_name, routing_key=binding_key, queue=queue_name)
+        for routing_key, arguments in to_unbind:
+            self._channel.queue_unbind(queue=queue_name, exchange=self._exchange_name,
+                                       routing_key=routing_key, arguments=arguments)
+            print("Removed binding %s from queue: %s" %(routing_key, queue_name))
+
     def declare_queue(self):
         """
-        Get the name of the queue, which is automatically created by the RabbitMQ server
+        Get the name of the queue, which is automatically created by the RabbitMQ server, or
+        declare the durable group queue when a group is set
         """
-        result = self._channel.queue_declare('', exclusive=True)
+        if self._lanes:
+            self.declare_lanes()
+            return
+
+        if self._group:
+            self._queue_name = self._group.queue_name(self._exchange_name)
+            result = self._channel.queue_declare(self._queue_name, durable=True, arguments=self.queue_arguments())
+            print("Resuming group queue: %s with %i messages waiting" %(self._queue_name, result.method.message_count))
+            print(' [*] Waiting for messages. To exit press CTRL+C')
+            return
+
+        result = self._channel.queue_declare('', exclusive=True, arguments=self.queue_arguments())
         self._queue_name = result.method.queue
         print("Queue declared....")
         print(' [*] Waiting for messages. To exit press CTRL+C')
 
+    def declare_lanes(self):
+        """
+        Declares an automatically named queue for each lane, or a durable group queue per lane when
+        a group is set, and binds it to the exchange with the binding keys of that lane.
+        """
+
+        for lane in self._lanes:
+            patterns = self._lane_planners[lane].patterns
+            if self._group:
+                result = self._channel.queue_declare(self._group.queue_name(self._exchange_name, lane), durable=True,
+                                                     arguments=self.queue_arguments())
+                self._lane_queues[lane] = result.method.queue
+                self.reconcile_bindings(result.method.queue, patterns)
+                continue
+            result = self._channel.queue_declare('', exclusive=True, arguments=self.queue_arguments())
+            self._lane_queues[lane] = result.method.queue
+            for pattern in patterns:
+                self._channel.queue_bind(exchange=self._exchange_name,
+                                         routing_key=pattern,
+                                         queue=result.method.queue)
+            print("Declared %s lane queue: %s with bindings: %s" %(lane, result.method.queue, ', '.join(patterns)))
+        print(' [*] Waiting for messages. To exit press CTRL+C')
+
     def make_binding(self):
         """
-        Bind the queue to the exchange with routing key
+        Bind the queue to the exchange with the planned patterns
+        """
+
+        if self._lanes:
+            return
+
+        if self._group:
+            self.reconcile_bindings(self._queue_name, self._planner.patterns)
+        else:
+            for pattern in self._planner.patterns:
+                self._channel.queue_bind(exchange=self._exchange_name,
+                                         routing_key=pattern,
+                                         queue=self._queue_name)
+        print("Made binding between exchange: %s and queue: %s with %i patterns for %i subscriptions" %(
+            self._exchange_name, self._queue_name, len(self._planner.patterns), len(self._planner.subscriptions)))
+
+    def wanted(self, method):
+        """
+        Returns whether a message matches the subscriptions of the queue it was delivered from, the
+        lane consumed by its consumer tag, or the queue of this consumer otherwise. Messages that only
+        match a generalized pattern are not wanted.
+
+        :param method: message details passed through from server on callback
         """
 
-        self._channel.queue_bind(exchange=self._exchange_name,
-                                 routing_key=self._routing_key,
-                                 queue=self._queue_name)
-        print("Made binding between exchange: %s and queue: %s" %(self._exchange_name, self._queue_name))
+        planner = self._consumer_planners.get(method.consumer_tag, self._planner)
+        return planner.wanted(method.routing_key)
 
     def on_message(self, channel, method, properties, body):
         """
@@ -89,19 +307,307 @@ class consume_engine:
         print(" [x] Feed Received - %s \n" % str(body))
         time.sleep(2)
 
+    def rebuild_message(self, method, properties, body):
+        """
+        Rebuilds the full score from a delta encoded message. Keyframes replace the stored fields
+        for the routing key, and deltas of 'index=field' pairs are applied on top of them. Messages
+        published without delta encoding are returned unchanged.
+
+        :param method: message details passed through from server on callback
+        :param properties: message properties passed through from server on callback
+        :param body: message body passed through from server on callback
+        :return: full message body, or None if a delta arrives before any keyframe
+        """
+
+        frame = (properties.headers or {}).get('x-frame')
+        if frame is None:
+            return body
+
+        if frame == 'keyframe':
+            self._frame_state[method.routing_key] = body.decode().split(' | ')
+            return body
+
+        fields = self._frame_state.get(method.routing_key)
+        if fields is None:
+            print(" [x] Waiting for keyframe on %s \n" % method.routing_key)
+            return None
+        if body:
+            for change in body.decode().split(' | '):
+                index, field = change.split('=', 1)
+                fields[int(index)] = field
+        return ' | '.join(fields).encode()
+
+    def on_delivery(self, channel, method, properties, body):
+        """
+        Called when a message is received. Rebuilds delta encoded scores before passing them to on_message.
+
+        :param channel: channel passed through from server on callback
+        :param method: message details passed through from server on callback
+        :param properties: message properties passed through from server on callback
+        :param body: message body passed through from server on callback
+        """
+
+        if not self.wanted(method):
+            return
+        body = self.rebuild_message(method, properties, body)
+        if body is not None:
+            self.handle_message(channel, method, properties, body)
+
+    def handle_message(self, channel, method, properties, body):
+        """
+        Passes a message to on_message, through the tracer when one is set, which records the time
+        between publish and arrival, spent in the network and the broker, and the time spent in
+        on_message.
+
+        :param channel: channel passed through from server on callback
+        :param method: message details passed through from server on callback
+        :param properties: message properties passed through from server on callback
+        :param body: message body passed through from server on callback
+        """
+
+        if self._tracer is None:
+            self.on_message(channel, method, properties, body)
+        else:
+            self._tracer.handle(self.on_message, channel, method, properties, body)
+
+    def on_conflated_message(self, channel, method, properties, body):
+        """
+        Called when a message is received in conflation mode. Keeps only the newest message
+        for each conflation key, the older message for that key is superseded and will be
+        acknowledged when the pending messages are flushed.
+
+        :param channel: channel passed through from server on callback
+        :param method: message details passed through from server on callback
+        :param properties: message properties passed through from server on callback
+        :param body: message body passed through from server on callback
+        """
+
+        self._last_delivery_tag = method.delivery_tag
+        if not self.wanted(method):
+            return
+        body = self.rebuild_message(method, properties, body)
+        if body is None:
+            return
+
+        if self._conflation_key:
+            key = self._conflation_key(method, properties, body)
+        else:
+            key = method.routing_key
+        self._latest_messages[key] = (method, properties, body)
+
+    def flush_conflated(self):
+        """
+        Hands the newest message for each key to on_message, then acknowledges every drained
+        message, including the superseded ones, with a single multiple acknowledgement.
+        """
+
+        if self._last_delivery_tag is None:
+            return
+
+        latest_messages = self._latest_messages
+        last_delivery_tag = self._last_delivery_tag
+        self._latest_messages = {}
+        self._last_delivery_tag = None
+
+        for method, properties, body in latest_messages.values():
+            self.handle_message(self._channel, method, properties, body)
+        self._channel.basic_ack(delivery_tag=last_delivery_tag, multiple=True)
+
+    def consume_conflated(self):
+        """
+        Consumes messages in conflation mode. Waits for at least one message, drains everything
+        else already delivered up to the conflation window, and then flushes the newest message
+        per key, so catching up after a stall takes one pass instead of one pass per message.
+        """
+
+        self._channel.basic_qos(prefetch_count=self._conflation_window)
+        self._channel.basic_consume(self._queue_name, self.on_conflated_message)
+        while self._channel.is_open and not self._draining:
+            self._connection.process_data_events(time_limit=None)
+            self._connection.process_data_events(time_limit=0)
+            self.flush_conflated()
+
+    def on_acked_message(self, channel, method, properties, body):
+        """
+        Called when a message is received on a queue consumed with manual acknowledgements.
+        Handles the message, and then acknowledges it so the next message can be delivered.
+
+        :param channel: channel passed through from server on callback
+        :param method: message details passed through from server on callback
+        :param properties: message properties passed through from server on callback
+        :param body: message body passed through from server on callback
+        """
+
+        self.on_delivery(channel, method, properties, body)
+        channel.basic_ack(delivery_tag=method.delivery_tag)
+
+    def consume_lanes(self):
+        """
+        Consumes every lane queue on the same channel. The prefetch count is set before each
+        consumer is registered, so it applies to that lane only, and lanes with a larger
+        prefetch get a larger share of deliveries.
+        """
+
+        for lane, (binding_keys, prefetch_count) in self._lanes.items():
+            self._channel.basic_qos(prefetch_count=prefetch_count)
+            consumer_tag = self._channel.basic_consume(self._lane_queues[lane], self.on_acked_message)
+            self._consumer_planners[consumer_tag] = self._lane_planners[lane]
+        self._channel.start_consuming()
+
+    def on_batch(self, messages):
+        """
+        Called with a batch of messages. Passes each message to on_message, or in columnar mode
+        decodes the batch into columns and prints the aggregations for it.
+
+        :param messages: list of (method, properties, body) tuples
+        """
+
+        if self._decoder is None:
+            for method, properties, body in messages:
+                self.handle_message(self._channel, method, properties, body)
+            return
+
+        columns = self._decoder.decode(messages)
+        team_names = dict((code, team) for team, code in self._decoder.teams.items())
+        for team, rate in zip(*self._decoder.score_rates(columns)):
+            print(" [x] %s rate: %.3f points/s" %(team_names[team], rate))
+
+    def on_batch_message(self, channel, method, properties, body):
+        """
+        Called when a message is received in batch mode. Rebuilds delta encoded scores, and adds
+        the message to the current batch.
+
+        :param channel: channel passed through from server on callback
+        :param method: message details passed through from server on callback
+        :param properties: message properties passed through from server on callback
+        :param body: message body passed through from server on callback
+        """
+
+        if not self._batch:
+            self._batch_started = time.monotonic()
+        self._last_delivery_tag = method.delivery_tag
+        if not self.wanted(method):
+            return
+        body = self.rebuild_message(method, properties, body)
+        if body is not None:
+            self._batch.append((method, properties, body))
+
+    def flush_batch(self):
+        """
+        Passes the current batch to on_batch, and acknowledges it with a single multiple acknowledgement.
+        """
+
+        messages = self._batch
+        last_delivery_tag = self._last_delivery_tag
+        self._batch = []
+        self._batch_started = None
+        self._last_delivery_tag = None
+        if messages:
+            self.on_batch(messages)
+        if last_delivery_tag is not None:
+            self._channel.basic_ack(delivery_tag=last_delivery_tag, multiple=True)
+
+    def consume_batches(self):
+        """
+        Consumes messages in batches. A batch is passed to on_batch once it holds batch_size
+        messages, or batch_wait milliseconds after its first message arrived, whichever is first.
+        """
+
+        self._channel.basic_qos(prefetch_count=self._batch_size)
+        self._channel.basic_consume(self._queue_name, self.on_batch_message)
+        while self._channel.is_open and not self._draining:
+            if self._batch_started is None:
+                self._connection.process_data_events(time_limit=None)
+                continue
+
+            remaining = self._batch_started + self._batch_wait / 1000.0 - time.monotonic()
+            if len(self._batch) >= self._batch_size or remaining <= 0:
+                self.flush_batch()
+            else:
+                self._connection.process_data_events(time_limit=remaining)
+
     def consume_messages(self):
         """
         Consumes all messages that are sent to the specific Direct Exchange on the RabbitMQ server
         """
 
-        self._channel.basic_consume(self._queue_name, self.on_message,
+        if self._lanes:
+            self.consume_lanes()
+            return
+
+        if self._conflate:
+            self.consume_conflated()
+            return
+
+        if self._batch_size:
+            self.consume_batches()
+            return
+
+        if self._max_priority or self._group:
+            # Priorities only reorder messages waiting in the queue, so keep one in flight, and
+            # acknowledge group queue messages once handled so none are lost on a restart
+            self._channel.basic_qos(prefetch_count=1)
+            self._channel.basic_consume(self._queue_name, self.on_acked_message)
+            self._channel.start_consuming()
+            return
+
+        self._channel.basic_consume(self._queue_name, self.on_delivery,
                                     auto_ack=True)
         self._channel.start_consuming()
 
+    def on_shutdown_signal(self, signum, frame):
+        """
+        Signal handler for SIGTERM and SIGINT. The first signal starts draining, the message being
+        handled is finished before consuming stops, and the process exits if draining takes longer
+        than drain_timeout. A second signal exits straight away.
+
+        :param signum: signal number
+        :param frame: stack frame the signal interrupted
+        """
+
+        if self._draining:
+            raise SystemExit("Exiting without draining")
+        print("Draining, send the signal again to exit straight away")
+        self._draining = True
+        if hasattr(signal, 'SIGALRM'):
+            signal.signal(signal.SIGALRM, self.on_drain_timeout)
+            signal.setitimer(signal.ITIMER_REAL, self._drain_timeout)
+        self._connection.add_callback_threadsafe(self._channel.stop_consuming)
+
+    def on_drain_timeout(self, signum, frame):
+        """
+        Signal handler for the drain timer. Exits without waiting any longer, unacknowledged
+        messages are redelivered by the server.
+
+        :param signum: signal number
+        :param frame: stack frame the signal interrupted
+        """
+
+        raise SystemExit("Draining took longer than %s seconds, exiting" % self._drain_timeout)
+
+    def drain(self):
+        """
+        Finishes shutting down after consuming has stopped. Hands on and acknowledges the messages
+        held for conflation or batching, and closes the connection.
+        """
+
+        if self._channel.is_open:
+            self._channel.stop_consuming()
+            # Lane messages are acknowledged one at a time as they are handled
+            if self._conflate and not self._lanes:
+                self.flush_conflated()
+            elif self._batch_size and not self._lanes:
+                self.flush_batch()
+        self._connection.close()
+        if hasattr(signal, 'SIGALRM'):
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        print("Drained and closed connection....")
+
     def run(self):
         """
         Method to run consumer. Makes connection to RabbitMQ server, creates channel,
         binds queue and exchange with routing key, consumes messages from queue.
+        Drains on SIGTERM or SIGINT.
         """
 
         self.make_connection()
@@ -109,7 +615,11 @@ class consume_engine:
         self.declare_exchange()
         self.declare_queue()
         self.make_binding()
+        signal.signal(signal.SIGTERM, self.on_shutdown_signal)
+        signal.signal(signal.SIGINT, self.on_shutdown_signal)
         self.consume_messages()
+        if self._draining:
+            self.drain()
 
 if __name__ == '__main__':
     engine = consume_engine(username='guest', password='guest', host='localhost', port=5672, vhost='/', exchange='score.feed.topic', routing_key='scores.#')
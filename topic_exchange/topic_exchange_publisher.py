@@ -19,20 +19,41 @@ class publish_engine:
     :param routing_key_curling: routing key
     :param routing_key_hockey: routing key
     :param routing_key_football: routing key
+    :param priorities: dictionary of routing key to message priority, for queues declared with x-max-priority
+    :param change_only: do not publish a score that is unchanged since the last score for that routing key
+    :param delta_encoding: only publish the fields of a score that changed, against a periodic keyframe
+    :param keyframe_interval: number of messages per routing key between full keyframes when delta encoding
+    :param connection_options: extra pika.ConnectionParameters arguments, such as a tuning profile from
+                               connection_profiles/connection_profiles.py
+    :param tracer: latency_tracer from latency/latency.py, when set every message carries the x-published-ns
+                   and x-trace-id headers, so consumers can measure publish to handle latency
+    :param blocked: blocked_monitor from flow_control/flow_control.py, pauses or stops publishing while the server
+                    blocks the connection under memory or disk pressure
     """
 
-    def __init__(self, username, password, host, port, vhost, exchange, number_of_messages, message_interval, routing_key_curling, routing_key_hockey, routing_key_football):
+    def __init__(self, username, password, host, port, vhost, exchange, number_of_messages, message_interval, routing_key_curling, routing_key_hockey, routing_key_football,
+                 change_only=False, delta_encoding=False, keyframe_interval=10, priorities=None,
+                 connection_options=None, tracer=None, blocked=None):
         self._username = username
         self._password = password
         self._host = host
         self._port = port
         self._vhost = vhost
+        self._connection_options = connection_options or {}
+        self._tracer = tracer
         self._messages = number_of_messages
         self._message_interval = message_interval
         self._exchange_name = exchange
         self._routing_key_curling = routing_key_curling
         self._routing_key_hockey = routing_key_hockey
         self._routing_key_football = routing_key_football
+        self._change_only = change_only
+        self._delta_encoding = delta_encoding
+        self._keyframe_interval = keyframe_interval
+        self._last_values = {}
+        self._frames_since_keyframe = {}
+        self._priorities = priorities or {}
+        self._blocked = blocked
         self._connection = None
         self._channel = None
 
@@ -43,8 +64,14 @@ class publish_engine:
         """
 
         credentials = pika.PlainCredentials(self._username, self._password)
-        parameters = pika.ConnectionParameters(self._host, self._port, self._vhost, credentials, socket_timeout=300)
+        options = {'socket_timeout': 300}
+        options.update(self._connection_options)
+        if self._blocked:
+            options.update(self._blocked.connection_options())
+        parameters = pika.ConnectionParameters(self._host, self._port, self._vhost, credentials, **options)
         self._connection = pika.BlockingConnection(parameters)
+        if self._blocked:
+            self._blocked.watch(self._connection)
         print("Connected successfully...")
 
     def open_channel(self):
@@ -64,6 +91,56 @@ class publish_engine:
                          exchange_type='topic')
         print("Exchange declared....")
 
+    def publish_score(self, routing_key, message_body):
+        """
+        Publishes a score to the Topic Exchange. A score is split into fields on ' | ', and the
+        last fields published for each routing key are cached. With change_only set, a score
+        identical to the cached one is not published. With delta_encoding set, only the changed
+        fields are published as 'index=field' pairs, with a full keyframe for the first score,
+        when the number of fields changes, and every keyframe_interval messages. The cache is only
+        updated once the message has been published, so a publish that fails while the connection is
+        blocked does not become the base of the next delta.
+
+        :param routing_key: routing key to publish the score with
+        :param message_body: full score message
+        :return: True if a message was published, False if it was suppressed
+        """
+
+        fields = message_body.split(' | ')
+        last_fields = self._last_values.get(routing_key)
+        if self._change_only and fields == last_fields:
+            return False
+
+        headers = None
+        frames = None
+        if self._delta_encoding:
+            frames = self._frames_since_keyframe.get(routing_key, self._keyframe_interval)
+            if last_fields is None or len(last_fields) != len(fields) or frames >= self._keyframe_interval:
+                headers = {'x-frame': 'keyframe'}
+                frames = 1
+            else:
+                message_body = ' | '.join('%i=%s' % (index, field)
+                                          for index, (field, last_field) in enumerate(zip(fields, last_fields))
+                                          if field != last_field)
+                headers = {'x-frame': 'delta'}
+                frames += 1
+
+        if self._blocked:
+            self._blocked.wait_while_blocked(self._connection)
+        self._channel.basic_publish(exchange=self._exchange_name,
+                                    routing_key=routing_key,
+                                    body=message_body,
+                                    properties=pika.BasicProperties(
+                                        delivery_mode=2,
+                                        timestamp=int(time.time()),
+                                        headers=self._tracer.trace_headers(headers) if self._tracer else headers,
+                                        priority=self._priorities.get(routing_key),
+                                    ))
+        self._last_values[routing_key] = fields
+        if frames is not None:
+            self._frames_since_keyframe[routing_key] = frames
+        return True
+
     def publish_message(self):
         """
         Publishes messages to Topic Exchange on RabbitMQ Server.
@@ -80,28 +157,13 @@ class publish_engine:
             hockey_score += randint(0, 1)
 
             message_body = "Curling Score | Home Team : Australia | Away Team : England | Score : %i" %(score)
-            self._channel.basic_publish(exchange=self._exchange_name,
-                                  routing_key=self._routing_key_curling,
-                                  body=message_body,
-                                  properties=pika.BasicProperties(
-                                      delivery_mode=2,
-                                  ))
+            self.publish_score(self._routing_key_curling, message_body)
 
             message_body = "Football Score | New York Vs New England | New York : %i | New England : 0" %(football_score)
-            self._channel.basic_publish(exchange=self._exchange_name,
-                                        routing_key=self._routing_key_football,
-                                        body=message_body,
-                                        properties=pika.BasicProperties(
-                                            delivery_mode=2,
-                                        ))
+            self.publish_score(self._routing_key_football, message_body)
 
             message_body = "Hockey Score | Canada Vs Russia | Canada : %i | Russia : 0" % (hockey_score)
-            self._channel.basic_publish(exchange=self._exchange_name,
-                                        routing_key=self._routing_key_hockey,
-                                        body=message_body,
-                                        properties=pika.BasicProperties(
-                                            delivery_mode=2,
-                                        ))
+            self.publish_score(self._routing_key_hockey, message_body)
 
             print("Published scorecard for curling, football and hockey - %i " %(message_count))
             time.sleep(self._message_interval)